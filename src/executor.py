@@ -2,13 +2,11 @@
 #
 
 import os
-import wx
 import sys
 import argparse
 import numpy as np
 import multiprocessing
 
-from form.MainFrame import MainFrame
 from utils.MLogger import MLogger
 from utils import MFileUtils
 
@@ -23,20 +21,18 @@ multiprocessing.freeze_support()
 if __name__ == '__main__':
     mydir_path = MFileUtils.get_mydir_path(sys.argv[0])
 
-    if len(sys.argv) > 3 and "--motion_path" in sys.argv:
+    if len(sys.argv) > 1 and sys.argv[1] == "convert":
         if os.name == "nt":
             import winsound     # Windows版のみインポート
 
-        # 引数指定がある場合、コマンドライン実行
-        # try:
-        #     SizingService(MOptions.parse(VERSION_NAME)).execute()
-        # except SizingException as se:
-        #     print("サポーター処理が処理できないデータで終了しました。\n\n%s", se.message)
-        # except Exception:
-        #     print("サポーター処理が意図せぬエラーで終了しました。")
-        #     print(traceback.format_exc())
-        # finally:
-        #     logging.shutdown()
+        # convert指定がある場合、コマンドラインで一括変換（wxは読み込まない）
+        from module.MOptions import MBatchOptions
+        from service.Vrm2PmxBatchService import Vrm2PmxBatchService
+
+        options = MBatchOptions.parse(VERSION_NAME, mydir_path, sys.argv[2:])
+        MLogger.initialize(level=options.logging_level, is_file=False)
+
+        result = Vrm2PmxBatchService(options).execute()
 
         # 終了音を鳴らす
         if os.name == "nt":
@@ -45,7 +41,13 @@ if __name__ == '__main__':
                 winsound.PlaySound("SystemAsterisk", winsound.SND_ALIAS)
             except Exception:
                 pass
+
+        # 全件成功した場合のみ正常終了
+        sys.exit(0 if result else 1)
     else:
+        import wx
+        from form.MainFrame import MainFrame
+
         parser = argparse.ArgumentParser()
         parser.add_argument("--verbose", default=20, type=int)
         parser.add_argument("--out_log", default=0, type=int)
@@ -7,6 +7,7 @@ import re
 import wx
 import logging
 from mmd.PmxReader import PmxReader
+from mmd.VrmData import VrmModel
 from mmd.VrmReader import VrmReader
 from utils import MFileUtils
 from utils.MException import SizingException
@@ -307,12 +308,22 @@ class BaseFilePickerCtrl():
             # 新規データがあり、かつハッシュが違う場合、置き換え
             if new_data_digest and ((self.data and self.data.digest != new_data_digest) or not self.data):
                 # ハッシュが取得できてて、過去データがないかハッシュが違う場合、読み込み
-                self.data = reader.read_data()
-                    
-                logger.info("%s%s 読み込み成功: %s", display_set_no, self.title, os.path.basename(file_path))
-                return True
+                new_data = reader.read_data()
+
+                # 読み込みに失敗した場合（例外が返ってきた場合）は、前のモデルをそのまま残す
+                if not isinstance(new_data, SizingException):
+                    if isinstance(self.data, VrmModel):
+                        # 前のモデルのメモリマップを閉じる（元ファイルをロックしたままにしない）
+                        self.data.close()
+                    self.data = new_data
+
+                    logger.info("%s%s 読み込み成功: %s", display_set_no, self.title, os.path.basename(file_path))
+                    return True
             elif new_data_digest and self.data and self.data.digest == new_data_digest:
                 # ハッシュが同じ場合、そのままスルー
+                if isinstance(reader, VrmReader):
+                    # ハッシュ計算のためだけにマップしたものは閉じる
+                    reader.close()
                 logger.info("%s%s 読み込み成功: %s", display_set_no, self.title, os.path.basename(file_path))
                 return True
         except MKilledException:
@@ -329,6 +340,8 @@ class BaseFilePickerCtrl():
 
 
 class FileModelCtrl():
+    # 取得済みモデル名（キー：(ファイルパス, 更新日時, サイズ)、値：モデル名）
+    model_names = {}
 
     def __init__(self, parent, picker, title, spacer_cnt, set_no):
         super().__init__()
@@ -375,9 +388,22 @@ class FileModelCtrl():
                 reader = PmxReader(file_path)
             else:
                 return "対象外拡張子"
+
+            # ファイルが変わっていなければ、前回取得したモデル名を使う
+            try:
+                stat = os.stat(file_path)
+                model_name_key = (os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                model_name_key = None
+
+            if model_name_key in self.model_names:
+                return self.model_names[model_name_key]
             
             try:
                 model_name = reader.read_model_name()
+
+                if model_name_key:
+                    self.model_names[model_name_key] = model_name
             except Exception:
                 model_name = "取得失敗"
 
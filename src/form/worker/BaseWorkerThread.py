@@ -80,6 +80,10 @@ def task_takes_time(acallable):
     """
     @wraps(acallable)
     def f(base_thread):
+        # 前回の停止命令で止まっていないスレッドがなければ、停止命令の確認を止める
+        if not [th for th in threading.enumerate() if isinstance(th, SimpleThread) and th._kwargs.get("is_killed", False)]:
+            MLogger.is_killing = False
+
         t = SimpleThread(base_thread, acallable)
         t.daemon = True
         t.start()
@@ -90,6 +94,7 @@ def task_takes_time(acallable):
 
             if base_thread.is_killed:
                 # 呼び出し元から停止命令が出ている場合、自分以外の全部のスレッドに終了命令
+                MLogger.is_killing = True
                 for th in threading.enumerate():
                     if th.ident != threading.current_thread().ident:
                         th._kwargs["is_killed"] = True
@@ -46,7 +46,8 @@ class ExportWorkerThread(BaseWorkerThread):
                     monitor=self.frame.export_panel_ctrl.console_ctrl, \
                     is_file=False, \
                     outout_datetime=logger.outout_datetime, \
-                    max_workers=(1 if self.is_exec_saving else min(5, 32, os.cpu_count() + 4)))
+                    max_workers=(1 if self.is_exec_saving else min(5, 32, os.cpu_count() + 4)), \
+                    mydir_path=self.frame.mydir_path)
                 
                 self.result = Vrm2PmxExportService(self.options).execute() and self.result
 
@@ -2,9 +2,10 @@
 #
 import _pickle as cPickle
 import math
+from collections.abc import Mapping
 import numpy as np
 
-from module.MMath import MRect, MVector2D, MVector3D, MVector4D, MQuaternion, MMatrix4x4 # noqa
+from module.MMath import MRect, MVector2D, MVector3D, MVector4D, MQuaternion, MMatrix4x4, MVector3DArray, mul_matrix_vectors # noqa
 from utils.MException import SizingException # noqa
 from utils.MLogger import MLogger # noqa
 
@@ -159,6 +160,132 @@ class Vertex:
         return self.deform.index0
 
 
+# 頂点データ（項目ごとの配列で保持する） ----------------------------
+class VertexStore:
+    # 変形方式ごとのボーンINDEX数（BDEF1, BDEF2, BDEF4, SDEF, QDEF）
+    DEFORM_INDEX_COUNTS = np.array([1, 2, 4, 2, 2])
+
+    def __init__(self, positions=None, normals=None, uvs=None, extended_uvs=None, deform_types=None, bone_indexes=None, weights=None, sdefs=None, edge_factors=None):
+        vertex_count = 0 if positions is None else len(positions)
+        # 位置 (N, 3)
+        self.positions = np.zeros((vertex_count, 3), dtype=np.float32) if positions is None else positions
+        # 法線 (N, 3)
+        self.normals = np.zeros((vertex_count, 3), dtype=np.float32) if normals is None else normals
+        # UV (N, 2)
+        self.uvs = np.zeros((vertex_count, 2), dtype=np.float32) if uvs is None else uvs
+        # 追加UV (N, 追加UV数, 4)
+        self.extended_uvs = np.zeros((vertex_count, 0, 4), dtype=np.float32) if extended_uvs is None else extended_uvs
+        # 変形方式 (N)
+        self.deform_types = np.zeros(vertex_count, dtype=np.uint8) if deform_types is None else deform_types
+        # ボーンINDEX (N, 4)（未使用は0）
+        self.bone_indexes = np.zeros((vertex_count, 4), dtype=np.int32) if bone_indexes is None else bone_indexes
+        # ウェイト (N, 4)
+        self.weights = np.zeros((vertex_count, 4), dtype=np.float32) if weights is None else weights
+        # SDEF-C, SDEF-R0, SDEF-R1 (N, 3, 3)
+        self.sdefs = np.zeros((vertex_count, 3, 3), dtype=np.float32) if sdefs is None else sdefs
+        # エッジ倍率 (N)
+        self.edge_factors = np.ones(vertex_count, dtype=np.float32) if edge_factors is None else edge_factors
+
+        # ボーンごとの頂点INDEX（CSR形式、必要になった時に生成）
+        self.bone_vertex_table = None
+        # 生成済みの頂点オブジェクト
+        self.vertex_cache = {}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __str__(self):
+        return "<VertexStore vertices(len):{0}, extended_uv:{1}".format(len(self), self.extended_uvs.shape[1])
+
+    # 出力用の項目ごとの配列
+    def get_columns(self):
+        return {"positions": self.positions, "normals": self.normals, "uvs": self.uvs, "extended_uvs": self.extended_uvs, "deform_types": self.deform_types,
+                "bone_indexes": self.bone_indexes, "weights": self.weights, "sdefs": self.sdefs, "edge_factors": self.edge_factors}
+
+    # 配列を直接書き換えた後に呼び出し、生成済みのデータを破棄する
+    def clear_cache(self):
+        self.bone_vertex_table = None
+        self.vertex_cache = {}
+
+    # ボーンINDEXごとの頂点INDEX（ボーンINDEXリスト, 開始位置, 頂点INDEX）
+    def get_bone_vertex_table(self):
+        if self.bone_vertex_table is None:
+            # 変形方式で使用しているボーンINDEXのみ対象
+            used_mask = np.arange(4) < self.DEFORM_INDEX_COUNTS[self.deform_types][:, np.newaxis]
+            vertex_idxs = np.broadcast_to(np.arange(len(self))[:, np.newaxis], used_mask.shape)[used_mask]
+            bone_idxs = self.bone_indexes[used_mask]
+
+            # ボーンINDEX・頂点INDEX順に並べて、同じ組み合わせは除く
+            order = np.lexsort((vertex_idxs, bone_idxs))
+            vertex_idxs = vertex_idxs[order]
+            bone_idxs = bone_idxs[order]
+            unique_mask = np.ones(len(order), dtype=bool)
+            unique_mask[1:] = (bone_idxs[1:] != bone_idxs[:-1]) | (vertex_idxs[1:] != vertex_idxs[:-1])
+            vertex_idxs = vertex_idxs[unique_mask]
+            bone_idxs = bone_idxs[unique_mask]
+
+            keys, starts = np.unique(bone_idxs, return_index=True)
+            self.bone_vertex_table = (keys, np.append(starts, len(bone_idxs)), vertex_idxs)
+
+        return self.bone_vertex_table
+
+    # 指定ボーンにウェイトが乗っている頂点INDEX
+    def get_vertex_indexes(self, bone_idx: int):
+        keys, offsets, vertex_idxs = self.get_bone_vertex_table()
+        n = np.searchsorted(keys, bone_idx)
+        if n >= len(keys) or keys[n] != bone_idx:
+            return np.zeros(0, dtype=vertex_idxs.dtype)
+
+        return vertex_idxs[offsets[n]:offsets[n + 1]]
+
+    # 頂点オブジェクト（参照された時に生成する）
+    def get_vertex(self, vertex_idx: int):
+        vertex_idx = int(vertex_idx)
+        if vertex_idx not in self.vertex_cache:
+            bone_indexes = self.bone_indexes[vertex_idx].tolist()
+            weights = self.weights[vertex_idx].tolist()
+            sdefs = [MVector3D(*v) for v in self.sdefs[vertex_idx].tolist()]
+            deform_type = int(self.deform_types[vertex_idx])
+
+            if deform_type == 0:
+                deform = Bdef1(bone_indexes[0])
+            elif deform_type == 1:
+                deform = Bdef2(bone_indexes[0], bone_indexes[1], weights[0])
+            elif deform_type == 2:
+                deform = Bdef4(*bone_indexes, *weights)
+            elif deform_type == 3:
+                deform = Sdef(bone_indexes[0], bone_indexes[1], weights[0], *sdefs)
+            elif deform_type == 4:
+                deform = Qdef(bone_indexes[0], bone_indexes[1], weights[0], *sdefs)
+            else:
+                raise SizingException("unknown deform_type: {0}".format(deform_type))
+
+            self.vertex_cache[vertex_idx] = Vertex(vertex_idx, MVector3D(*self.positions[vertex_idx].tolist()), MVector3D(*self.normals[vertex_idx].tolist()),
+                                                   self.uvs[vertex_idx].tolist(), [MVector4D(*v) for v in self.extended_uvs[vertex_idx].tolist()],
+                                                   deform, float(self.edge_factors[vertex_idx]))
+
+        return self.vertex_cache[vertex_idx]
+
+
+# ボーンINDEXごとの頂点リスト（VertexStoreの読み取り専用ビュー）
+class VertexBoneView(Mapping):
+    def __init__(self, vertex_store: VertexStore):
+        self.vertex_store = vertex_store
+
+    def __getitem__(self, bone_idx):
+        vertex_idxs = self.vertex_store.get_vertex_indexes(bone_idx)
+        if len(vertex_idxs) == 0:
+            raise KeyError(bone_idx)
+
+        return [self.vertex_store.get_vertex(vertex_idx) for vertex_idx in vertex_idxs]
+
+    def __iter__(self):
+        return iter(self.vertex_store.get_bone_vertex_table()[0].tolist())
+
+    def __len__(self):
+        return len(self.vertex_store.get_bone_vertex_table()[0])
+
+
 # 材質構造-----------------------
 class Material:
     def __init__(self, name, english_name, diffuse_color, alpha, specular_factor, specular_color, ambient_color, flag, edge_color, edge_size, texture_index,
@@ -371,6 +498,21 @@ class Morph:
             self.vertex_index = vertex_index
             self.position_offset = position_offset
 
+    # 頂点モーフのオフセットを配列で保持（参照時にVertexMorphOffsetを生成）
+    class VertexMorphOffsets:
+        def __init__(self, vertex_indexes, position_offsets):
+            # 頂点INDEX (N)
+            self.vertex_indexes = vertex_indexes
+            # 位置オフセット (N, 3)
+            self.position_offsets = position_offsets
+
+        def __len__(self):
+            return len(self.vertex_indexes)
+
+        def __iter__(self):
+            for vertex_index, position_offset in zip(self.vertex_indexes.tolist(), self.position_offsets.tolist()):
+                yield Morph.VertexMorphOffset(vertex_index, MVector3D(*position_offset))
+
     class BoneMorphData:
         def __init__(self, bone_index, position, rotation):
             self.bone_index = bone_index
@@ -504,6 +646,10 @@ class OBB:
         # 剛体自体の回転(回転用行列だけ保持)
         self.rotated_matrix.rotate(self.shape_rotation_qq)
 
+        # 逆行列（判定のたびに求めないよう保持）
+        self.inverted_matrix = self.matrix.inverted()
+        self.rotated_inverted_matrix = self.rotated_matrix.inverted()
+
         # 剛体自体の原点
         self.origin = self.matrix * MVector3D(0, 0, 0)
 
@@ -513,6 +659,38 @@ class OBB:
     # OBBとの衝突判定
     def get_collistion(self, point, root_global_pos, max_length):
         pass
+
+    # OBBとの衝突判定（複数点）
+    # 戻り値は get_collistion と同じ並びで、点ごとの配列とする
+    def get_collistions(self, points, root_global_pos, max_length):
+        pass
+
+    # 近接判定を含む範囲を覆う軸平行境界ボックス（最小, 最大）
+    def get_aabb(self):
+        pass
+
+    # 離れ具合の角度（複数点）
+    def get_thetas(self, values, base):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratios = values / base
+        # 0除算で不定の場合、離れていないものとする
+        ratios[np.isnan(ratios)] = 1
+        return np.arccos(np.clip(ratios, -1, 1))
+
+    # 腕から見た回避位置が最大可能距離より長い場合、縮める（複数点）
+    # 縮めた点のマスクを返す（rep_collision_vecs は直接更新）
+    def shrink_collision_vecs(self, rep_collision_vecs, root_global_pos, max_length):
+        root_pos = root_global_pos.data()
+        arm_locals = rep_collision_vecs - root_pos
+        arm_lengths = np.linalg.norm(arm_locals, axis=1)
+
+        shrink_mask = arm_lengths >= max_length
+        if np.any(shrink_mask):
+            with np.errstate(divide="ignore", invalid="ignore"):
+                ratios = (max_length / arm_lengths[shrink_mask]) * 0.98
+            rep_collision_vecs[shrink_mask] = arm_locals[shrink_mask] * ratios[:, np.newaxis] + root_pos
+
+        return shrink_mask
     
 
 # 球剛体
@@ -535,7 +713,7 @@ class Sphere(OBB):
 
         if collision or near_collision:
             # 剛体のローカル座標系に基づく点の位置
-            local_point = self.matrix.inverted() * point
+            local_point = self.inverted_matrix * point
 
             x = self.shape_size.x() * 1.02 * self.h_sign
             y = self.shape_size.x() * 1.02 * self.v_sign
@@ -574,14 +752,14 @@ class Sphere(OBB):
                 # 最大可能距離より長い場合、縮める
                 x_arm_local *= (max_length / x_arm_local.length()) * 0.98
                 rep_x_collision_vec = arm_matrix * x_arm_local
-                new_x_local = self.matrix.inverted() * rep_x_collision_vec
+                new_x_local = self.inverted_matrix * rep_x_collision_vec
                 x_distance = new_x_local.distanceToPoint(local_point)
 
             if z_arm_local.length() >= max_length:
                 # 最大可能距離より長い場合、縮める
                 z_arm_local *= (max_length / z_arm_local.length()) * 0.98
                 rep_z_collision_vec = arm_matrix * z_arm_local
-                new_z_local = self.matrix.inverted() * rep_z_collision_vec
+                new_z_local = self.inverted_matrix * rep_z_collision_vec
                 z_distance = new_z_local.distanceToPoint(local_point)
 
             logger.debug("f: %s, y: %s, yt: %s, sy: %s, xt: %s, sx: %s, zt: %s, sz: %s, xd: %s, zd: %s, l: %s, d: %s, xl: %s, zl: %s, xr: %s, zr: %s", \
@@ -591,18 +769,68 @@ class Sphere(OBB):
         # 3方向の間に点が含まれていたら衝突あり
         return (collision, near_collision, x_distance, z_distance, rep_x_collision_vec, rep_z_collision_vec)
 
+    def get_aabb(self):
+        radius = MVector3D(1, 1, 1) * (self.shape_size.x() * 1.02 + 0.0001)
+        return (self.origin - radius, self.origin + radius)
+
+    # 衝突しているか（複数点）
+    def get_collistions(self, points, root_global_pos, max_length):
+        points = MVector3DArray(points).data()
+
+        # 原点との距離が半径未満なら衝突
+        d = np.linalg.norm(points - self.origin.data(), axis=1)
+        collisions = (0 < d) & (d < self.shape_size.x() * 0.98)
+        near_collisions = (0 <= d) & (d <= self.shape_size.x() * 1.02)
+
+        x_distances = np.zeros(len(points), dtype=np.float64)
+        z_distances = np.zeros(len(points), dtype=np.float64)
+        rep_x_collision_vecs = np.zeros((len(points), 3), dtype=np.float64)
+        rep_z_collision_vecs = np.zeros((len(points), 3), dtype=np.float64)
+
+        hits = collisions | near_collisions
+        if np.any(hits):
+            # 剛体のローカル座標系に基づく点の位置
+            local_points = mul_matrix_vectors(self.inverted_matrix.data(), points[hits])
+
+            x = self.shape_size.x() * 1.02 * self.h_sign
+            y = self.shape_size.x() * 1.02 * self.v_sign
+            z = self.shape_size.x() * 1.02 * -1
+
+            # Y軸方向の離れ具合
+            y_thetas = self.get_thetas(local_points[:, 1], y)
+
+            new_x_locals = local_points.copy()
+            new_x_locals[:, 0] = y_thetas * x
+            new_z_locals = local_points.copy()
+            new_z_locals[:, 2] = y_thetas * z
+
+            hit_x_distances = np.linalg.norm(new_x_locals - local_points, axis=1)
+            hit_z_distances = np.linalg.norm(new_z_locals - local_points, axis=1)
+
+            hit_rep_x_vecs = mul_matrix_vectors(self.matrix.data(), new_x_locals)
+            hit_rep_z_vecs = mul_matrix_vectors(self.matrix.data(), new_z_locals)
+
+            # 腕から見て遠すぎる場合、縮める
+            for (hit_rep_vecs, hit_distances) in [(hit_rep_x_vecs, hit_x_distances), (hit_rep_z_vecs, hit_z_distances)]:
+                shrink_mask = self.shrink_collision_vecs(hit_rep_vecs, root_global_pos, max_length)
+                new_locals = mul_matrix_vectors(self.inverted_matrix.data(), hit_rep_vecs[shrink_mask])
+                hit_distances[shrink_mask] = np.linalg.norm(new_locals - local_points[shrink_mask], axis=1)
+
+            x_distances[hits] = hit_x_distances
+            z_distances[hits] = hit_z_distances
+            rep_x_collision_vecs[hits] = hit_rep_x_vecs
+            rep_z_collision_vecs[hits] = hit_rep_z_vecs
+
+        logger.test("f: %s, points: %s, collisions: %s, near_collisions: %s", self.fno, len(points), np.count_nonzero(collisions), np.count_nonzero(near_collisions))
+
+        return (collisions, near_collisions, x_distances, z_distances, MVector3DArray(rep_x_collision_vecs), MVector3DArray(rep_z_collision_vecs))
+
 
 # 箱剛体
 class Box(OBB):
     def __init__(self, *args):
         super().__init__(*args)
 
-    # 衝突しているか（内外判定）
-    # https://stackoverflow.com/questions/21037241/how-to-determine-a-point-is-inside-or-outside-a-cube
-    def get_collistion(self, point, root_global_pos, max_length):
-        # 立方体の中にある場合、衝突
-
-        # ---------
         # 下辺
         b1 = self.matrix * MVector3D(-self.shape_size.x(), -self.shape_size.y(), -self.shape_size.z())
         b2 = self.matrix * MVector3D(self.shape_size.x(), -self.shape_size.y(), -self.shape_size.z())
@@ -610,60 +838,35 @@ class Box(OBB):
         # 上辺
         t1 = self.matrix * MVector3D(-self.shape_size.x(), self.shape_size.y(), -self.shape_size.z())
 
-        d1 = (t1 - b1)
-        size1 = d1.length()
-        dir1 = d1 / size1
-        dir1.effective()
+        # 箱の3辺の向きと長さ
+        self.axes = []
+        self.axis_sizes = []
+        for d in [(t1 - b1), (b2 - b1), (b4 - b1)]:
+            size = d.length()
+            axis = d / size
+            axis.effective()
 
-        d2 = (b2 - b1)
-        size2 = d2.length()
-        dir2 = d2 / size2
-        dir2.effective()
-
-        d3 = (b4 - b1)
-        size3 = d3.length()
-        dir3 = d3 / size3
-        dir3.effective()
+            self.axes.append(axis)
+            self.axis_sizes.append(size)
 
+    # 衝突しているか（内外判定）
+    # https://stackoverflow.com/questions/21037241/how-to-determine-a-point-is-inside-or-outside-a-cube
+    def get_collistion(self, point, root_global_pos, max_length):
+        # 立方体の中にある場合、衝突
         dir_vec = point - self.origin
         dir_vec.effective()
 
-        res1 = abs(MVector3D.dotProduct(dir_vec, dir1)) * 2 < size1
-        res2 = abs(MVector3D.dotProduct(dir_vec, dir2)) * 2 < size2
-        res3 = abs(MVector3D.dotProduct(dir_vec, dir3)) * 2 < size3
+        res1 = abs(MVector3D.dotProduct(dir_vec, self.axes[0])) * 2 < self.axis_sizes[0]
+        res2 = abs(MVector3D.dotProduct(dir_vec, self.axes[1])) * 2 < self.axis_sizes[1]
+        res3 = abs(MVector3D.dotProduct(dir_vec, self.axes[2])) * 2 < self.axis_sizes[2]
 
         # 3方向の間に点が含まれていたら衝突あり
         collision = (res1 and res2 and res3 and True)
 
-        # ---------
-        # 下辺
-        b1 = self.matrix * MVector3D(-self.shape_size.x(), -self.shape_size.y(), -self.shape_size.z()) * 1.02
-        b2 = self.matrix * MVector3D(self.shape_size.x(), -self.shape_size.y(), -self.shape_size.z()) * 1.02
-        b4 = self.matrix * MVector3D(-self.shape_size.x(), -self.shape_size.y(), self.shape_size.z()) * 1.02
-        # 上辺
-        t1 = self.matrix * MVector3D(-self.shape_size.x(), self.shape_size.y(), -self.shape_size.z()) * 1.02
-
-        d1 = (t1 - b1)
-        size1 = d1.length()
-        dir1 = d1 / size1
-        dir1.effective()
-
-        d2 = (b2 - b1)
-        size2 = d2.length()
-        dir2 = d2 / size2
-        dir2.effective()
-
-        d3 = (b4 - b1)
-        size3 = d3.length()
-        dir3 = d3 / size3
-        dir3.effective()
-
-        dir_vec = point - self.origin
-        dir_vec.effective()
-
-        res1 = abs(MVector3D.dotProduct(dir_vec, dir1)) * 2 < size1
-        res2 = abs(MVector3D.dotProduct(dir_vec, dir2)) * 2 < size2
-        res3 = abs(MVector3D.dotProduct(dir_vec, dir3)) * 2 < size3
+        # 少し大きい箱（軸の向きは同じ）
+        res1 = abs(MVector3D.dotProduct(dir_vec, self.axes[0])) * 2 < self.axis_sizes[0] * 1.02
+        res2 = abs(MVector3D.dotProduct(dir_vec, self.axes[1])) * 2 < self.axis_sizes[1] * 1.02
+        res3 = abs(MVector3D.dotProduct(dir_vec, self.axes[2])) * 2 < self.axis_sizes[2] * 1.02
 
         # 3方向の間に点が含まれていたら衝突あり
         near_collision = (res1 and res2 and res3 and True)
@@ -692,7 +895,7 @@ class Box(OBB):
             logger.test("z_diff: %s", z_diff)
 
             # 剛体のローカル座標系に基づく点の位置
-            local_point = self.rotated_matrix.inverted() * point
+            local_point = self.rotated_inverted_matrix * point
 
             new_y = local_point.y()
 
@@ -718,14 +921,14 @@ class Box(OBB):
                 # 最大可能距離より長い場合、縮める
                 x_arm_local *= (max_length / x_arm_local.length()) * 0.98
                 rep_x_collision_vec = arm_matrix * x_arm_local
-                new_x_local = self.matrix.inverted() * rep_x_collision_vec
+                new_x_local = self.inverted_matrix * rep_x_collision_vec
                 x_distance = new_x_local.distanceToPoint(local_point)
 
             if z_arm_local.length() >= max_length:
                 # 最大可能距離より長い場合、縮める
                 z_arm_local *= (max_length / z_arm_local.length()) * 0.98
                 rep_z_collision_vec = arm_matrix * z_arm_local
-                new_z_local = self.matrix.inverted() * rep_z_collision_vec
+                new_z_local = self.inverted_matrix * rep_z_collision_vec
                 z_distance = new_z_local.distanceToPoint(local_point)
 
             logger.debug("f: %s, xd: %s, zd: %s, l: %s, xl: %s, zl: %s, xr: %s, zr: %s", \
@@ -733,20 +936,84 @@ class Box(OBB):
 
         return (collision, near_collision, x_distance, z_distance, rep_x_collision_vec, rep_z_collision_vec)
 
+    def get_aabb(self):
+        # 各辺の半分（少し大きい箱）をXYZ軸に投影した長さ
+        extent = MVector3D(0.0001, 0.0001, 0.0001)
+        for (axis, size) in zip(self.axes, self.axis_sizes):
+            extent += MVector3D(abs(axis.x()), abs(axis.y()), abs(axis.z())) * (size * 1.02 / 2)
+        return (self.origin - extent, self.origin + extent)
+
+    # 衝突しているか（内外判定・複数点）
+    def get_collistions(self, points, root_global_pos, max_length):
+        points = MVector3DArray(points).data()
+
+        # 各辺方向への距離
+        dir_vecs = points - self.origin.data()
+        dir_vecs[~np.isfinite(dir_vecs)] = 0
+        axis_distances = np.abs(dir_vecs @ np.array([axis.data() for axis in self.axes]).T) * 2
+        axis_sizes = np.array(self.axis_sizes, dtype=np.float64)
+
+        # 3方向の間に点が含まれていたら衝突あり
+        collisions = np.all(axis_distances < axis_sizes, axis=1)
+        near_collisions = np.all(axis_distances < axis_sizes * 1.02, axis=1)
+
+        x_distances = np.zeros(len(points), dtype=np.float64)
+        z_distances = np.zeros(len(points), dtype=np.float64)
+        rep_x_collision_vecs = np.zeros((len(points), 3), dtype=np.float64)
+        rep_z_collision_vecs = np.zeros((len(points), 3), dtype=np.float64)
+
+        hits = collisions | near_collisions
+        if np.any(hits):
+            # 左右の腕のどちらと衝突しているかにより、元に戻す方向が逆になる
+            x = self.shape_size.x() * 1.02 * self.h_sign
+            z = -self.shape_size.z() * 1.02
+
+            # 剛体のローカル座標系に基づく点の位置
+            local_points = mul_matrix_vectors(self.rotated_inverted_matrix.data(), points[hits])
+
+            new_x_locals = local_points.copy()
+            new_x_locals[:, 0] = x
+            new_z_locals = local_points.copy()
+            new_z_locals[:, 2] = z
+
+            hit_x_distances = np.linalg.norm(new_x_locals - local_points, axis=1)
+            hit_z_distances = np.linalg.norm(new_z_locals - local_points, axis=1)
+
+            hit_rep_x_vecs = mul_matrix_vectors(self.rotated_matrix.data(), new_x_locals)
+            hit_rep_z_vecs = mul_matrix_vectors(self.rotated_matrix.data(), new_z_locals)
+
+            # 腕から見て遠すぎる場合、縮める
+            for (hit_rep_vecs, hit_distances) in [(hit_rep_x_vecs, hit_x_distances), (hit_rep_z_vecs, hit_z_distances)]:
+                shrink_mask = self.shrink_collision_vecs(hit_rep_vecs, root_global_pos, max_length)
+                new_locals = mul_matrix_vectors(self.inverted_matrix.data(), hit_rep_vecs[shrink_mask])
+                hit_distances[shrink_mask] = np.linalg.norm(new_locals - local_points[shrink_mask], axis=1)
+
+            x_distances[hits] = hit_x_distances
+            z_distances[hits] = hit_z_distances
+            rep_x_collision_vecs[hits] = hit_rep_x_vecs
+            rep_z_collision_vecs[hits] = hit_rep_z_vecs
+
+        logger.test("f: %s, points: %s, collisions: %s, near_collisions: %s", self.fno, len(points), np.count_nonzero(collisions), np.count_nonzero(near_collisions))
+
+        return (collisions, near_collisions, x_distances, z_distances, MVector3DArray(rep_x_collision_vecs), MVector3DArray(rep_z_collision_vecs))
+
 
 # カプセル剛体
 class Capsule(OBB):
     def __init__(self, *args):
         super().__init__(*args)
 
+        # 下辺
+        self.bottom_pos = self.rotated_matrix * MVector3D(0, -self.shape_size.y(), 0)
+        # 上辺
+        self.top_pos = self.rotated_matrix * MVector3D(0, self.shape_size.y(), 0)
+
     # 衝突しているか
     # http://marupeke296.com/COL_3D_No27_CapsuleCapsule.html
     def get_collistion(self, point, root_global_pos, max_length):
 
-        # 下辺
-        b1 = self.rotated_matrix * MVector3D(0, -self.shape_size.y(), 0)
-        # 上辺
-        t1 = self.rotated_matrix * MVector3D(0, self.shape_size.y(), 0)
+        b1 = self.bottom_pos
+        t1 = self.top_pos
 
         # 垂線までの長さ
         v = (t1 - b1)
@@ -800,7 +1067,7 @@ class Capsule(OBB):
         if collision or near_collision:
             # hのローカル座標系に基づく点の位置
             h_matrix = self.matrix.copy()
-            h_matrix.translate(self.matrix.inverted() * h)
+            h_matrix.translate(self.inverted_matrix * h)
             local_point = h_matrix.inverted() * point
             logger.debug("h: %s, localh: %s", h, h_matrix * MVector3D())
 
@@ -860,6 +1127,195 @@ class Capsule(OBB):
         # 3方向の間に点が含まれていたら衝突あり
         return (collision, near_collision, x_distance, z_distance, rep_x_collision_vec, rep_z_collision_vec)
 
+    def get_aabb(self):
+        radius = MVector3D(1, 1, 1) * (self.shape_size.x() * 1.02 + 0.0001)
+        # 垂線が線分の長さ以内で外側に下りた場合は端点に寄せないため、線分の長さ分伸ばした範囲とする
+        v = self.top_pos - self.bottom_pos
+        ends = np.array([(self.bottom_pos - v).data(), (self.top_pos + v).data()])
+        return (MVector3D(np.min(ends, axis=0)) - radius, MVector3D(np.max(ends, axis=0)) + radius)
+
+    # 衝突しているか（複数点）
+    def get_collistions(self, points, root_global_pos, max_length):
+        points = MVector3DArray(points).data()
+
+        b1 = self.bottom_pos.data()
+        t1 = self.top_pos.data()
+
+        # 垂線を下ろした座標
+        v = (t1 - b1)
+        lensq = np.sum(v ** 2)
+        t = np.zeros(len(points), dtype=np.float64) if lensq == 0 else ((points - b1) @ v) / lensq
+        hs = b1 + v * t[:, np.newaxis]
+
+        # 線分の外側に垂線が下りた場合、近い方の端点
+        segment_length = np.linalg.norm(t1 - b1)
+        b1_lengths = np.linalg.norm(hs - b1, axis=1)
+        t1_lengths = np.linalg.norm(hs - t1, axis=1)
+        hs[(segment_length < b1_lengths) & (b1_lengths < t1_lengths)] = b1
+        hs[(segment_length < t1_lengths) & (t1_lengths < b1_lengths)] = t1
+
+        # カプセルの線分から半径以内なら中に入っている
+        d = np.linalg.norm(points - hs, axis=1)
+        collisions = (0 < d) & (d < self.shape_size.x() * 0.98)
+        near_collisions = (0 <= d) & (d <= self.shape_size.x() * 1.02)
+
+        x_distances = np.zeros(len(points), dtype=np.float64)
+        z_distances = np.zeros(len(points), dtype=np.float64)
+        rep_x_collision_vecs = np.zeros((len(points), 3), dtype=np.float64)
+        rep_z_collision_vecs = np.zeros((len(points), 3), dtype=np.float64)
+
+        hits = collisions | near_collisions
+        if np.any(hits):
+            # hのローカル座標系（剛体の回転なし行列をhに移動したもの）
+            rotation = self.matrix.data()[:3, :3]
+            inverted_rotation = self.inverted_matrix.data()[:3, :3]
+            hit_hs = hs[hits]
+            local_points = (points[hits] - hit_hs) @ inverted_rotation.T
+
+            # 距離分だけ離した場合の球
+            hit_d = d[hits]
+            x = hit_d * 1.02 * self.h_sign
+            y = hit_d * 1.02 * self.v_sign
+            z = hit_d * 1.02 * -1
+
+            # Y軸方向の離れ具合
+            y_thetas = self.get_thetas(np.abs(local_points[:, 1]), y)
+
+            new_x_locals = local_points.copy()
+            new_x_locals[:, 0] = y_thetas * x
+            new_z_locals = local_points.copy()
+            new_z_locals[:, 2] = y_thetas * z
+
+            hit_x_distances = np.linalg.norm(new_x_locals - local_points, axis=1)
+            hit_z_distances = np.linalg.norm(new_z_locals - local_points, axis=1)
+
+            hit_rep_x_vecs = new_x_locals @ rotation.T + hit_hs
+            hit_rep_z_vecs = new_z_locals @ rotation.T + hit_hs
+
+            # 腕から見て遠すぎる場合、縮める
+            for (hit_rep_vecs, hit_distances) in [(hit_rep_x_vecs, hit_x_distances), (hit_rep_z_vecs, hit_z_distances)]:
+                shrink_mask = self.shrink_collision_vecs(hit_rep_vecs, root_global_pos, max_length)
+                new_locals = (hit_rep_vecs[shrink_mask] - hit_hs[shrink_mask]) @ inverted_rotation.T
+                hit_distances[shrink_mask] = np.linalg.norm(new_locals - local_points[shrink_mask], axis=1)
+
+            x_distances[hits] = hit_x_distances
+            z_distances[hits] = hit_z_distances
+            rep_x_collision_vecs[hits] = hit_rep_x_vecs
+            rep_z_collision_vecs[hits] = hit_rep_z_vecs
+
+        logger.test("f: %s, points: %s, collisions: %s, near_collisions: %s", self.fno, len(points), np.count_nonzero(collisions), np.count_nonzero(near_collisions))
+
+        return (collisions, near_collisions, x_distances, z_distances, MVector3DArray(rep_x_collision_vecs), MVector3DArray(rep_z_collision_vecs))
+
+
+# OBBの境界ボックス木（AABB木）
+# 点の近くにあるOBBのみを衝突判定の対象とする
+class OBBTree:
+    def __init__(self, obbs, leaf_size=2):
+        self.obbs = list(obbs)
+        self.leaf_size = leaf_size
+
+        # OBBごとの境界ボックス
+        self.obb_mins = np.zeros((len(self.obbs), 3), dtype=np.float64)
+        self.obb_maxs = np.zeros((len(self.obbs), 3), dtype=np.float64)
+        for (obb_idx, obb) in enumerate(self.obbs):
+            (min_pos, max_pos) = obb.get_aabb()
+            self.obb_mins[obb_idx] = min_pos.data()
+            self.obb_maxs[obb_idx] = max_pos.data()
+
+        # ノードデータ（境界ボックス、子ノードINDEX、葉のOBB INDEXリスト）
+        self.node_mins = []
+        self.node_maxs = []
+        self.node_children = []
+        self.node_obb_indexes = []
+
+        if len(self.obbs) > 0:
+            self.build_node(np.arange(len(self.obbs)))
+
+        logger.test("obbs: %s, nodes: %s", len(self.obbs), len(self.node_mins))
+
+    def __str__(self):
+        return "<OBBTree obbs(len):{0}, nodes(len):{1}".format(len(self.obbs), len(self.node_mins))
+
+    # ノード生成（最も長い軸の中央値で二分割）
+    def build_node(self, obb_indexes):
+        node_idx = len(self.node_mins)
+        self.node_mins.append(np.min(self.obb_mins[obb_indexes], axis=0))
+        self.node_maxs.append(np.max(self.obb_maxs[obb_indexes], axis=0))
+        self.node_children.append(None)
+        self.node_obb_indexes.append(None)
+
+        if len(obb_indexes) <= self.leaf_size:
+            self.node_obb_indexes[node_idx] = obb_indexes
+            return node_idx
+
+        centers = (self.obb_mins[obb_indexes] + self.obb_maxs[obb_indexes]) / 2
+        split_axis = np.argmax(self.node_maxs[node_idx] - self.node_mins[node_idx])
+        sorted_indexes = obb_indexes[np.argsort(centers[:, split_axis], kind="stable")]
+        half = len(sorted_indexes) // 2
+
+        left_idx = self.build_node(sorted_indexes[:half])
+        right_idx = self.build_node(sorted_indexes[half:])
+        self.node_children[node_idx] = (left_idx, right_idx)
+
+        return node_idx
+
+    # 点を含む可能性のあるOBBのINDEXリスト
+    def get_candidates(self, point):
+        p = point.data()
+        candidates = []
+
+        stack = [0] if len(self.node_mins) > 0 else []
+        while stack:
+            node_idx = stack.pop()
+            if np.any(p < self.node_mins[node_idx]) or np.any(p > self.node_maxs[node_idx]):
+                continue
+
+            if self.node_children[node_idx]:
+                stack.extend(self.node_children[node_idx])
+            else:
+                for obb_idx in self.node_obb_indexes[node_idx]:
+                    if np.all(self.obb_mins[obb_idx] <= p) and np.all(p <= self.obb_maxs[obb_idx]):
+                        candidates.append(int(obb_idx))
+
+        return sorted(candidates)
+
+    # OBBごとの、境界ボックス内にある点のINDEX配列（キー：OBB INDEX）
+    def get_candidate_points(self, points):
+        points = MVector3DArray(points).data()
+        candidates = {}
+
+        stack = [(0, np.arange(len(points)))] if len(self.node_mins) > 0 else []
+        while stack:
+            (node_idx, point_indexes) = stack.pop()
+            node_points = points[point_indexes]
+            point_indexes = point_indexes[np.all((self.node_mins[node_idx] <= node_points) & (node_points <= self.node_maxs[node_idx]), axis=1)]
+            if len(point_indexes) == 0:
+                continue
+
+            if self.node_children[node_idx]:
+                for child_idx in self.node_children[node_idx]:
+                    stack.append((child_idx, point_indexes))
+            else:
+                node_points = points[point_indexes]
+                for obb_idx in self.node_obb_indexes[node_idx]:
+                    obb_point_indexes = point_indexes[np.all((self.obb_mins[obb_idx] <= node_points) & (node_points <= self.obb_maxs[obb_idx]), axis=1)]
+                    if len(obb_point_indexes) > 0:
+                        candidates[int(obb_idx)] = obb_point_indexes
+
+        return candidates
+
+    # 候補となるOBBとのみ衝突判定を行う（複数点）
+    # 戻り値は（OBB INDEX, 点INDEX配列, get_collistions の結果）のリスト
+    def get_collistions(self, points, root_global_pos, max_length):
+        points = MVector3DArray(points).data()
+        results = []
+
+        for (obb_idx, point_indexes) in sorted(self.get_candidate_points(points).items()):
+            results.append((obb_idx, point_indexes, self.obbs[obb_idx].get_collistions(points[point_indexes], root_global_pos, max_length)))
+
+        return results
+
 
 # ジョイント構造-----------------------
 class Joint:
@@ -895,10 +1351,10 @@ class PmxModel:
         self.english_name = ''
         self.comment = ''
         self.english_comment = ''
-        # 頂点データ（キー：ボーンINDEX、値：頂点データリスト）
-        self.vertices = {}
-        # 面データ
-        self.indices = []
+        # 頂点データ
+        self.vertex_store = VertexStore()
+        # 面データ（三角形ごとの頂点INDEX (N, 3)）
+        self.indices = np.zeros((0, 3), dtype=np.int32)
         # テクスチャデータ
         self.textures = []
         # 材質データ
@@ -942,6 +1398,70 @@ class PmxModel:
         # 左右ひじ手首中間頂点
         self.elbow_middle_entity_vertex = {}
     
+    # 頂点データ（キー：ボーンINDEX、値：頂点データリスト）
+    @property
+    def vertices(self):
+        return VertexBoneView(self.vertex_store)
+
+    # ボーンの一括挿入
+    # insert_bones: (挿入先のボーンINDEX, ボーン)のリスト（挿入先のボーンの前に入る。ボーン数を指定した場合は末尾）
+    # ボーンが参照するINDEXは、既存ボーンは挿入前のINDEX、挿入ボーンは「既存ボーン数＋リスト内の位置」で指定する
+    # 戻り値は挿入前のINDEX（挿入ボーン含む）から挿入後のINDEXへの変換配列
+    def insert_bones(self, insert_bones: list):
+        bones = [self.bones[self.bone_indexes[bone_idx]] for bone_idx in range(len(self.bone_indexes))]
+        bone_count = len(bones)
+
+        # 挿入先順に並べる（同じ挿入先はリスト順）
+        insert_slots = np.array([slot for (slot, _) in insert_bones], dtype=np.int32)
+        insert_order = np.argsort(insert_slots, kind="stable")
+        sorted_slots = insert_slots[insert_order]
+
+        # 既存ボーンは、自分より前に挿入されるボーンの数だけずれる
+        bone_remap = np.zeros(bone_count + len(insert_bones), dtype=np.int32)
+        bone_remap[:bone_count] = np.arange(bone_count) + np.searchsorted(sorted_slots, np.arange(bone_count), side="right")
+        bone_remap[bone_count + insert_order] = sorted_slots + np.arange(len(insert_bones))
+
+        for (_, bone) in insert_bones:
+            if bone.name in self.bones:
+                raise SizingException("同じ名前のボーンが既にあります。bone: {0}".format(bone.name))
+            bones.append(bone)
+
+        def remap_index(bone_idx):
+            return int(bone_remap[bone_idx]) if bone_idx >= 0 else bone_idx
+
+        for bone_idx, bone in enumerate(bones):
+            bone.index = int(bone_remap[bone_idx])
+            bone.parent_index = remap_index(bone.parent_index)
+            bone.tail_index = remap_index(bone.tail_index)
+            bone.effect_index = remap_index(bone.effect_index)
+
+            if bone.ik:
+                bone.ik.target_index = remap_index(bone.ik.target_index)
+                for link in bone.ik.link:
+                    link.bone_index = remap_index(link.bone_index)
+
+        self.bones = {bone.name: bone for bone in sorted(bones, key=lambda b: b.index)}
+        self.bone_indexes = {bone.index: bone.name for bone in self.bones.values()}
+
+        # ボーンを参照しているデータも同じ変換配列で振り直す
+        if len(self.vertex_store) > 0:
+            self.vertex_store.bone_indexes = bone_remap[self.vertex_store.bone_indexes]
+            self.vertex_store.bone_vertex_table = None
+            self.vertex_store.vertex_cache = {}
+
+        for morph in self.morphs.values():
+            if morph.morph_type == 2:
+                for offset in morph.offsets:
+                    offset.bone_index = remap_index(offset.bone_index)
+
+        for display_slot in self.display_slots.values():
+            display_slot.references = [(display_type, remap_index(idx) if display_type == 0 else idx) for (display_type, idx) in display_slot.references]
+
+        for rigidbody in self.rigidbodies.values():
+            rigidbody.bone_index = remap_index(rigidbody.bone_index)
+
+        return bone_remap
+
     # ローカルX軸の取得
     def get_local_x_axis(self, bone_name: str):
         if bone_name not in self.bones:
@@ -2,8 +2,9 @@
 #
 import struct
 import hashlib
+import numpy as np
 
-from mmd.PmxData import PmxModel, Bone, RigidBody, Vertex, Material, Morph, DisplaySlot, RigidBody, Joint, Ik, IkLink, Bdef1, Bdef2, Bdef4, Sdef, Qdef # noqa
+from mmd.PmxData import PmxModel, VertexStore, Bone, RigidBody, Vertex, Material, Morph, DisplaySlot, RigidBody, Joint, Ik, IkLink, Bdef1, Bdef2, Bdef4, Sdef, Qdef # noqa
 from module.MMath import MRect, MVector3D, MVector4D, MQuaternion, MMatrix4x4 # noqa
 from utils.MLogger import MLogger # noqa
 from utils.MException import SizingException, MKilledException, MParseException
@@ -12,6 +13,9 @@ logger = MLogger(__name__, level=1)
 
 
 class PmxReader:
+    # モデル名取得時に最初に読み込むサイズ（ヘッダ + 一般的な長さのモデル名）
+    MODEL_NAME_READ_SIZE = 512
+
     def __init__(self, file_path, is_check=True):
         self.file_path = file_path
         self.is_check = is_check
@@ -23,73 +27,57 @@ class PmxReader:
         self.bone_index_size = 0
         self.morph_index_size = 0
         self.rigidbody_index_size = 0
+        # ハッシュ値（一度だけ計算する）
+        self.digest = None
 
+    # モデル名のみ取得（ファイル全体は読まず、ヘッダとモデル名の範囲のみ読み込む）
     def read_model_name(self):
         model_name = ""
         with open(self.file_path, "rb") as f:
-            # PMXファイルをバイナリ読み込み
-            self.buffer = f.read()
-            # logger.test("hashlib.algorithms_available: %s", hashlib.algorithms_available)
-
-            # pmx宣言
-            signature = self.unpack(4, "4s")
-            logger.test("signature: %s (%s)", signature, self.offset)
-
-            # pmxバージョン
-            version = self.read_float()
-            logger.test("version: %s (%s)", version, self.offset)
-
-            if signature[:3] != b"PMX" or (version != 2.0 and version != 2.1):
-                # 整合性チェック
-                raise MParseException("PMX2.0/2.1形式外のデータです。signature: {0}, version: {1} ".format(signature, version))
-
-            # flag
-            flag_bytes = self.read_int(1)
-            logger.test("flag_bytes: %s (%s)", flag_bytes, self.offset)
-
-            # エンコード方式
-            text_encoding = self.read_int(1)
-            logger.test("text_encoding: %s (%s)", text_encoding, self.offset)
-            # エンコードに基づいて文字列解凍処理を定義
-            self.read_text = self.define_read_text(text_encoding)
-
-            # 追加UV数
-            self.extended_uv = self.read_int(1)
-            logger.test("extended_uv: %s (%s)", self.extended_uv, self.offset)
-
-            # 頂点Indexサイズ
-            self.vertex_index_size = self.read_int(1)
-            logger.test("vertex_index_size: %s (%s)", self.vertex_index_size, self.offset)
-            self.read_vertex_index_size = lambda: self.read_int(self.vertex_index_size)
-
-            # テクスチャIndexサイズ
-            self.texture_index_size = self.read_int(1)
-            logger.test("texture_index_size: %s (%s)", self.texture_index_size, self.offset)
-            self.read_texture_index_size = lambda: self.read_int(self.texture_index_size)
-
-            # 材質Indexサイズ
-            self.material_index_size = self.read_int(1)
-            logger.test("material_index_size: %s (%s)", self.material_index_size, self.offset)
-            self.read_material_index_size = lambda: self.read_int(self.material_index_size)
-
-            # ボーンIndexサイズ
-            self.bone_index_size = self.read_int(1)
-            logger.test("bone_index_size: %s (%s)", self.bone_index_size, self.offset)
-            self.read_bone_index_size = lambda: self.read_int(self.bone_index_size)
-
-            # モーフIndexサイズ
-            self.morph_index_size = self.read_int(1)
-            logger.test("morph_index_size: %s (%s)", self.morph_index_size, self.offset)
-            self.read_morph_index_size = lambda: self.read_int(self.morph_index_size)
-
-            # 剛体Indexサイズ
-            self.rigidbody_index_size = self.read_int(1)
-            logger.test("rigidbody_index_size: %s (%s)", self.rigidbody_index_size, self.offset)
-            self.read_rigidbody_index_size = lambda: self.read_int(self.rigidbody_index_size)
-
-            # モデル名（日本語）
-            model_name = self.read_text()
-            logger.test("name: %s (%s)", model_name, self.offset)
+            # ヘッダ部分のみ読み込み
+            self.buffer = f.read(self.MODEL_NAME_READ_SIZE)
+            self.offset = 0
+
+            try:
+                # pmx宣言
+                signature = self.unpack(4, "4s")
+                logger.test("signature: %s (%s)", signature, self.offset)
+
+                # pmxバージョン
+                version = self.read_float()
+                logger.test("version: %s (%s)", version, self.offset)
+
+                if signature[:3] != b"PMX" or (version != 2.0 and version != 2.1):
+                    # 整合性チェック
+                    raise MParseException("PMX2.0/2.1形式外のデータです。signature: {0}, version: {1} ".format(signature, version))
+
+                # flag
+                flag_bytes = self.read_int(1)
+                logger.test("flag_bytes: %s (%s)", flag_bytes, self.offset)
+
+                # エンコード方式
+                text_encoding = self.read_int(1)
+                logger.test("text_encoding: %s (%s)", text_encoding, self.offset)
+                # エンコードに基づいて文字列解凍処理を定義
+                self.read_text = self.define_read_text(text_encoding)
+
+                # 追加UV数・各Indexサイズは読み飛ばす
+                self.offset += 7
+
+                # モデル名（日本語）が読み込み範囲を超えている場合、足りない分だけ追加で読み込む
+                name_size = self.read_int(4)
+                if name_size < 0:
+                    raise MParseException("モデル名の長さが不正です。name_size: {0}".format(name_size))
+                if self.offset + name_size > len(self.buffer):
+                    self.buffer += f.read(self.offset + name_size - len(self.buffer))
+                self.offset -= 4
+
+                model_name = self.read_text()
+                logger.test("name: %s (%s)", model_name, self.offset)
+            finally:
+                # 途中までのバッファは解析・ハッシュに使わない
+                self.buffer = None
+                self.offset = 0
 
         return model_name
 
@@ -101,7 +89,9 @@ class PmxReader:
         try:
             # PMXファイルをバイナリ読み込み
             with open(self.file_path, "rb") as f:
-                self.buffer = f.read()
+                # ハッシュ取得時に読み込み済みの場合、そのまま使う
+                if self.buffer is None:
+                    self.buffer = f.read()
                 # logger.test("hashlib.algorithms_available: %s", hashlib.algorithms_available)
 
                 # pmx宣言
@@ -176,39 +166,14 @@ class PmxReader:
                 pmx.english_comment = self.read_text()
                 logger.test("english_comment: %s (%s)", pmx.english_comment, self.offset)
 
-                # 頂点データリスト
-                for vertex_idx in range(self.read_int(4)):
-                    position = self.read_Vector3D()
-                    normal = self.read_Vector3D()
-                    uv = self.read_Vector2D()
-
-                    extended_uvs = []
-                    if self.extended_uv > 0:
-                        # 追加UVがある場合
-                        for _ in range(self.extended_uv):
-                            extended_uvs.append(self.read_Vector4D())
-
-                    deform = self.read_deform()
-                    edge_factor = self.read_float()
-
-                    # 頂点をウェイトボーンごとに分けて保持する
-                    vertex = Vertex(vertex_idx, position, normal, uv, extended_uvs, deform, edge_factor)
-                    for bone_idx in vertex.deform.get_idx_list():
-                        if bone_idx not in pmx.vertices:
-                            pmx.vertices[bone_idx] = []
-                        pmx.vertices[bone_idx].append(vertex)
-
-                logger.test("len(vertices): %s", len(pmx.vertices))
-                logger.test("vertices.keys: %s", pmx.vertices.keys())
+                # 頂点データリスト（列ごとの配列に一括で解凍）
+                pmx.vertex_store = VertexStore(**self.read_vertices())
+
+                logger.test("len(vertices): %s", len(pmx.vertex_store))
                 logger.info("-- PMX 頂点読み込み完了")
 
                 # 面データリスト
-                for _ in range(self.read_int(4)):
-                    if self.vertex_index_size <= 2:
-                        # 頂点サイズが2以下の場合、符号なし
-                        pmx.indices.append(self.read_uint(self.vertex_index_size))
-                    else:
-                        pmx.indices.append(self.read_int(self.vertex_index_size))
+                pmx.indices = self.read_indices()
                 logger.test("len(indices): %s", len(pmx.indices))
                 
                 logger.info("-- PMX 面読み込み完了")
@@ -775,18 +740,21 @@ class PmxReader:
             raise e
 
     def hexdigest(self):
-        sha1 = hashlib.sha1()
+        if self.digest is None:
+            # 解析と同じバッファを使い、ファイルを読み直さない
+            if self.buffer is None:
+                with open(self.file_path, "rb") as f:
+                    self.buffer = f.read()
 
-        with open(self.file_path, 'rb') as f:
-            for chunk in iter(lambda: f.read(2048 * sha1.block_size), b''):
-                sha1.update(chunk)
+            blake2 = hashlib.blake2b(digest_size=32)
+            blake2.update(self.buffer)
 
-        sha1.update(chunk)
+            # ファイルパスをハッシュに含める
+            blake2.update(self.file_path.encode('utf-8'))
 
-        # ファイルパスをハッシュに含める
-        sha1.update(self.file_path.encode('utf-8'))
+            self.digest = blake2.hexdigest()
 
-        return sha1.hexdigest()
+        return self.digest
 
     def calc_bone_length(self, bones, bone_indexes):
         for k, v in bones.items():
@@ -902,6 +870,103 @@ class PmxReader:
         scalar = self.read_float()
         return MQuaternion(scalar, x, y, z)
 
+    # 面データリストの解凍（三角形ごとの頂点INDEX (N, 3)）
+    def read_indices(self):
+        index_count = self.read_int(4)
+
+        if self.vertex_index_size <= 2:
+            # 頂点サイズが2以下の場合、符号なし
+            dtype = np.dtype({1: "u1", 2: "<u2"}[self.vertex_index_size])
+        elif self.vertex_index_size == 4:
+            dtype = np.dtype("<i4")
+        else:
+            raise MParseException("read_indices vertex_index_sizeエラー {0}".format(self.vertex_index_size))
+
+        if index_count % 3 != 0:
+            raise MParseException("面の頂点INDEX数が3の倍数ではありません。count: {0}".format(index_count))
+
+        # 読み込みバッファを保持しないよう、int32に変換した配列として持つ
+        indices = np.frombuffer(self.buffer, dtype=dtype, count=index_count, offset=self.offset).astype(np.int32).reshape(-1, 3)
+
+        self.offset += index_count * self.vertex_index_size
+
+        return indices
+
+    # 頂点データリストの解凍
+    # 変形方式のバイトだけを順に辿ってレコード位置を求め、各項目はまとめて配列で取り出す
+    def read_vertices(self):
+        vertex_count = self.read_int(4)
+
+        # 位置・法線・UV・追加UVのバイトサイズ
+        base_size = 4 * (3 + 3 + 2) + 16 * self.extended_uv
+        # 変形方式ごとの変形データのバイトサイズ
+        deform_sizes = {0: self.bone_index_size, 1: self.bone_index_size * 2 + 4, 2: self.bone_index_size * 4 + 16,
+                        3: self.bone_index_size * 2 + 4 + 36, 4: self.bone_index_size * 2 + 4 + 36}
+
+        record_offsets = [0] * vertex_count
+        deform_types = [0] * vertex_count
+        offset = self.offset
+        buffer = self.buffer
+        for vertex_idx in range(vertex_count):
+            record_offsets[vertex_idx] = offset
+            deform_type = buffer[offset + base_size]
+            if deform_type not in deform_sizes:
+                raise MParseException("unknown deform_type: {0}".format(deform_type))
+            deform_types[vertex_idx] = deform_type
+            offset += base_size + 1 + deform_sizes[deform_type] + 4
+
+        # 頂点データの終端まで進める
+        self.offset = offset
+
+        data = np.frombuffer(self.buffer, dtype=np.uint8)
+        record_offsets = np.array(record_offsets, dtype=np.int64)
+        deform_types = np.array(deform_types, dtype=np.uint8)
+        bone_index_dtype = np.dtype({1: "i1", 2: "<i2", 4: "<i4"}[self.bone_index_size])
+
+        positions = self.gather_values(data, record_offsets, "<f4", 3)
+        normals = self.gather_values(data, record_offsets + 12, "<f4", 3)
+        uvs = self.gather_values(data, record_offsets + 24, "<f4", 2)
+        extended_uvs = self.gather_values(data, record_offsets + 32, "<f4", 4 * self.extended_uv).reshape(vertex_count, self.extended_uv, 4)
+        # エッジ倍率は各レコードの末尾
+        edge_factors = self.gather_values(data, np.append(record_offsets[1:], offset)[:vertex_count] - 4, "<f4", 1)[:, 0]
+
+        bone_indexes = np.zeros((vertex_count, 4), dtype=np.int32)
+        weights = np.zeros((vertex_count, 4), dtype=np.float32)
+        sdefs = np.zeros((vertex_count, 3, 3), dtype=np.float32)
+
+        # 変形データの開始位置
+        deform_offsets = record_offsets + base_size + 1
+
+        for deform_type, index_count, weight_count in [(0, 1, 0), (1, 2, 1), (2, 4, 4), (3, 2, 1), (4, 2, 1)]:
+            target_idxs = np.flatnonzero(deform_types == deform_type)
+            if len(target_idxs) == 0:
+                continue
+
+            target_offsets = deform_offsets[target_idxs]
+            bone_indexes[target_idxs, :index_count] = self.gather_values(data, target_offsets, bone_index_dtype, index_count)
+
+            weight_offsets = target_offsets + self.bone_index_size * index_count
+            if deform_type == 0:
+                weights[target_idxs, 0] = 1
+            elif weight_count == 1:
+                weight0 = self.gather_values(data, weight_offsets, "<f4", 1)[:, 0]
+                weights[target_idxs, 0] = weight0
+                weights[target_idxs, 1] = 1 - weight0
+            else:
+                weights[target_idxs] = self.gather_values(data, weight_offsets, "<f4", 4)
+
+            if deform_type in [3, 4]:
+                sdefs[target_idxs] = self.gather_values(data, weight_offsets + 4, "<f4", 9).reshape(len(target_idxs), 3, 3)
+
+        return {"positions": positions, "normals": normals, "uvs": uvs, "extended_uvs": extended_uvs, "deform_types": deform_types,
+                "bone_indexes": bone_indexes, "weights": weights, "sdefs": sdefs, "edge_factors": edge_factors}
+
+    # 各レコード位置から同じ型の値を一括で取り出す
+    def gather_values(self, data, offsets, dtype, count):
+        dtype = np.dtype(dtype)
+        byte_positions = offsets[:, np.newaxis] + np.arange(dtype.itemsize * count)
+        return data[byte_positions].view(dtype).reshape(len(offsets), count)
+
     def read_deform(self):
         deform_type = self.read_int(1)
 
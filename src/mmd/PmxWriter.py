@@ -0,0 +1,455 @@
+# -*- coding: utf-8 -*-
+#
+import os
+import struct
+import tempfile
+import numpy as np
+
+from mmd.PmxData import PmxModel, Bone, RigidBody, Vertex, Material, Morph, DisplaySlot, RigidBody, Joint, Ik, IkLink, Bdef1, Bdef2, Bdef4, Sdef, Qdef # noqa
+from module.MMath import MRect, MVector3D, MVector4D, MQuaternion, MMatrix4x4 # noqa
+from utils.MLogger import MLogger # noqa
+from utils.MException import SizingException, MKilledException, MParseException
+
+logger = MLogger(__name__, level=1)
+
+
+class PmxWriter:
+    # 変形方式
+    DEFORM_BDEF1 = 0
+    DEFORM_BDEF2 = 1
+    DEFORM_BDEF4 = 2
+    DEFORM_SDEF = 3
+    DEFORM_QDEF = 4
+
+    # 変形方式ごとのボーンINDEX数とウェイト数
+    DEFORM_SIZES = {DEFORM_BDEF1: (1, 0), DEFORM_BDEF2: (2, 1), DEFORM_BDEF4: (4, 4), DEFORM_SDEF: (2, 1), DEFORM_QDEF: (2, 1)}
+
+    # 頂点以外のINDEXの書式（符号あり）
+    INDEX_FORMATS = {1: "<b", 2: "<h", 4: "<i"}
+
+    # 出力バッファサイズ
+    BUFFER_SIZE = 1024 * 1024
+    # 一度に書き出す頂点数・面INDEX数
+    VERTEX_CHUNK_SIZE = 65536
+    INDEX_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self):
+        self.vertex_index_size = 0
+        self.texture_index_size = 0
+        self.material_index_size = 0
+        self.bone_index_size = 0
+        self.morph_index_size = 0
+        self.rigidbody_index_size = 0
+
+    def write(self, pmx: PmxModel, output_path: str):
+        # 頂点データ（列ごとの配列）
+        vertex_columns = pmx.vertex_store.get_columns()
+        # 面データ
+        indices = np.asarray(pmx.indices).reshape(-1)
+
+        materials = list(pmx.materials.values())
+        bones = sorted([b for b in pmx.bones.values() if b.index >= 0], key=lambda b: b.index)
+        morphs = sorted(pmx.morphs.values(), key=lambda m: m.index)
+        rigidbodies = sorted(pmx.rigidbodies.values(), key=lambda r: r.index)
+
+        # INDEXサイズは要素数から決定
+        self.vertex_index_size = self.get_vertex_index_size(len(vertex_columns["positions"]))
+        self.texture_index_size = self.get_index_size(len(pmx.textures))
+        self.material_index_size = self.get_index_size(len(materials))
+        self.bone_index_size = self.get_index_size(len(bones))
+        self.morph_index_size = self.get_index_size(len(morphs))
+        self.rigidbody_index_size = self.get_index_size(len(rigidbodies))
+
+        # 同じディレクトリの一時ファイルに出力し、最後まで書けた場合のみ置き換える
+        output_dir_path = os.path.dirname(os.path.abspath(output_path))
+        fd, tmp_path = tempfile.mkstemp(prefix="{0}.".format(os.path.basename(output_path)), suffix=".tmp", dir=output_dir_path)
+
+        try:
+            with os.fdopen(fd, "wb", buffering=self.BUFFER_SIZE) as fout:
+                self.write_data(fout, pmx, vertex_columns, indices, materials, bones, morphs, rigidbodies)
+
+            # 一時ファイルは所有者のみ読み書き可で作られるので、通常のファイルと同じ権限にしてから置き換える
+            os.chmod(tmp_path, self.get_file_mode(output_path))
+            os.replace(tmp_path, output_path)
+        except Exception as e:
+            # 中断・失敗時は一時ファイルを残さない
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise e
+
+    # 出力ファイルの権限（既存ファイルがある場合はその権限、ない場合はumaskに従う）
+    def get_file_mode(self, output_path: str):
+        try:
+            return os.stat(output_path).st_mode & 0o777
+        except OSError:
+            umask = os.umask(0)
+            os.umask(umask)
+            return 0o666 & ~umask
+
+    # セクションごとに順次出力
+    def write_data(self, fout, pmx: PmxModel, vertex_columns: dict, indices, materials: list, bones: list, morphs: list, rigidbodies: list):
+        # pmx宣言
+        fout.write(b"PMX ")
+        # pmxバージョン
+        fout.write(struct.pack("<f", 2.0))
+        # 後続するデータ列のバイトサイズ
+        fout.write(struct.pack("<b", 8))
+        # エンコード方式（UTF16LE）
+        fout.write(struct.pack("<b", 0))
+        # 追加UV数
+        fout.write(struct.pack("<b", vertex_columns["extended_uvs"].shape[1]))
+        # 各INDEXサイズ
+        fout.write(struct.pack("<6b", self.vertex_index_size, self.texture_index_size, self.material_index_size,
+                               self.bone_index_size, self.morph_index_size, self.rigidbody_index_size))
+
+        # モデル名・コメント
+        self.write_text(fout, pmx.name)
+        self.write_text(fout, pmx.english_name)
+        self.write_text(fout, pmx.comment)
+        self.write_text(fout, pmx.english_comment)
+
+        # 頂点データリスト
+        self.write_vertices(fout, **vertex_columns)
+        logger.info("-- PMX 頂点出力完了")
+
+        # 面データリスト
+        fout.write(struct.pack("<i", len(indices)))
+        for start in range(0, len(indices), self.INDEX_CHUNK_SIZE):
+            fout.write(indices[start:(start + self.INDEX_CHUNK_SIZE)].astype(self.get_vertex_index_dtype()).tobytes())
+        logger.info("-- PMX 面出力完了")
+
+        # テクスチャデータリスト
+        self.write_section(fout, pmx.textures, self.write_text)
+        logger.info("-- PMX テクスチャ出力完了")
+
+        # 材質データリスト
+        self.write_section(fout, materials, self.write_material)
+        logger.info("-- PMX 材質出力完了")
+
+        # ボーンデータリスト
+        self.write_section(fout, bones, self.write_bone)
+        logger.info("-- PMX ボーン出力完了")
+
+        # モーフデータリスト
+        self.write_section(fout, morphs, self.write_morph)
+        logger.info("-- PMX モーフ出力完了")
+
+        # 表示枠データリスト
+        self.write_section(fout, pmx.display_slots.values(), self.write_display_slot)
+        logger.info("-- PMX 表示枠出力完了")
+
+        # 剛体データリスト
+        self.write_rigidbodies(fout, rigidbodies)
+        logger.info("-- PMX 剛体出力完了")
+
+        # ジョイントデータリスト
+        self.write_joints(fout, list(pmx.joints.values()))
+        logger.info("-- PMX ジョイント出力完了")
+
+    # 件数を仮置きしてレコードを順次出力し、最後に件数を書き戻す
+    def write_section(self, fout, records, write_record):
+        count_pos = fout.tell()
+        fout.write(struct.pack("<i", 0))
+
+        count = 0
+        for record in records:
+            write_record(fout, record)
+            count += 1
+
+        end_pos = fout.tell()
+        fout.seek(count_pos)
+        fout.write(struct.pack("<i", count))
+        fout.seek(end_pos)
+
+        return count
+
+    # 頂点の構造化型（変形方式ごと）
+    def get_vertex_dtype(self, deform_type: int, extended_uv_count: int):
+        index_count, weight_count = self.DEFORM_SIZES[deform_type]
+
+        fields = [("position", "<f4", 3), ("normal", "<f4", 3), ("uv", "<f4", 2)]
+        if extended_uv_count > 0:
+            fields.append(("extended_uv", "<f4", (extended_uv_count, 4)))
+        fields.append(("deform_type", "u1"))
+        fields.append(("bone_index", self.get_index_dtype(self.bone_index_size), index_count))
+        if weight_count > 0:
+            fields.append(("weight", "<f4", weight_count))
+        if deform_type in [self.DEFORM_SDEF, self.DEFORM_QDEF]:
+            fields.append(("sdef", "<f4", (3, 3)))
+        fields.append(("edge_factor", "<f4"))
+
+        return np.dtype(fields)
+
+    # 頂点データリスト出力
+    def write_vertices(self, fout, positions, normals, uvs, extended_uvs, deform_types, bone_indexes, weights, sdefs, edge_factors):
+        vertex_count = len(positions)
+        dtypes = {deform_type: self.get_vertex_dtype(deform_type, extended_uvs.shape[1]) for deform_type in self.DEFORM_SIZES.keys()}
+
+        fout.write(struct.pack("<i", vertex_count))
+
+        # 一定数ごとにバイト列を生成して書き出す
+        for start in range(0, vertex_count, self.VERTEX_CHUNK_SIZE):
+            end = min(start + self.VERTEX_CHUNK_SIZE, vertex_count)
+            fout.write(self.pack_vertices(dtypes, positions[start:end], normals[start:end], uvs[start:end], extended_uvs[start:end], deform_types[start:end],
+                                          bone_indexes[start:end], weights[start:end], sdefs[start:end], edge_factors[start:end]))
+
+    # 頂点のバイト列生成
+    # 変形方式ごとに構造化配列を作り、可変長のレコード位置に一括で配置する
+    def pack_vertices(self, dtypes, positions, normals, uvs, extended_uvs, deform_types, bone_indexes, weights, sdefs, edge_factors):
+        vertex_count = len(positions)
+        extended_uv_count = extended_uvs.shape[1]
+
+        # レコードごとのバイトサイズと開始位置
+        record_sizes = np.zeros(vertex_count, dtype=np.int64)
+        for deform_type, dtype in dtypes.items():
+            record_sizes[deform_types == deform_type] = dtype.itemsize
+        record_offsets = np.concatenate([[0], np.cumsum(record_sizes)[:-1]]).astype(np.int64)
+
+        vertex_bytes = np.zeros(int(record_sizes.sum()), dtype=np.uint8)
+
+        for deform_type, dtype in dtypes.items():
+            target_idxs = np.flatnonzero(deform_types == deform_type)
+            if len(target_idxs) == 0:
+                continue
+
+            index_count, weight_count = self.DEFORM_SIZES[deform_type]
+
+            records = np.zeros(len(target_idxs), dtype=dtype)
+            records["position"] = positions[target_idxs]
+            records["normal"] = normals[target_idxs]
+            records["uv"] = uvs[target_idxs]
+            if extended_uv_count > 0:
+                records["extended_uv"] = extended_uvs[target_idxs]
+            records["deform_type"] = deform_type
+            records["bone_index"] = bone_indexes[target_idxs, :index_count].reshape(len(target_idxs), index_count)
+            if weight_count > 0:
+                records["weight"] = weights[target_idxs, :weight_count].reshape(len(target_idxs), weight_count)
+            if deform_type in [self.DEFORM_SDEF, self.DEFORM_QDEF]:
+                records["sdef"] = sdefs[target_idxs]
+            records["edge_factor"] = edge_factors[target_idxs]
+
+            # 各レコードのバイト列を、頂点順の位置に配置
+            byte_positions = record_offsets[target_idxs][:, np.newaxis] + np.arange(dtype.itemsize)
+            vertex_bytes[byte_positions] = records.view(np.uint8).reshape(len(target_idxs), dtype.itemsize)
+
+        return vertex_bytes.tobytes()
+
+    def write_material(self, fout, material: Material):
+        self.write_text(fout, material.name)
+        self.write_text(fout, material.english_name)
+        fout.write(struct.pack("<4f", material.diffuse_color.x(), material.diffuse_color.y(), material.diffuse_color.z(), material.alpha))
+        fout.write(struct.pack("<4f", material.specular_color.x(), material.specular_color.y(), material.specular_color.z(), material.specular_factor))
+        fout.write(struct.pack("<3f", material.ambient_color.x(), material.ambient_color.y(), material.ambient_color.z()))
+        fout.write(struct.pack("<B", material.flag & 0xFF))
+        fout.write(struct.pack("<4f", material.edge_color.x(), material.edge_color.y(), material.edge_color.z(), material.edge_color.w()))
+        fout.write(struct.pack("<f", material.edge_size))
+        self.write_index(fout, self.texture_index_size, material.texture_index)
+        self.write_index(fout, self.texture_index_size, material.sphere_texture_index)
+        fout.write(struct.pack("<2b", material.sphere_mode, material.toon_sharing_flag))
+
+        if material.toon_sharing_flag == 0:
+            self.write_index(fout, self.texture_index_size, material.toon_texture_index)
+        elif material.toon_sharing_flag == 1:
+            fout.write(struct.pack("<b", material.toon_texture_index))
+        else:
+            raise SizingException("unknown toon_sharing_flag {0}".format(material.toon_sharing_flag))
+
+        self.write_text(fout, material.comment)
+        fout.write(struct.pack("<i", material.vertex_count))
+
+    def write_bone(self, fout, bone: Bone):
+        self.write_text(fout, bone.name)
+        self.write_text(fout, bone.english_name)
+        self.write_Vector3D(fout, bone.position)
+        self.write_index(fout, self.bone_index_size, bone.parent_index)
+        fout.write(struct.pack("<i", bone.layer))
+        fout.write(struct.pack("<H", bone.flag & 0xFFFF))
+
+        if not bone.getConnectionFlag():
+            self.write_Vector3D(fout, bone.tail_position)
+        else:
+            self.write_index(fout, self.bone_index_size, bone.tail_index)
+
+        if bone.getExternalRotationFlag() or bone.getExternalTranslationFlag():
+            self.write_index(fout, self.bone_index_size, bone.effect_index)
+            fout.write(struct.pack("<f", bone.effect_factor))
+
+        if bone.getFixedAxisFlag():
+            self.write_Vector3D(fout, bone.fixed_axis)
+
+        if bone.getLocalCoordinateFlag():
+            self.write_Vector3D(fout, bone.local_x_vector)
+            self.write_Vector3D(fout, bone.local_z_vector)
+
+        if bone.getExternalParentDeformFlag():
+            fout.write(struct.pack("<i", bone.external_key))
+
+        if bone.getIkFlag():
+            self.write_index(fout, self.bone_index_size, bone.ik.target_index)
+            fout.write(struct.pack("<if", bone.ik.loop, bone.ik.limit_radian))
+            fout.write(struct.pack("<i", len(bone.ik.link)))
+
+            for link in bone.ik.link:
+                self.write_index(fout, self.bone_index_size, link.bone_index)
+                fout.write(struct.pack("<b", link.limit_angle))
+
+                if link.limit_angle == 1:
+                    self.write_Vector3D(fout, link.limit_min)
+                    self.write_Vector3D(fout, link.limit_max)
+
+    def write_morph(self, fout, morph: Morph):
+        self.write_text(fout, morph.name)
+        self.write_text(fout, morph.english_name)
+        fout.write(struct.pack("<2b", morph.panel, morph.morph_type))
+        fout.write(struct.pack("<i", len(morph.offsets)))
+
+        if morph.morph_type == 0:
+            # group
+            records = np.zeros(len(morph.offsets), dtype=[("morph_index", self.get_index_dtype(self.morph_index_size)), ("value", "<f4")])
+            records["morph_index"] = [o.morph_index for o in morph.offsets]
+            records["value"] = [o.value for o in morph.offsets]
+            fout.write(records.tobytes())
+        elif morph.morph_type == 1:
+            # vertex
+            records = np.zeros(len(morph.offsets), dtype=[("vertex_index", self.get_vertex_index_dtype()), ("position_offset", "<f4", 3)])
+            if isinstance(morph.offsets, Morph.VertexMorphOffsets):
+                # 配列で保持している場合はそのまま
+                records["vertex_index"] = morph.offsets.vertex_indexes
+                records["position_offset"] = morph.offsets.position_offsets
+            else:
+                records["vertex_index"] = [o.vertex_index for o in morph.offsets]
+                records["position_offset"] = [(o.position_offset.x(), o.position_offset.y(), o.position_offset.z()) for o in morph.offsets]
+            fout.write(records.tobytes())
+        elif morph.morph_type == 2:
+            # bone
+            records = np.zeros(len(morph.offsets), dtype=[("bone_index", self.get_index_dtype(self.bone_index_size)), ("position", "<f4", 3), ("rotation", "<f4", 4)])
+            records["bone_index"] = [o.bone_index for o in morph.offsets]
+            records["position"] = [(o.position.x(), o.position.y(), o.position.z()) for o in morph.offsets]
+            records["rotation"] = [(o.rotation.x(), o.rotation.y(), o.rotation.z(), o.rotation.scalar()) for o in morph.offsets]
+            fout.write(records.tobytes())
+        elif 3 <= morph.morph_type <= 7:
+            # uv, uv extended1～4
+            records = np.zeros(len(morph.offsets), dtype=[("vertex_index", self.get_vertex_index_dtype()), ("uv", "<f4", 4)])
+            records["vertex_index"] = [o.vertex_index for o in morph.offsets]
+            records["uv"] = [(o.uv.x(), o.uv.y(), o.uv.z(), o.uv.w()) for o in morph.offsets]
+            fout.write(records.tobytes())
+        elif morph.morph_type == 8:
+            # material
+            for o in morph.offsets:
+                self.write_index(fout, self.material_index_size, o.material_index)
+                fout.write(struct.pack("<b", o.calc_mode))
+                self.write_Vector4D(fout, o.diffuse)
+                self.write_Vector3D(fout, o.specular)
+                fout.write(struct.pack("<f", o.specular_factor))
+                self.write_Vector3D(fout, o.ambient)
+                self.write_Vector4D(fout, o.edge_color)
+                fout.write(struct.pack("<f", o.edge_size))
+                self.write_Vector4D(fout, o.texture_factor)
+                self.write_Vector4D(fout, o.sphere_texture_factor)
+                self.write_Vector4D(fout, o.toon_texture_factor)
+        else:
+            raise SizingException("unknown morph type: {0}".format(morph.morph_type))
+
+    def write_display_slot(self, fout, display_slot: DisplaySlot):
+        self.write_text(fout, display_slot.name)
+        self.write_text(fout, display_slot.english_name)
+        fout.write(struct.pack("<b", display_slot.special_flag))
+        fout.write(struct.pack("<i", len(display_slot.references)))
+
+        for display_type, target_idx in display_slot.references:
+            fout.write(struct.pack("<b", display_type))
+            if display_type == 0:
+                self.write_index(fout, self.bone_index_size, target_idx)
+            elif display_type == 1:
+                self.write_index(fout, self.morph_index_size, target_idx)
+            else:
+                raise SizingException("unknown display_type: {0}".format(display_type))
+
+    # 剛体データリスト出力
+    # 名前以外は固定長なので、全剛体分の構造化配列を作り、名前と交互に出力する
+    def write_rigidbodies(self, fout, rigidbodies: list):
+        records = np.zeros(len(rigidbodies), dtype=[("bone_index", self.get_index_dtype(self.bone_index_size)), ("collision_group", "i1"),
+                                                    ("no_collision_group", "<u2"), ("shape_type", "i1"), ("shape_size", "<f4", 3),
+                                                    ("shape_position", "<f4", 3), ("shape_rotation", "<f4", 3), ("param", "<f4", 5), ("mode", "i1")])
+        if len(rigidbodies) > 0:
+            records["bone_index"] = [r.bone_index for r in rigidbodies]
+            records["collision_group"] = [r.collision_group for r in rigidbodies]
+            records["no_collision_group"] = [r.no_collision_group & 0xFFFF for r in rigidbodies]
+            records["shape_type"] = [r.shape_type for r in rigidbodies]
+            records["shape_size"] = [(r.shape_size.x(), r.shape_size.y(), r.shape_size.z()) for r in rigidbodies]
+            records["shape_position"] = [(r.shape_position.x(), r.shape_position.y(), r.shape_position.z()) for r in rigidbodies]
+            records["shape_rotation"] = [(r.shape_rotation.x(), r.shape_rotation.y(), r.shape_rotation.z()) for r in rigidbodies]
+            records["param"] = [(r.param.mass, r.param.linear_damping, r.param.angular_damping, r.param.restitution, r.param.friction) for r in rigidbodies]
+            records["mode"] = [r.mode for r in rigidbodies]
+
+        self.write_named_records(fout, rigidbodies, records)
+
+    # ジョイントデータリスト出力
+    # 名前以外は固定長なので、全ジョイント分の構造化配列を作り、名前と交互に出力する
+    def write_joints(self, fout, joints: list):
+        rigidbody_index_dtype = self.get_index_dtype(self.rigidbody_index_size)
+        records = np.zeros(len(joints), dtype=[("joint_type", "i1"), ("rigidbody_index_a", rigidbody_index_dtype), ("rigidbody_index_b", rigidbody_index_dtype),
+                                               ("vectors", "<f4", (8, 3))])
+        if len(joints) > 0:
+            records["joint_type"] = [j.joint_type for j in joints]
+            records["rigidbody_index_a"] = [j.rigidbody_index_a for j in joints]
+            records["rigidbody_index_b"] = [j.rigidbody_index_b for j in joints]
+            records["vectors"] = [[(v.x(), v.y(), v.z()) for v in [j.position, j.rotation, j.translation_limit_min, j.translation_limit_max, j.rotation_limit_min,
+                                                                    j.rotation_limit_max, j.spring_constant_translation, j.spring_constant_rotation]] for j in joints]
+
+        self.write_named_records(fout, joints, records)
+
+    # 件数・名前（日本語名, 英名）・固定長部分のレコードを順に出力
+    def write_named_records(self, fout, named_records: list, records):
+        fout.write(struct.pack("<i", len(named_records)))
+
+        record_bytes = records.tobytes()
+        record_size = records.dtype.itemsize
+        for n, named_record in enumerate(named_records):
+            self.write_text(fout, named_record.name)
+            self.write_text(fout, named_record.english_name)
+            fout.write(record_bytes[(n * record_size):((n + 1) * record_size)])
+
+    # 頂点INDEXサイズ（符号なし：1, 2 / 符号あり：4）
+    def get_vertex_index_size(self, count: int):
+        if count <= 256:
+            return 1
+        elif count <= 65536:
+            return 2
+        return 4
+
+    # 頂点以外のINDEXサイズ（符号あり、-1を含む）
+    def get_index_size(self, count: int):
+        if count <= 128:
+            return 1
+        elif count <= 32768:
+            return 2
+        return 4
+
+    def get_vertex_index_dtype(self):
+        if self.vertex_index_size == 1:
+            return np.dtype("u1")
+        elif self.vertex_index_size == 2:
+            return np.dtype("<u2")
+        return np.dtype("<i4")
+
+    def get_index_dtype(self, index_size: int):
+        if index_size == 1:
+            return np.dtype("i1")
+        elif index_size == 2:
+            return np.dtype("<i2")
+        return np.dtype("<i4")
+
+    def write_index(self, fout, index_size: int, value: int):
+        fout.write(struct.pack(self.INDEX_FORMATS[index_size], value))
+
+    def write_text(self, fout, text: str):
+        btext = text.encode("utf-16-le")
+        fout.write(struct.pack("<i", len(btext)))
+        fout.write(btext)
+
+    def write_Vector3D(self, fout, v: MVector3D):
+        fout.write(struct.pack("<3f", v.x(), v.y(), v.z()))
+
+    def write_Vector4D(self, fout, v: MVector4D):
+        fout.write(struct.pack("<4f", v.x(), v.y(), v.z(), v.w()))
@@ -1,17 +1,244 @@
 # -*- coding: utf-8 -*-
 #
+import numpy as np
 
-from module.MMath import MRect, MVector2D, MVector3D, MVector4D, MQuaternion, MMatrix4x4 # noqa
+from module.MMath import MRect, MVector2D, MVector3D, MVector4D, MQuaternion, MMatrix4x4, MQuaternionArray # noqa
 
-from utils.MException import SizingException # noqa
+from utils.MException import SizingException, MParseException # noqa
 from utils.MLogger import MLogger # noqa
 
 logger = MLogger(__name__, level=MLogger.DEBUG)
 
 
+# メッシュ構造-----------------------
+class VrmMesh:
+    def __init__(self, index, name, primitives=None, target_names=None):
+        self.index = index
+        self.name = name
+        self.primitives = primitives or []
+        # モーフターゲット名（extras.targetNames）
+        self.target_names = target_names or []
+
+    def __str__(self):
+        return "<VrmMesh index:{0}, name:{1}, primitives(len):{2}".format(self.index, self.name, len(self.primitives))
+
+
+# プリミティブ構造-----------------------
+class VrmPrimitive:
+    def __init__(self, index, attributes, indices, material_index, mode, targets=None, vertex_key=None):
+        self.index = index
+        # 頂点属性（キー：属性名(POSITION等)、値：(N, 成分数)の配列）
+        self.attributes = attributes
+        # 面の頂点INDEX
+        self.indices = indices
+        self.material_index = material_index
+        self.mode = mode
+        # モーフターゲット（キー：属性名、値：VrmMorphOffset）のリスト
+        self.targets = targets or []
+        # 頂点属性・モーフターゲットのaccessor INDEX（同じキーのプリミティブは頂点を共有している）
+        self.vertex_key = vertex_key if vertex_key is not None else index
+
+    def __str__(self):
+        return "<VrmPrimitive index:{0}, attributes:{1}, indices(len):{2}, material_index:{3}, mode:{4}, targets(len):{5}".format(
+               self.index, list(self.attributes.keys()), len(self.indices), self.material_index, self.mode, len(self.targets))
+
+
+# モーフ差分構造-----------------------
+# 差分のある頂点INDEXと差分値のみ保持する（PMXの頂点モーフと同じ疎な形）
+class VrmMorphOffset:
+    def __init__(self, vertex_count, indices, deltas):
+        # 対象となる頂点の総数
+        self.vertex_count = vertex_count
+        # 差分のある頂点INDEX
+        self.indices = indices
+        # 差分値（len(indices), 成分数）
+        self.deltas = deltas
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __str__(self):
+        return "<VrmMorphOffset vertex_count:{0}, offsets(len):{1}".format(self.vertex_count, len(self.indices))
+
+    # 全頂点分の差分配列（呼ばれた時だけ生成する）
+    def dense(self):
+        values = np.zeros((self.vertex_count,) + self.deltas.shape[1:], dtype=self.deltas.dtype)
+        values[self.indices] = self.deltas
+        return values
+
+
+# ノード構造-----------------------
+# glTFのノードを項目ごとの配列で保持し、初期姿勢は親の階層ごとにまとめて計算する
+class VrmNodeStore:
+    def __init__(self, names=None, parent_indexes=None, child_indexes=None, translations=None, rotations=None, scales=None, matrices=None, has_matrices=None,
+                 mesh_indexes=None, skin_indexes=None):
+        node_count = 0 if names is None else len(names)
+        # ノード名
+        self.names = names or []
+        # 親ノードINDEX (N)（親がない場合は-1）
+        self.parent_indexes = np.full(node_count, -1, dtype=np.int32) if parent_indexes is None else parent_indexes
+        # 子ノードINDEXリスト（glTFのchildrenの並び順）
+        self.child_indexes = child_indexes or [[] for _ in range(node_count)]
+        # 移動 (N, 3)
+        self.translations = np.zeros((node_count, 3), dtype=np.float64) if translations is None else translations
+        # 回転 (N, 4)（MQuaternionと同じw,x,y,z）
+        self.rotations = np.tile(np.array([1, 0, 0, 0], dtype=np.float64), (node_count, 1)) if rotations is None else rotations
+        # 縮尺 (N, 3)
+        self.scales = np.ones((node_count, 3), dtype=np.float64) if scales is None else scales
+        # 行列 (N, 4, 4)（matrix指定のあるノードのみ有効）
+        self.matrices = np.tile(np.eye(4, dtype=np.float64), (node_count, 1, 1)) if matrices is None else matrices
+        self.has_matrices = np.zeros(node_count, dtype=np.bool_) if has_matrices is None else has_matrices
+        # メッシュINDEX・スキンINDEX (N)（ない場合は-1）
+        self.mesh_indexes = np.full(node_count, -1, dtype=np.int32) if mesh_indexes is None else mesh_indexes
+        self.skin_indexes = np.full(node_count, -1, dtype=np.int32) if skin_indexes is None else skin_indexes
+
+    def __len__(self):
+        return len(self.names)
+
+    def __str__(self):
+        return "<VrmNodeStore nodes(len):{0}, matrices:{1}".format(len(self), np.count_nonzero(self.has_matrices))
+
+    # ノードごとのローカル行列 (N, 4, 4)（T * R * S、matrix指定があればそちらを使う）
+    def get_local_matrices(self):
+        local_matrices = MQuaternionArray(self.rotations).toMatrix4x4().data()
+        local_matrices[:, :3, :3] *= self.scales[:, np.newaxis, :]
+        local_matrices[:, :3, 3] = self.translations
+        local_matrices[self.has_matrices] = self.matrices[self.has_matrices]
+
+        return local_matrices
+
+    # ルートからの深さ (N)
+    def get_depths(self):
+        depths = np.zeros(len(self), dtype=np.int32)
+        ancestor_indexes = self.parent_indexes.copy()
+
+        # 全ノードの祖先を1階層ずつまとめて辿る
+        for _ in range(len(self)):
+            has_ancestors = ancestor_indexes >= 0
+            if not has_ancestors.any():
+                return depths
+
+            depths[has_ancestors] += 1
+            ancestor_indexes[has_ancestors] = self.parent_indexes[ancestor_indexes[has_ancestors]]
+
+        raise MParseException("ノードの親子関係が循環しています。")
+
+    # 親が子より先になるよう、深さ順（同じ深さはノード順）に並べたノードINDEX
+    def get_sorted_indexes(self, depths=None):
+        if depths is None:
+            depths = self.get_depths()
+
+        return np.lexsort((np.arange(len(self)), depths)).astype(np.int32)
+
+    # 最初の子ノードINDEX (N)（子がない場合は-1）
+    def get_first_child_indexes(self):
+        return np.array([children[0] if children else -1 for children in self.child_indexes], dtype=np.int32)
+
+    # ノードごとのグローバル行列 (N, 4, 4)（初期姿勢）
+    # 同じ深さのノードは親の行列が確定しているので、深さごとにまとめて掛ける
+    def get_global_matrices(self):
+        global_matrices = self.get_local_matrices()
+
+        depths = self.get_depths()
+        sorted_indexes = self.get_sorted_indexes(depths)
+        sorted_depths = depths[sorted_indexes]
+
+        # 深さごとの範囲（深さ0はローカル行列のまま）
+        depth_starts = np.searchsorted(sorted_depths, np.arange(1, sorted_depths[-1] + 2)) if len(self) > 0 else []
+        for start, end in zip(depth_starts[:-1], depth_starts[1:]):
+            node_indexes = sorted_indexes[start:end]
+            global_matrices[node_indexes] = global_matrices[self.parent_indexes[node_indexes]] @ global_matrices[node_indexes]
+
+        return global_matrices
+
+
+# 画像構造-----------------------
+# BINチャンク上の位置のみ保持し、デコードもコピーもしない
+class VrmImage:
+    def __init__(self, index, name, mime_type, buffer_view_index, offset, length):
+        self.index = index
+        self.name = name
+        self.mime_type = mime_type
+        self.buffer_view_index = buffer_view_index
+        # BINチャンク内の開始位置と長さ
+        self.offset = offset
+        self.length = length
+
+    def __str__(self):
+        return "<VrmImage index:{0}, name:{1}, mime_type:{2}, buffer_view_index:{3}, offset:{4}, length:{5}".format(
+               self.index, self.name, self.mime_type, self.buffer_view_index, self.offset, self.length)
+
+
 class VrmModel:
     def __init__(self):
         self.path = ''
-    
-    
+        self.name = ''
+        # glTF JSONデータ
+        self.json_data = {}
+        # BINチャンク（メモリマップ上のmemoryview）
+        self.buffer = None
+        # ファイル全体のメモリマップ（closeで閉じる）
+        self.mapped_buffer = None
+        # ノードデータ
+        self.node_store = VrmNodeStore()
+        # humanoidボーン（キー：VRM0.xのボーン名、値：ノードINDEX）
+        self.humanoid = {}
+        # VRM1.0形式か（VRM0.xとはモデルの正面の向きが異なる）
+        self.is_vrm1 = False
+        # ノード・メッシュを読み込んでいないか（変換キャッシュを使う場合）
+        self.is_partial = False
+        # メッシュデータ
+        self.meshes = []
+        # 画像データ
+        self.images = []
+        # ハッシュ値
+        self.digest = None
+
+    # メモリマップを閉じる（メッシュ・画像はBINチャンク上のビューなので、閉じた後は使えない）
+    def close(self):
+        self.meshes = []
+
+        try:
+            if self.buffer is not None:
+                self.buffer.release()
+                self.buffer = None
+
+            if self.mapped_buffer is not None:
+                self.mapped_buffer.close()
+                self.mapped_buffer = None
+        except BufferError:
+            # 参照が残っている場合、参照がなくなった時点で閉じられる
+            logger.debug("メモリマップを閉じられませんでした: %s", self.path)
+
+    # 画像のバイト列（BINチャンク上のビュー）
+    def get_image_view(self, image: VrmImage):
+        return self.buffer[image.offset:(image.offset + image.length)]
+
+    # 材質が参照する画像INDEX（メイン, スフィア）
+    def get_material_image_indexes(self, material_idx: int):
+        main_texture_idx = -1
+        sphere_texture_idx = -1
+
+        if 0 <= material_idx < len(self.json_data.get("materials", [])):
+            material_data = self.json_data["materials"][material_idx]
+
+            if "baseColorTexture" in material_data.get("pbrMetallicRoughness", {}):
+                main_texture_idx = material_data["pbrMetallicRoughness"]["baseColorTexture"]["index"]
+
+            # VRM独自の材質設定（同名の材質）
+            for material_property in self.json_data.get("extensions", {}).get("VRM", {}).get("materialProperties", []):
+                if material_property.get("name") == material_data.get("name"):
+                    texture_properties = material_property.get("textureProperties", {})
+                    main_texture_idx = texture_properties.get("_MainTex", main_texture_idx)
+                    sphere_texture_idx = texture_properties.get("_SphereAdd", sphere_texture_idx)
+                    break
+
+        return (self.get_texture_image_index(main_texture_idx), self.get_texture_image_index(sphere_texture_idx))
+
+    # テクスチャINDEXから画像INDEX
+    def get_texture_image_index(self, texture_idx: int):
+        textures = self.json_data.get("textures", [])
+        if 0 <= texture_idx < len(textures):
+            return textures[texture_idx].get("source", -1)
 
+        return -1
@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 #
+import mmap
+import json
 import struct
 import hashlib
+import traceback
+import numpy as np
 
-from mmd.VrmData import VrmModel # noqa
+from mmd.VrmData import VrmModel, VrmMesh, VrmPrimitive, VrmMorphOffset, VrmImage, VrmNodeStore # noqa
 from module.MMath import MRect, MVector3D, MVector4D, MQuaternion, MMatrix4x4 # noqa
 from utils.MLogger import MLogger # noqa
 from utils.MException import SizingException, MKilledException, MParseException
@@ -12,41 +16,461 @@ logger = MLogger(__name__, level=1)
 
 
 class VrmReader:
+    # GLBヘッダ（magic, version, length）
+    GLB_MAGIC = b"glTF"
+    GLB_VERSION = 2
+    GLB_HEADER_SIZE = 12
+    # GLBチャンクヘッダ（length, type）
+    GLB_CHUNK_HEADER_SIZE = 8
+    GLB_CHUNK_TYPE_JSON = 0x4E4F534A
+    GLB_CHUNK_TYPE_BIN = 0x004E4942
+
+    # accessor.componentType別の型（glTFはリトルエンディアン）
+    COMPONENT_DTYPES = {
+        5120: np.dtype("<i1"),
+        5121: np.dtype("<u1"),
+        5122: np.dtype("<i2"),
+        5123: np.dtype("<u2"),
+        5125: np.dtype("<u4"),
+        5126: np.dtype("<f4"),
+    }
+    # accessor.type別の成分数
+    ACCESSOR_COMPONENT_COUNTS = {"SCALAR": 1, "VEC2": 2, "VEC3": 3, "VEC4": 4, "MAT2": 4, "MAT3": 9, "MAT4": 16}
+    # primitive.mode: TRIANGLES
+    PRIMITIVE_MODE_TRIANGLES = 4
+    # VRM1.0の親指ボーン名をVRM0.xの名前に揃える（1.0は1段根元側から始まる）
+    VRM1_HUMAN_BONE_NAMES = {
+        "leftThumbMetacarpal": "leftThumbProximal",
+        "leftThumbProximal": "leftThumbIntermediate",
+        "rightThumbMetacarpal": "rightThumbProximal",
+        "rightThumbProximal": "rightThumbIntermediate",
+    }
+
     def __init__(self, file_path, is_check=True):
         self.file_path = file_path
+        self.is_check = is_check
+        self.offset = 0
+        # ファイル全体のメモリマップ
+        self.buffer = None
+        # JSONチャンク・BINチャンク（メモリマップ上のmemoryview）
+        self.json_chunk = None
+        self.bin_chunk = None
+        # JSONチャンクの解析結果
+        self.json_data = None
+        # ハッシュ値（一度だけ計算する）
+        self.digest = None
+        # 解凍済みのaccessor（キー：accessor INDEX、プリミティブ間で共有されているaccessorは一度だけ解凍する）
+        self.accessors = {}
+        self.sparse_accessors = {}
 
+    # モデル名のみ取得（BINチャンクは読まず、JSONチャンクのみ読み込む）
     def read_model_name(self):
-        return ""
+        with open(self.file_path, "rb") as f:
+            # GLBヘッダと最初のチャンクヘッダ
+            header = f.read(self.GLB_HEADER_SIZE + self.GLB_CHUNK_HEADER_SIZE)
+            if len(header) < self.GLB_HEADER_SIZE + self.GLB_CHUNK_HEADER_SIZE:
+                raise MParseException("GLB形式外のデータです。ファイルサイズ: {0}".format(len(header)))
+
+            magic, version, length, chunk_length, chunk_type = struct.unpack("<4sIIII", header)
+            logger.test("magic: %s, version: %s, length: %s, chunk_type: %x, chunk_length: %s", magic, version, length, chunk_type, chunk_length)
+
+            # GLBは最初のチャンクがJSONチャンク
+            if magic != self.GLB_MAGIC or version != self.GLB_VERSION or chunk_type != self.GLB_CHUNK_TYPE_JSON:
+                raise MParseException("GLB2.0形式外のデータです。magic: {0}, version: {1}, chunk_type: {2:x}".format(magic, version, chunk_type))
+
+            json_data = json.loads(f.read(chunk_length).decode("utf-8"))
+
+        return self.get_model_name(json_data)
 
-    def read_data(self):
-        # Pmxモデル生成
+    # VRMメタ情報のタイトル
+    def get_model_name(self, json_data: dict):
+        return json_data.get("extensions", {}).get("VRM", {}).get("meta", {}).get("title", "")
+
+    # is_partial: 変換キャッシュを使う場合、ノード・メッシュは読まない（テクスチャ出力に必要な情報のみ読む）
+    def read_data(self, is_partial=False):
+        # Vrmモデル生成
         vrm = VrmModel()
         vrm.path = self.file_path
+        vrm.is_partial = is_partial
 
         try:
-            
+            # GLBコンテナ読み込み
+            self.read_glb()
+
+            vrm.json_data = self.json_data
+            vrm.buffer = self.bin_chunk
+
+            vrm.name = self.get_model_name(self.json_data)
+            logger.test("name: %s", vrm.name)
+
+            logger.info("-- VRM GLB読み込み完了")
+
+            vrm.is_vrm1 = "VRMC_vrm" in self.json_data.get("extensions", {})
+
+            if not is_partial:
+                # ノードデータ（親子関係と初期姿勢）
+                vrm.node_store = self.read_nodes()
+                logger.test("node_store: %s", vrm.node_store)
+
+                vrm.humanoid = self.read_humanoid(len(vrm.node_store))
+                logger.test("humanoid: %s", vrm.humanoid)
+                logger.info("-- VRM ノード読み込み完了")
+
+                # メッシュデータリスト
+                vrm.meshes = self.read_meshes()
+
+                logger.test("len(meshes): %s, len(accessors): %s", len(vrm.meshes), len(self.accessors))
+                logger.info("-- VRM メッシュ読み込み完了")
+
+            # 画像データリスト（位置の索引のみ）
+            for image_idx, image_data in enumerate(self.json_data.get("images", [])):
+                if "bufferView" in image_data:
+                    buffer_view = self.json_data["bufferViews"][image_data["bufferView"]]
+                    offset = buffer_view.get("byteOffset", 0)
+                    length = buffer_view["byteLength"]
+
+                    if self.bin_chunk is None or offset + length > len(self.bin_chunk):
+                        raise MParseException("画像がBINチャンクの範囲を超えています。image: {0}".format(image_idx))
+
+                    image = VrmImage(image_idx, image_data.get("name", ""), image_data.get("mimeType", ""), image_data["bufferView"], offset, length)
+                else:
+                    # 外部参照（uri）の画像は対象外
+                    logger.warning("GLB外部の画像は出力できません。image: %s, uri: %s", image_idx, image_data.get("uri", ""))
+                    image = VrmImage(image_idx, image_data.get("name", ""), image_data.get("mimeType", ""), -1, 0, 0)
+
+                logger.test("image: %s", image)
+                vrm.images.append(image)
+
+            logger.test("len(images): %s", len(vrm.images))
+            logger.info("-- VRM テクスチャ読み込み完了")
+
+            # ハッシュを設定
+            vrm.digest = self.hexdigest()
+            logger.test("vrm: %s, hash: %s", vrm.name, vrm.digest)
+
+            # メモリマップはモデルと一緒に閉じる（解凍済みaccessorはメッシュが持っているので、リーダーからは手放す）
+            vrm.mapped_buffer = self.buffer
+            self.accessors = {}
+            self.sparse_accessors = {}
+
             return vrm
         except MKilledException as ke:
             # 終了命令
+            self.close_with_error(vrm, ke)
             raise ke
         except SizingException as se:
             logger.error("VRM2PMX処理が処理できないデータで終了しました。\n\n%s", se.message)
+            self.close_with_error(vrm, se)
             return se
         except Exception as e:
-            import traceback
             logger.error("VRM2PMX処理が意図せぬエラーで終了しました。\n\n%s", traceback.format_exc())
+            self.close_with_error(vrm, e)
             raise e
 
+    # 読み込みに失敗した場合、途中まで読んだデータを手放してメモリマップを閉じる
+    def close_with_error(self, vrm: VrmModel, e: Exception):
+        vrm.meshes = []
+        vrm.buffer = None
+        # 例外が保持している途中のビューも手放す
+        traceback.clear_frames(e.__traceback__)
+        self.close()
+
+    # メモリマップを閉じる（BINチャンク上のビューが残っている場合、参照がなくなった時点で閉じられる）
+    def close(self):
+        self.accessors = {}
+        self.sparse_accessors = {}
+
+        try:
+            for chunk in [self.json_chunk, self.bin_chunk]:
+                if chunk is not None:
+                    chunk.release()
+            self.json_chunk = None
+            self.bin_chunk = None
+
+            if self.buffer is not None:
+                self.buffer.close()
+                self.buffer = None
+        except BufferError:
+            logger.debug("メモリマップを閉じられませんでした: %s", self.file_path)
+
+    # メッシュの読み込み（頂点属性は全てBINチャンク上のビュー）
+    def read_meshes(self):
+        meshes = []
+        for mesh_idx, mesh_data in enumerate(self.json_data.get("meshes", [])):
+            mesh = VrmMesh(mesh_idx, mesh_data.get("name", ""), target_names=mesh_data.get("extras", {}).get("targetNames", []))
+
+            for primitive_idx, primitive_data in enumerate(mesh_data["primitives"]):
+                # 頂点属性は全てBINチャンク上のビューとして取得する
+                attributes = {}
+                for attribute_name, accessor_idx in primitive_data["attributes"].items():
+                    attributes[attribute_name] = self.read_accessor(accessor_idx)
+
+                if "indices" in primitive_data:
+                    indices = self.read_accessor(primitive_data["indices"])
+                else:
+                    # INDEXがない場合、頂点の並び順そのまま
+                    indices = np.arange(len(attributes["POSITION"]), dtype=np.uint32)
+
+                # モーフターゲットは疎なまま保持する
+                targets = []
+                for target_data in primitive_data.get("targets", []):
+                    target = {}
+                    for attribute_name, accessor_idx in target_data.items():
+                        target[attribute_name] = self.read_sparse_accessor(accessor_idx)
+                    targets.append(target)
+
+                # 頂点属性・モーフターゲットのaccessorが同じプリミティブは、頂点を共有している
+                vertex_key = (tuple(sorted(primitive_data["attributes"].items())),
+                              tuple(tuple(sorted(target_data.items())) for target_data in primitive_data.get("targets", [])))
+
+                primitive = VrmPrimitive(primitive_idx, attributes, indices, primitive_data.get("material", -1), \
+                                         primitive_data.get("mode", self.PRIMITIVE_MODE_TRIANGLES), targets, vertex_key)
+                logger.test("mesh: %s, primitive: %s", mesh.name, primitive)
+
+                mesh.primitives.append(primitive)
+
+            meshes.append(mesh)
+
+        return meshes
+
+    # ノードの読み込み（項目ごとの配列にまとめる）
+    def read_nodes(self):
+        nodes_data = self.json_data.get("nodes", [])
+        node_count = len(nodes_data)
+
+        parent_indexes = np.full(node_count, -1, dtype=np.int32)
+        child_indexes = []
+        for node_idx, node_data in enumerate(nodes_data):
+            children = node_data.get("children", [])
+            for child_idx in children:
+                if not 0 <= child_idx < node_count or child_idx == node_idx or parent_indexes[child_idx] >= 0:
+                    # 親が複数あるノードは木構造にならない
+                    raise MParseException("ノードの親子関係が不正です。node: {0}, child: {1}".format(node_idx, child_idx))
+                parent_indexes[child_idx] = node_idx
+            child_indexes.append(list(children))
+
+        node_store = VrmNodeStore(
+            names=[node_data.get("name", "") for node_data in nodes_data],
+            parent_indexes=parent_indexes,
+            child_indexes=child_indexes,
+            translations=np.array([node_data.get("translation", [0, 0, 0]) for node_data in nodes_data], dtype=np.float64).reshape(-1, 3),
+            # glTFはx,y,z,wの順
+            rotations=np.array([node_data.get("rotation", [0, 0, 0, 1]) for node_data in nodes_data], dtype=np.float64).reshape(-1, 4)[:, [3, 0, 1, 2]],
+            scales=np.array([node_data.get("scale", [1, 1, 1]) for node_data in nodes_data], dtype=np.float64).reshape(-1, 3),
+            has_matrices=np.array(["matrix" in node_data for node_data in nodes_data], dtype=np.bool_),
+            mesh_indexes=np.array([node_data.get("mesh", -1) for node_data in nodes_data], dtype=np.int32),
+            skin_indexes=np.array([node_data.get("skin", -1) for node_data in nodes_data], dtype=np.int32))
+
+        for node_idx in np.where(node_store.has_matrices)[0]:
+            # glTFの行列は列優先
+            node_store.matrices[node_idx] = np.array(nodes_data[node_idx]["matrix"], dtype=np.float64).reshape(4, 4).T
+
+        # 循環していないか（深さが求まるか）
+        node_store.get_depths()
+
+        return node_store
+
+    # humanoidボーンの読み込み（キー：VRM0.xのボーン名、値：ノードINDEX）
+    def read_humanoid(self, node_count: int):
+        extensions = self.json_data.get("extensions", {})
+
+        humanoid = {}
+        if "VRMC_vrm" in extensions:
+            # VRM1.0
+            for bone_name, bone_data in extensions["VRMC_vrm"].get("humanoid", {}).get("humanBones", {}).items():
+                humanoid[self.VRM1_HUMAN_BONE_NAMES.get(bone_name, bone_name)] = bone_data.get("node", -1)
+        else:
+            # VRM0.x
+            for bone_data in extensions.get("VRM", {}).get("humanoid", {}).get("humanBones", []):
+                humanoid[bone_data.get("bone", "")] = bone_data.get("node", -1)
+
+        # 存在しないノードを指しているものは除外
+        return {bone_name: node_idx for (bone_name, node_idx) in humanoid.items() if 0 <= node_idx < node_count}
+
+    # GLBコンテナの読み込み
+    # ファイルはメモリマップで開き、JSON/BINチャンクはコピーせずmemoryviewとして保持する
+    def read_glb(self):
+        if self.buffer is not None:
+            # 既にマップ済みの場合、そのまま使う
+            return
+
+        with open(self.file_path, "rb") as f:
+            try:
+                self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # 空ファイルはマップできない
+                raise MParseException("GLB形式外のデータです。ファイルサイズが0です。")
+
+        try:
+            if len(self.buffer) < self.GLB_HEADER_SIZE:
+                raise MParseException("GLB形式外のデータです。ファイルサイズ: {0}".format(len(self.buffer)))
+
+            # glTF宣言・バージョン・全体長
+            magic, version, length = struct.unpack_from("<4sII", self.buffer, 0)
+            logger.test("magic: %s, version: %s, length: %s", magic, version, length)
+
+            if magic != self.GLB_MAGIC or version != self.GLB_VERSION or length > len(self.buffer):
+                # 整合性チェック
+                raise MParseException("GLB2.0形式外のデータです。magic: {0}, version: {1}, length: {2}".format(magic, version, length))
+
+            self.offset = self.GLB_HEADER_SIZE
+
+            while self.offset + self.GLB_CHUNK_HEADER_SIZE <= length:
+                chunk_length, chunk_type = struct.unpack_from("<II", self.buffer, self.offset)
+                chunk_start = self.offset + self.GLB_CHUNK_HEADER_SIZE
+                chunk_end = chunk_start + chunk_length
+                logger.test("chunk_type: %x, chunk_length: %s (%s)", chunk_type, chunk_length, self.offset)
+
+                if chunk_end > length:
+                    raise MParseException("GLBチャンクがファイル長を超えています。type: {0:x}, length: {1}".format(chunk_type, chunk_length))
+
+                # 最初のJSON/BINチャンクのみ採用（未知のチャンクは読み飛ばす）
+                if chunk_type == self.GLB_CHUNK_TYPE_JSON and self.json_chunk is None:
+                    self.json_chunk = memoryview(self.buffer)[chunk_start:chunk_end]
+                elif chunk_type == self.GLB_CHUNK_TYPE_BIN and self.bin_chunk is None:
+                    self.bin_chunk = memoryview(self.buffer)[chunk_start:chunk_end]
+
+                self.offset = chunk_end
+
+            if self.json_chunk is None:
+                raise MParseException("GLBにJSONチャンクがありません。")
+
+            # JSONチャンクのみデコードする（BINチャンクはマップしたまま）
+            self.json_data = json.loads(self.json_chunk.tobytes().decode("utf-8"))
+            # デコード後のJSONチャンクは使わないので、ビューを手放す（メモリマップを閉じられるように）
+            self.json_chunk.release()
+        except Exception as e:
+            # 読み込めないファイルはマップしたままにしない
+            self.close()
+            raise e
+
+    # accessorの解凍
+    # BINチャンク上のbufferViewをそのままndarrayとして参照し、要素ごとのオブジェクトは作らない
+    def read_accessor(self, accessor_idx):
+        if accessor_idx in self.accessors:
+            return self.accessors[accessor_idx]
+
+        accessor = self.json_data["accessors"][accessor_idx]
+        dtype, component_count = self.get_accessor_format(accessor)
+        count = accessor["count"]
+
+        if "bufferView" in accessor:
+            values = self.read_buffer_view(accessor["bufferView"], accessor.get("byteOffset", 0), dtype, component_count, count)
+        else:
+            # bufferViewがない場合、0初期化
+            values = np.zeros((count, component_count), dtype=dtype)
+
+        if "sparse" in accessor:
+            # 疎なaccessorを全頂点分に展開する場合、ベースを書き換えるのでコピーする
+            sparse_indices, sparse_values = self.read_sparse_values(accessor, dtype, component_count)
+            if not values.flags.writeable:
+                values = values.copy()
+            values[sparse_indices] = sparse_values
+
+        values = self.normalize_values(accessor, values)
+
+        if component_count == 1:
+            # SCALARは1次元で扱う
+            values = values[:, 0]
+
+        self.accessors[accessor_idx] = values
+
+        return values
+
+    # accessorの疎な解凍
+    # 差分のある要素のINDEXと値だけを返す（モーフターゲット用）
+    def read_sparse_accessor(self, accessor_idx):
+        if accessor_idx in self.sparse_accessors:
+            return self.sparse_accessors[accessor_idx]
+
+        accessor = self.json_data["accessors"][accessor_idx]
+        dtype, component_count = self.get_accessor_format(accessor)
+        count = accessor["count"]
+
+        if "sparse" in accessor and "bufferView" not in accessor:
+            # ベースが0の疎なaccessorは、そのままINDEXと値のビューを使う
+            indices, deltas = self.read_sparse_values(accessor, dtype, component_count)
+            deltas = self.normalize_values(accessor, deltas)
+        else:
+            # 密なaccessorの場合、差分のある要素だけ抜き出す
+            values = self.read_accessor(accessor_idx)
+            if component_count == 1:
+                values = values[:, np.newaxis]
+            indices = np.flatnonzero(np.any(values != 0, axis=1))
+            deltas = values[indices]
+
+        self.sparse_accessors[accessor_idx] = VrmMorphOffset(count, indices, deltas)
+
+        return self.sparse_accessors[accessor_idx]
+
+    # 疎なaccessorのINDEXと値
+    def read_sparse_values(self, accessor, dtype, component_count):
+        sparse = accessor["sparse"]
+        sparse_count = sparse["count"]
+
+        indices_data = sparse["indices"]
+        if indices_data["componentType"] not in (5121, 5123, 5125):
+            raise MParseException("unknown sparse indices componentType: {0}".format(indices_data["componentType"]))
+
+        indices = self.read_buffer_view(indices_data["bufferView"], indices_data.get("byteOffset", 0), \
+                                        self.COMPONENT_DTYPES[indices_data["componentType"]], 1, sparse_count)[:, 0]
+
+        values_data = sparse["values"]
+        values = self.read_buffer_view(values_data["bufferView"], values_data.get("byteOffset", 0), dtype, component_count, sparse_count)
+
+        if sparse_count > 0 and indices.max() >= accessor["count"]:
+            raise MParseException("sparse indicesがaccessorの範囲を超えています。count: {0}".format(accessor["count"]))
+
+        return indices, values
+
+    # accessorの型と成分数
+    def get_accessor_format(self, accessor):
+        if accessor["componentType"] not in self.COMPONENT_DTYPES:
+            raise MParseException("unknown accessor componentType: {0}".format(accessor["componentType"]))
+        if accessor["type"] not in self.ACCESSOR_COMPONENT_COUNTS:
+            raise MParseException("unknown accessor type: {0}".format(accessor["type"]))
+
+        return self.COMPONENT_DTYPES[accessor["componentType"]], self.ACCESSOR_COMPONENT_COUNTS[accessor["type"]]
+
+    # 正規化整数は実数に変換する（ここだけは新規配列）
+    def normalize_values(self, accessor, values):
+        if accessor.get("normalized", False) and values.dtype.kind in "iu":
+            max_value = np.iinfo(values.dtype).max
+            return np.maximum(values.astype(np.float32) / max_value, -1)
+
+        return values
+
+    # bufferViewの参照（byteStrideを考慮したビュー）
+    def read_buffer_view(self, buffer_view_idx, byte_offset, dtype, component_count, count):
+        buffer_view = self.json_data["bufferViews"][buffer_view_idx]
+
+        if buffer_view.get("buffer", 0) != 0 or self.bin_chunk is None:
+            # GLB埋め込み以外のバッファは対象外
+            raise MParseException("GLB外部バッファは読み込めません。bufferView: {0}".format(buffer_view_idx))
+
+        view_offset = buffer_view.get("byteOffset", 0)
+        view_length = buffer_view["byteLength"]
+        element_size = dtype.itemsize * component_count
+        # byteStrideの指定がない場合、詰めて格納されている
+        stride = buffer_view.get("byteStride", element_size)
+
+        offset = view_offset + byte_offset
+        if count > 0 and (offset + stride * (count - 1) + element_size > view_offset + view_length or view_offset + view_length > len(self.bin_chunk)):
+            raise MParseException("accessorがbufferViewの範囲を超えています。bufferView: {0}, count: {1}".format(buffer_view_idx, count))
+
+        return np.ndarray(shape=(count, component_count), dtype=dtype, buffer=self.bin_chunk, offset=offset, strides=(stride, dtype.itemsize))
+
     def hexdigest(self):
-        sha1 = hashlib.sha1()
+        if self.digest is None:
+            # 読み込みと同じメモリマップを使い、ファイルを読み直さない
+            self.read_glb()
 
-        with open(self.file_path, 'rb') as f:
-            for chunk in iter(lambda: f.read(2048 * sha1.block_size), b''):
-                sha1.update(chunk)
+            blake2 = hashlib.blake2b(digest_size=32)
+            blake2.update(self.buffer)
 
-        sha1.update(chunk)
+            # ファイルパスをハッシュに含める
+            blake2.update(self.file_path.encode('utf-8'))
 
-        # ファイルパスをハッシュに含める
-        sha1.update(self.file_path.encode('utf-8'))
+            self.digest = blake2.hexdigest()
 
-        return sha1.hexdigest()
+        return self.digest
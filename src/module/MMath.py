@@ -3,10 +3,9 @@
 # cython: boundscheck=False
 # cython: wraparound=False
 #
-import quaternion # noqa
 import math
 import numpy as np
-from math import sin, cos, acos, atan2, asin, pi, sqrt, degrees, radians
+from math import sin, cos, acos, atan2, asin, pi, sqrt, degrees, radians, isfinite
 
 from utils.MLogger import MLogger # noqa
 
@@ -290,43 +289,67 @@ class MVector2D:
 
 
 class MVector3D:
+    # 配列を持たず、実数3つで保持する
+    __slots__ = ("__x", "__y", "__z")
 
     def __init__(self, x=0.0, y=0.0, z=0.0):
-        if isinstance(x, float):
-            # 実数の場合
-            self.__data = np.array([x, y, z], dtype=np.float64)
-        elif isinstance(x, MVector3D):
+        if isinstance(x, MVector3D):
             # クラスの場合
-            self.__data = np.array([x.x(), x.y(), x.z()], dtype=np.float64)
+            self.__x = x.__x
+            self.__y = x.__y
+            self.__z = x.__z
         elif isinstance(x, np.ndarray):
             # arrayそのものの場合
-            self.__data = np.array([x[0], x[1], x[2]], dtype=np.float64)
+            self.__x = float(x[0])
+            self.__y = float(x[1])
+            self.__z = float(x[2])
+        else:
+            # 実数の場合
+            self.__x = float(x)
+            self.__y = float(y)
+            self.__z = float(z)
+
+    # 実数から型判定なしで生成する（nan/infは0とする）
+    @staticmethod
+    def fromFloats(x: float, y: float, z: float):
+        v = object.__new__(MVector3D)
+        if isfinite(x + y + z):
+            # 和が有限なら全要素が有限
+            v.__x = x
+            v.__y = y
+            v.__z = z
         else:
-            self.__data = np.array([x, y, z], dtype=np.float64)
+            v.__x = x if isfinite(x) else 0.0
+            v.__y = y if isfinite(y) else 0.0
+            v.__z = z if isfinite(z) else 0.0
+        return v
 
     def copy(self):
-        return MVector3D(self.x(), self.y(), self.z())
+        return MVector3D.fromFloats(self.__x, self.__y, self.__z)
 
     def length(self):
-        return float(np.linalg.norm(self.data(), ord=2))
+        return sqrt(self.__x * self.__x + self.__y * self.__y + self.__z * self.__z)
 
     def lengthSquared(self):
-        return float(np.linalg.norm(self.data(), ord=2)**2)
+        return self.__x * self.__x + self.__y * self.__y + self.__z * self.__z
 
     def normalized(self):
-        l2 = np.linalg.norm(self.data(), ord=2, axis=-1, keepdims=True)
-        l2[l2 == 0] = 1
-        normv = self.data() / l2
-        return MVector3D(normv[0], normv[1], normv[2])
+        l2 = self.length()
+        if l2 == 0:
+            l2 = 1
+        return MVector3D.fromFloats(self.__x / l2, self.__y / l2, self.__z / l2)
 
     def normalize(self):
         self.effective()
-        l2 = np.linalg.norm(self.data(), ord=2, axis=-1, keepdims=True)
-        l2[l2 == 0] = 1
-        self.__data /= l2
+        l2 = self.length()
+        if l2 == 0:
+            l2 = 1
+        self.__x /= l2
+        self.__y /= l2
+        self.__z /= l2
     
     def distanceToPoint(self, v):
-        return MVector3D(self.data() - v.data()).length()
+        return MVector3D(self.__x - v.__x, self.__y - v.__y, self.__z - v.__z).length()
     
     def project(self, modelView, projection, viewport: MRect):
         tmp = MVector4D(self.x(), self.y(), self.z(), 1)
@@ -361,14 +384,15 @@ class MVector3D:
         return obj.toVector3D()
         
     def toVector4D(self):
-        return MVector4D(self.__data[0], self.__data[1], self.__data[2], 0)
+        return MVector4D(self.__x, self.__y, self.__z, 0)
 
     def is_almost_null(self):
-        return (is_almost_null(self.__data[0]) and is_almost_null(self.__data[1]) and is_almost_null(self.__data[2]))
+        return (is_almost_null(self.__x) and is_almost_null(self.__y) and is_almost_null(self.__z))
     
     def effective(self):
-        self.__data[np.isnan(self.data())] = 0
-        self.__data[np.isinf(self.data())] = 0
+        self.__x = self.__x if isfinite(self.__x) else 0.0
+        self.__y = self.__y if isfinite(self.__y) else 0.0
+        self.__z = self.__z if isfinite(self.__z) else 0.0
 
         return self
                 
@@ -396,8 +420,7 @@ class MVector3D:
         return self
     
     def isnan(self):
-        self.__data = self.data().astype(np.float64)
-        return np.isnan(self.data()).any()
+        return math.isnan(self.__x) or math.isnan(self.__y) or math.isnan(self.__z)
 
     @classmethod
     def crossProduct(cls, v1, v2):
@@ -408,131 +431,124 @@ class MVector3D:
         return dotProduct_MVector3D(v1, v2)
         
     def data(self):
-        return self.__data
+        return np.array([self.__x, self.__y, self.__z], dtype=np.float64)
 
     def to_log(self):
-        return "x: {0}, y: {1} z: {2}".format(round(self.__data[0], 5), round(self.__data[1], 5), round(self.__data[2], 5))
+        return "x: {0}, y: {1} z: {2}".format(round(self.__x, 5), round(self.__y, 5), round(self.__z, 5))
 
     def __str__(self):
-        return "MVector3D({0}, {1}, {2})".format(self.__data[0], self.__data[1], self.__data[2])
+        return "MVector3D({0}, {1}, {2})".format(self.__x, self.__y, self.__z)
 
     def __lt__(self, other):
-        return np.all(np.less(self.data(), other.data()))
+        return self.__x < other.__x and self.__y < other.__y and self.__z < other.__z
 
     def __le__(self, other):
-        return np.all(np.less_equal(self.data(), other.data()))
+        return self.__x <= other.__x and self.__y <= other.__y and self.__z <= other.__z
 
     def __eq__(self, other):
-        d1 = self.data()
-        d2 = other.data()
-        return d1[0] == d2[0] and d1[1] == d2[1] and d1[2] == d2[2]
+        return self.__x == other.__x and self.__y == other.__y and self.__z == other.__z
 
     def __ne__(self, other):
-        d1 = self.data()
-        d2 = other.data()
-        return d1[0] != d2[0] or d1[1] != d2[1] or d1[2] != d2[2]
+        return self.__x != other.__x or self.__y != other.__y or self.__z != other.__z
 
     def __gt__(self, other):
-        return np.all(np.greater(self.data(), other.data()))
+        return self.__x > other.__x and self.__y > other.__y and self.__z > other.__z
 
     def __ge__(self, other):
-        return np.all(np.greater_equal(self.data(), other.data()))
+        return self.__x >= other.__x and self.__y >= other.__y and self.__z >= other.__z
 
     def __add__(self, other):
-        if isinstance(other, np.float):
-            v = self.add_float(other)
-        elif isinstance(other, MVector3D):
-            v = self.add_MVector3D(other)
-        elif isinstance(other, np.int):
-            v = self.add_int(other)
+        if isinstance(other, MVector3D):
+            x, y, z = self.__x + other.__x, self.__y + other.__y, self.__z + other.__z
+            if isfinite(x + y + z):
+                # 最も多く呼ばれるので、fromFloatsを経由せずに生成する
+                v = object.__new__(MVector3D)
+                v.__x = x
+                v.__y = y
+                v.__z = z
+                return v
+            return MVector3D.fromFloats(x, y, z)
+        elif isinstance(other, (int, float, np.number)):
+            return MVector3D.fromFloats(self.__x + other, self.__y + other, self.__z + other)
         else:
-            v = self.data() + other
-        v2 = self.__class__(v)
-        v2.effective()
-        return v2
+            v = self.__class__(self.data() + other)
+        return v.effective()
     
     def add_MVector3D(self, other):
-        return self.__data + other.__data
+        return self.data() + other.data()
 
     def add_float(self, other: float):
-        return self.__data + other
+        return self.data() + other
 
     def add_int(self, other: int):
-        return self.__data + other
+        return self.data() + other
 
     def __sub__(self, other):
-        if isinstance(other, np.float):
-            v = self.sub_float(other)
-        elif isinstance(other, MVector3D):
-            v = self.sub_MVector3D(other)
-        elif isinstance(other, np.int):
-            v = self.sub_int(other)
+        if isinstance(other, MVector3D):
+            x, y, z = self.__x - other.__x, self.__y - other.__y, self.__z - other.__z
+            if isfinite(x + y + z):
+                # 最も多く呼ばれるので、fromFloatsを経由せずに生成する
+                v = object.__new__(MVector3D)
+                v.__x = x
+                v.__y = y
+                v.__z = z
+                return v
+            return MVector3D.fromFloats(x, y, z)
+        elif isinstance(other, (int, float, np.number)):
+            return MVector3D.fromFloats(self.__x - other, self.__y - other, self.__z - other)
         else:
-            v = self.data() - other
-        v2 = self.__class__(v)
-        v2.effective()
-        return v2
+            v = self.__class__(self.data() - other)
+        return v.effective()
     
     def sub_MVector3D(self, other):
-        return self.__data - other.__data
+        return self.data() - other.data()
 
     def sub_float(self, other: float):
-        return self.__data - other
+        return self.data() - other
 
     def sub_int(self, other: int):
-        return self.__data - other
+        return self.data() - other
 
     def __mul__(self, other):
-        if isinstance(other, np.float):
-            v = self.mul_float(other)
-        elif isinstance(other, MVector3D):
-            v = self.mul_MVector3D(other)
-        elif isinstance(other, np.int):
-            v = self.mul_int(other)
+        if isinstance(other, MVector3D):
+            return MVector3D.fromFloats(self.__x * other.__x, self.__y * other.__y, self.__z * other.__z)
+        elif isinstance(other, (int, float, np.number)):
+            return MVector3D.fromFloats(self.__x * other, self.__y * other, self.__z * other)
         else:
-            v = self.data() * other
-        v2 = self.__class__(v)
-        v2.effective()
-        return v2
+            v = self.__class__(self.data() * other)
+        return v.effective()
     
     def mul_MVector3D(self, other):
-        return self.__data * other.__data
+        return self.data() * other.data()
 
     def mul_float(self, other: float):
-        return self.__data * other
+        return self.data() * other
 
     def mul_int(self, other: int):
-        return self.__data * other
+        return self.data() * other
 
     def __truediv__(self, other):
-        if isinstance(other, np.float):
-            v = self.truediv_float(other)
-        elif isinstance(other, MVector3D):
-            v = self.truediv_MVector3D(other)
-        elif isinstance(other, np.int):
-            v = self.truediv_int(other)
+        # 0除算はnumpyと同じくinf/nanとし、effectiveで0にする
+        if isinstance(other, MVector3D):
+            v = self.__class__(self.data() / other.data())
+        elif isinstance(other, (int, float, np.number)) and other != 0:
+            return MVector3D.fromFloats(self.__x / other, self.__y / other, self.__z / other)
         else:
-            v = self.data() / other
-        v2 = self.__class__(v)
-        v2.effective()
-        return v2
+            v = self.__class__(self.data() / other)
+        return v.effective()
     
     def truediv_MVector3D(self, other):
-        return self.__data / other.__data
+        return self.data() / other.data()
 
     def truediv_float(self, other: float):
-        return self.__data / other
+        return self.data() / other
 
     def truediv_int(self, other: int):
-        return self.__data / other
+        return self.data() / other
 
     def __floordiv__(self, other):
-        if isinstance(other, np.float):
-            v = self.floordiv_float(other)
-        elif isinstance(other, MVector3D):
-            v = self.floordiv_MVector3D(other)
-        elif isinstance(other, np.int):
-            v = self.floordiv_int(other)
+        if isinstance(other, MVector3D):
+            v = self.data() // other.data()
         else:
             v = self.data() // other
         v2 = self.__class__(v)
@@ -540,21 +556,17 @@ class MVector3D:
         return v2
     
     def floordiv_MVector3D(self, other):
-        return self.__data // other.__data
+        return self.data() // other.data()
 
     def floordiv_float(self, other: float):
-        return self.__data // other
+        return self.data() // other
 
     def floordiv_int(self, other: int):
-        return self.__data // other
+        return self.data() // other
 
     def __mod__(self, other):
-        if isinstance(other, np.float):
-            v = self.mod_float(other)
-        elif isinstance(other, MVector3D):
-            v = self.mod_MVector3D(other)
-        elif isinstance(other, np.int):
-            v = self.mod_int(other)
+        if isinstance(other, MVector3D):
+            v = self.data() % other.data()
         else:
             v = self.data() % other
         v2 = self.__class__(v)
@@ -562,13 +574,13 @@ class MVector3D:
         return v2
     
     def mod_MVector3D(self, other):
-        return self.__data % other.__data
+        return self.data() % other.data()
 
     def mod_float(self, other: float):
-        return self.__data % other
+        return self.data() % other
 
     def mod_int(self, other: int):
-        return self.__data % other
+        return self.data() % other
 
     def __lshift__(self, other):
         if isinstance(other, MVector3D):
@@ -607,37 +619,36 @@ class MVector3D:
         return v2
 
     def __neg__(self):
-        return self.__class__(-self.x(), -self.y(), -self.z())
+        return MVector3D.fromFloats(-self.__x, -self.__y, -self.__z)
 
     def __pos__(self):
-        return self.__class__(+self.x(), +self.y(), +self.z())
+        return MVector3D.fromFloats(+self.__x, +self.__y, +self.__z)
 
     def x(self):
-        return self.__data[0]
+        return self.__x
 
     def y(self):
-        return self.__data[1]
+        return self.__y
 
     def z(self):
-        return self.__data[2]
+        return self.__z
     
     def setX(self, x):
-        self.__data[0] = x
+        self.__x = float(x)
 
     def setY(self, y):
-        self.__data[1] = y
+        self.__y = float(y)
 
     def setZ(self, z):
-        self.__data[2] = z
+        self.__z = float(z)
 
 
 def crossProduct_MVector3D(v1, v2):
-    crossv = np.cross(v1.data(), v2.data())
-    return MVector3D(crossv[0], crossv[1], crossv[2])
+    return MVector3D.fromFloats(v1.y() * v2.z() - v1.z() * v2.y(), v1.z() * v2.x() - v1.x() * v2.z(), v1.x() * v2.y() - v1.y() * v2.x())
 
 
 def dotProduct_MVector3D(v1, v2):
-    return np.dot(v1.data(), v2.data())
+    return v1.x() * v2.x() + v1.y() * v2.y() + v1.z() * v2.z()
 
 
 class MVector4D:
@@ -924,86 +935,86 @@ def dotProduct_MVector4D(v1, v2):
 
 
 class MQuaternion:
+    # 実数4つ（w,x,y,z）で保持する
+    __slots__ = ("__w", "__x", "__y", "__z")
 
     def __init__(self, w=1.0, x=0.0, y=0.0, z=0.0):
-        if isinstance(w, float):
-            self.__data = np.array([w, x, y, z], dtype=np.float64)
-        elif isinstance(w, MQuaternion):
+        if isinstance(w, MQuaternion):
             # クラスの場合
-            self.__data = np.array([w.data().components.w, w.data().components.x, w.data().components.y, w.data().components.z], dtype=np.float64)
-        elif isinstance(w, np.quaternion):
-            # quaternionの場合
-            self.__data = w.components
+            self.__w = w.__w
+            self.__x = w.__x
+            self.__y = w.__y
+            self.__z = w.__z
         elif isinstance(w, np.ndarray):
             # arrayそのものの場合
-            self.__data = np.array([w[0], w[1], w[2], w[3]], dtype=np.float64)
+            self.__w = float(w[0])
+            self.__x = float(w[1])
+            self.__y = float(w[2])
+            self.__z = float(w[3])
         else:
-            self.__data = np.array([w, x, y, z], dtype=np.float64)
+            # 実数の場合
+            self.__w = float(w)
+            self.__x = float(x)
+            self.__y = float(y)
+            self.__z = float(z)
 
     def copy(self):
-        return MQuaternion(self.scalar(), self.x(), self.y(), self.z())
+        return MQuaternion(self.__w, self.__x, self.__y, self.__z)
     
     def __str__(self):
-        return "MQuaternion({0}, {1}, {2}, {3})".format(self.scalar(), self.x(), self.y(), self.z())
+        return "MQuaternion({0}, {1}, {2}, {3})".format(self.__w, self.__x, self.__y, self.__z)
 
     def inverted(self):
-        v = self.data().inverse()
-        return self.__class__(v.w, v.x, v.y, v.z)
+        # 共役をノルムの二乗で割る
+        l2 = self.lengthSquared()
+        if l2 == 0:
+            # ノルムが0の場合は逆がないので、正規化と同じく単位クォータニオンとする
+            return self.__class__()
+        return self.__class__(self.__w / l2, -self.__x / l2, -self.__y / l2, -self.__z / l2)
 
     def length(self):
-        return self.data().abs()
+        return sqrt(self.lengthSquared())
 
     def lengthSquared(self):
-        return self.data().abs()**2
+        return self.__w * self.__w + self.__x * self.__x + self.__y * self.__y + self.__z * self.__z
 
     def normalized(self):
         self.effective()
-        v = self.data().normalized()
-        return MQuaternion(v.w, v.x, v.y, v.z)
+        l2 = self.length()
+        return MQuaternion(self.__w / l2, self.__x / l2, self.__y / l2, self.__z / l2)
 
     def normalize(self):
-        self.__data = self.data().normalized().components
+        l2 = self.length()
+        if l2 == 0:
+            return
+        self.__w /= l2
+        self.__x /= l2
+        self.__y /= l2
+        self.__z /= l2
 
     def effective(self):
-        self.data().components[np.isnan(self.data().components)] = 0
-        self.data().components[np.isinf(self.data().components)] = 0
+        self.__w = self.__w if isfinite(self.__w) else 0.0
+        self.__x = self.__x if isfinite(self.__x) else 0.0
+        self.__y = self.__y if isfinite(self.__y) else 0.0
+        self.__z = self.__z if isfinite(self.__z) else 0.0
         # Scalarは1がデフォルトとなる
         self.setScalar(1 if self.scalar() == 0 else self.scalar())
 
     def toMatrix4x4(self):
-        mat = MMatrix4x4()
-        m = mat.data()
-
-        # q(w,x,y,z)から(x,y,z,w)に並べ替え.
-        q2 = np.array([self.data().x, self.data().y, self.data().z, self.data().w], dtype=np.float64)
-
-        m[0, 0] = q2[3] * q2[3] + q2[0] * q2[0] - q2[1] * q2[1] - q2[2] * q2[2]
-        m[0, 1] = 2.0 * q2[0] * q2[1] - 2.0 * q2[3] * q2[2]
-        m[0, 2] = 2.0 * q2[0] * q2[2] + 2.0 * q2[3] * q2[1]
-        m[0, 3] = 0.0
-
-        m[1, 0] = 2.0 * q2[0] * q2[1] + 2.0 * q2[3] * q2[2]
-        m[1, 1] = q2[3] * q2[3] - q2[0] * q2[0] + q2[1] * q2[1] - q2[2] * q2[2]
-        m[1, 2] = 2.0 * q2[1] * q2[2] - 2.0 * q2[3] * q2[0]
-        m[1, 3] = 0.0
-
-        m[2, 0] = 2.0 * q2[0] * q2[2] - 2.0 * q2[3] * q2[1]
-        m[2, 1] = 2.0 * q2[1] * q2[2] + 2.0 * q2[3] * q2[0]
-        m[2, 2] = q2[3] * q2[3] - q2[0] * q2[0] - q2[1] * q2[1] + q2[2] * q2[2]
-        m[2, 3] = 0.0
-
-        m[3, 0] = 0.0
-        m[3, 1] = 0.0
-        m[3, 2] = 0.0
-        m[3, 3] = q2[3] * q2[3] + q2[0] * q2[0] + q2[1] * q2[1] + q2[2] * q2[2]
+        w, x, y, z = self.__w, self.__x, self.__y, self.__z
 
-        m /= m[3, 3]
-        m[3, 3] = 1.0
+        # 長さが1でない場合の補正
+        l2 = w * w + x * x + y * y + z * z
+        if l2 == 0:
+            l2 = 1
 
-        return mat
+        return MMatrix4x4((w * w + x * x - y * y - z * z) / l2, (2.0 * x * y - 2.0 * w * z) / l2, (2.0 * x * z + 2.0 * w * y) / l2, 0.0,
+                          (2.0 * x * y + 2.0 * w * z) / l2, (w * w - x * x + y * y - z * z) / l2, (2.0 * y * z - 2.0 * w * x) / l2, 0.0,
+                          (2.0 * x * z - 2.0 * w * y) / l2, (2.0 * y * z + 2.0 * w * x) / l2, (w * w - x * x - y * y + z * z) / l2, 0.0,
+                          0.0, 0.0, 0.0, 1.0)
     
     def toVector4D(self):
-        return MVector4D(self.data().x, self.data().y, self.data().z, self.data().w)
+        return MVector4D(self.__x, self.__y, self.__z, self.__w)
 
     def toEulerAngles4MMD(self):
         # MMDの表記に合わせたオイラー角
@@ -1013,10 +1024,10 @@ class MQuaternion:
 
     # http://www.j3d.org/matrix_faq/matrfaq_latest.html#Q37
     def toEulerAngles(self):
-        xp = self.data().x
-        yp = self.data().y
-        zp = self.data().z
-        wp = self.data().w
+        xp = self.__x
+        yp = self.__y
+        zp = self.__z
+        wp = self.__w
 
         xx = xp * xp
         xy = xp * yp
@@ -1071,6 +1082,24 @@ class MQuaternion:
         # sinOfAngle = sin(angle)
         # return sinOfAngle
 
+    # ベクトルの回転（行列を作らずに計算する）
+    def rotateVector(self, vec3):
+        w, x, y, z = self.__w, self.__x, self.__y, self.__z
+        vx, vy, vz = vec3.x(), vec3.y(), vec3.z()
+
+        # 長さが1でない場合の補正
+        l2 = w * w + x * x + y * y + z * z
+        if l2 == 0:
+            l2 = 1
+
+        # t = 2 * (q.xyz × v) / |q|^2
+        tx = 2.0 * (y * vz - z * vy) / l2
+        ty = 2.0 * (z * vx - x * vz) / l2
+        tz = 2.0 * (x * vy - y * vx) / l2
+
+        # v' = v + w * t + q.xyz × t
+        return MVector3D.fromFloats(vx + w * tx + (y * tz - z * ty), vy + w * ty + (z * tx - x * tz), vz + w * tz + (x * ty - y * tx))
+
     @classmethod
     def dotProduct(cls, v1, v2):
         return dotProduct_MQuaternion(v1, v2)
@@ -1112,137 +1141,96 @@ class MQuaternion:
         return slerp(q1, q2, t)
 
     def x(self):
-        return self.data().x
+        return self.__x
 
     def y(self):
-        return self.data().y
+        return self.__y
 
     def z(self):
-        return self.data().z
+        return self.__z
 
     def scalar(self):
-        return self.data().w
+        return self.__w
 
     def vector(self):
-        return MVector3D(self.data().x, self.data().y, self.data().z)
+        return MVector3D.fromFloats(self.__x, self.__y, self.__z)
 
     def setX(self, x):
-        self.__data[1] = x
+        self.__x = float(x)
 
     def setY(self, y):
-        self.__data[2] = y
+        self.__y = float(y)
 
     def setZ(self, z):
-        self.__data[3] = z
+        self.__z = float(z)
 
     def setScalar(self, w):
-        self.__data[0] = w
+        self.__w = float(w)
         
     def data(self):
-        return np.quaternion(self.__data[0], self.__data[1], self.__data[2], self.__data[3])
+        return np.array([self.__w, self.__x, self.__y, self.__z], dtype=np.float64)
+
+    def components(self):
+        return (self.__w, self.__x, self.__y, self.__z)
 
     def __lt__(self, other):
-        return self.data().less(other.data())
+        return self.components() < other.components()
 
     def __le__(self, other):
-        return self.data().less_equal(other.data())
+        return self.components() <= other.components()
 
     def __eq__(self, other):
-        return self.data().equal(other.data())
+        return self.components() == other.components()
 
     def __ne__(self, other):
-        return self.data().not_equal(other.data())
+        return self.components() != other.components()
 
     def __gt__(self, other):
-        return self.data().greater(other.data())
+        return self.components() > other.components()
 
     def __ge__(self, other):
-        return self.data().greater_equal(other.data())
+        return self.components() >= other.components()
 
     def __add__(self, other):
         if isinstance(other, MQuaternion):
-            v = self.data() + other.data()
-        else:
-            v = self.data() + other
-        return self.__class__(v.w, v.x, v.y, v.z)
+            return self.__class__(self.__w + other.__w, self.__x + other.__x, self.__y + other.__y, self.__z + other.__z)
+        # 実数はスカラー部にのみ加算
+        return self.__class__(self.__w + other, self.__x, self.__y, self.__z)
 
     def __sub__(self, other):
         if isinstance(other, MQuaternion):
-            v = self.data() - other.data()
-        else:
-            v = self.data() - other
-        return self.__class__(v.w, v.x, v.y, v.z)
+            return self.__class__(self.__w - other.__w, self.__x - other.__x, self.__y - other.__y, self.__z - other.__z)
+        # 実数はスカラー部からのみ減算
+        return self.__class__(self.__w - other, self.__x, self.__y, self.__z)
 
     def __mul__(self, other):
         if isinstance(other, MQuaternion):
-            v = self.data() * other.data()
-            return self.__class__(v)
+            # ハミルトン積
+            w1, x1, y1, z1 = self.__w, self.__x, self.__y, self.__z
+            w2, x2, y2, z2 = other.__w, other.__x, other.__y, other.__z
+            return self.__class__(w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2,
+                                  w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2,
+                                  w1 * y2 - x1 * z2 + y1 * w2 + z1 * x2,
+                                  w1 * z2 + x1 * y2 - y1 * x2 + z1 * w2)
         elif isinstance(other, MVector3D):
-            v = self.toMatrix4x4() * other
-            return v
+            return self.rotateVector(other)
         else:
-            v = self.data() * other
-            return self.__class__(v.w, v.x, v.y, v.z)
+            return self.__class__(self.__w * other, self.__x * other, self.__y * other, self.__z * other)
 
     def __truediv__(self, other):
         if isinstance(other, MQuaternion):
-            v = self.data() / other.data()
-        else:
-            v = self.data() / other
-        return self.__class__(v.w, v.x, v.y, v.z)
-
-    def __floordiv__(self, other):
-        if isinstance(other, MQuaternion):
-            v = self.data() // other.data()
-        else:
-            v = self.data() // other
-        return self.__class__(v.w, v.x, v.y, v.z)
-
-    def __mod__(self, other):
-        if isinstance(other, MQuaternion):
-            v = self.data() % other.data()
-        else:
-            v = self.data() % other
-        return self.__class__(v.w, v.x, v.y, v.z)
-
-    def __lshift__(self, other):
-        if isinstance(other, MQuaternion):
-            v = self.data() << other.data()
-        else:
-            v = self.data() << other
-        return self.__class__(v.w, v.x, v.y, v.z)
-
-    def __rshift__(self, other):
-        if isinstance(other, MQuaternion):
-            v = self.data() >> other.data()
-        else:
-            v = self.data() >> other
-        return self.__class__(v.w, v.x, v.y, v.z)
-
-    def __and__(self, other):
-        v = self.data() & other.data()
-        return self.__class__(v.w, v.x, v.y, v.z)
-
-    def __dataor__(self, other):
-        v = self.data() ^ other.data()
-        return self.__class__(v.w, v.x, v.y, v.z)
-
-    def __or__(self, other):
-        v = self.data() | other.data()
-        return self.__class__(v.w, v.x, v.y, v.z)
+            return self * other.inverted()
+        return self.__class__(self.__w / other, self.__x / other, self.__y / other, self.__z / other)
     
     def __neg__(self):
-        return self.__class__(-self.data().w, -self.data().x, -self.data().y, -self.data().z)
+        return self.__class__(-self.__w, -self.__x, -self.__y, -self.__z)
 
     def __pos__(self):
-        return self.__class__(+self.data().w, +self.data().x, +self.data().y, +self.data().z)
-
-    def __invert__(self):
-        return self.__class__(~self.data().w, ~self.data().x, ~self.data().y, ~self.data().z)
+        return self.__class__(+self.__w, +self.__x, +self.__y, +self.__z)
 
 
 def dotProduct_MQuaternion(v1: MQuaternion, v2: MQuaternion):
-    return np.sum(v1.data().components * v2.data().components)
+    return v1.scalar() * v2.scalar() + v1.x() * v2.x() + v1.y() * v2.y() + v1.z() * v2.z()
 
 def fromAxisAndAngle(vec3, angle: float):
     x = vec3.x()
@@ -1425,7 +1413,9 @@ def slerp(q1: MQuaternion, q2: MQuaternion, t: float):
 
 
 class MMatrix4x4:
-    
+    # 4x4の配列と、その実数の控え（ベクトル変換用、必要になった時に生成）を保持する
+    __slots__ = ("__data", "__values")
+
     def __init__(self, m11=1.0, m12=0.0, m13=0.0, m14=0.0, m21=0.0, m22=1.0, m23=0.0, m24=0.0, m31=0.0, m32=0.0, m33=1.0, m34=0.0, m41=0.0, m42=0.0, m43=0.0, m44=1.0):
         if isinstance(m11, float):
             self.__data = np.array([[m11, m12, m13, m14], [m21, m22, m23, m24], [m31, m32, m33, m34], [m41, m42, m43, m44]], dtype=np.float64)
@@ -1443,12 +1433,22 @@ class MMatrix4x4:
             # べた値の場合
             self.__data = np.array([[m11, m12, m13, m14], [m21, m22, m23, m24], [m31, m32, m33, m34], [m41, m42, m43, m44]], dtype=np.float64)
 
+        self.__values = None
+
     def copy(self):
         return MMatrix4x4(self.data())
     
     def data(self):
+        # 呼び出し元で書き換えられる可能性があるので、実数の控えは破棄する
+        self.__values = None
         return self.__data
 
+    # 行列の16要素（行優先）の実数タプル
+    def values(self):
+        if self.__values is None:
+            self.__values = tuple(self.__data.ravel().tolist())
+        return self.__values
+
     # 逆行列
     def inverted(self):
         return MMatrix4x4(np.linalg.inv(self.data()))
@@ -1459,25 +1459,20 @@ class MMatrix4x4:
 
     # 平行移動行列
     def translate(self, vec3):
-        vec_mat = np.array([[vec3.x(), vec3.y(), vec3.z()], 
-                            [vec3.x(), vec3.y(), vec3.z()], 
-                            [vec3.x(), vec3.y(), vec3.z()], 
-                            [vec3.x(), vec3.y(), vec3.z()]], dtype=np.float64)
-        data_mat = self.__data[:, :3] * vec_mat
-        self.__data[:, 3] += np.sum(data_mat, axis=1)
+        # 一時配列を作らず、4列目に直接加算する
+        x, y, z = vec3.x(), vec3.y(), vec3.z()
+        m = self.data()
+        for (row_idx, (m0, m1, m2, m3)) in enumerate(m.tolist()):
+            m[row_idx, 3] = m0 * x + m1 * y + m2 * z + m3
 
     # 縮尺行列
     def scale(self, scale):
-        vec3 = MVector3D(scale, scale, scale)
-        vec_mat = np.array([[vec3.x(), vec3.y(), vec3.z()], 
-                            [vec3.x(), vec3.y(), vec3.z()], 
-                            [vec3.x(), vec3.y(), vec3.z()], 
-                            [vec3.x(), vec3.y(), vec3.z()]], dtype=np.float64)
-        self.__data[:, :3] *= vec_mat
+        self.data()[:, :3] *= scale
         
     # 単位行列
     def setToIdentity(self):
         self.__data = np.eye(4, dtype=np.float64)
+        self.__values = None
     
     def lookAt(self, eye, center, up):
         forward = center - eye
@@ -1521,10 +1516,10 @@ class MMatrix4x4:
         self *= m
     
     def mapVector(self, vector):
-        vec_mat = np.array([vector.x(), vector.y(), vector.z()])
-        xyz = np.sum(vec_mat * self.__data[:3, :3], axis=1)
+        x, y, z = vector.x(), vector.y(), vector.z()
+        (m11, m12, m13, _, m21, m22, m23, _, m31, m32, m33, _, _, _, _, _) = self.values()
 
-        return MVector3D(xyz[0], xyz[1], xyz[2])
+        return MVector3D.fromFloats(m11 * x + m12 * y + m13 * z, m21 * x + m22 * y + m23 * z, m31 * x + m32 * y + m33 * z)
     
     def toQuaternion(self):
         a = np.array([[self.__data[0, 0], self.__data[0, 1], self.__data[0, 2], self.__data[0, 3]],
@@ -1587,12 +1582,10 @@ class MMatrix4x4:
         return np.all(np.greater_equal(self.data(), other.data()))
 
     def __add__(self, other):
-        if isinstance(other, np.float):
-            v = self.add_float(other)
-        elif isinstance(other, MMatrix4x4):
+        if isinstance(other, MMatrix4x4):
             v = self.add_MMatrix4x4(other)
-        elif isinstance(other, np.int):
-            v = self.add_int(other)
+        elif isinstance(other, (int, float, np.number)):
+            v = self.add_float(other)
         else:
             v = self.data() + other
         v2 = self.__class__(v)
@@ -1608,12 +1601,10 @@ class MMatrix4x4:
         return self.__data + other
 
     def __sub__(self, other):
-        if isinstance(other, np.float):
-            v = self.sub_float(other)
-        elif isinstance(other, MMatrix4x4):
+        if isinstance(other, MMatrix4x4):
             v = self.sub_MMatrix4x4(other)
-        elif isinstance(other, np.int):
-            v = self.sub_int(other)
+        elif isinstance(other, (int, float, np.number)):
+            v = self.sub_float(other)
         else:
             v = self.data() - other
         v2 = self.__class__(v)
@@ -1629,51 +1620,46 @@ class MMatrix4x4:
         return self.__data - other
 
     def __mul__(self, other):
-        if isinstance(other, np.float):
-            v = self.mul_float(other)
+        if isinstance(other, MVector3D):
+            return self.mul_MVector3D(other)
         elif isinstance(other, MMatrix4x4):
             v = self.mul_MMatrix4x4(other)
-        elif isinstance(other, MVector3D):
-            return self.mul_MVector3D(other)
         elif isinstance(other, MVector4D):
             return self.mul_MVector4D(other)
-        elif isinstance(other, np.int):
-            v = self.mul_int(other)
+        elif isinstance(other, MVector3DArray):
+            return MVector3DArray(mul_matrix_vectors(self.__data, other.data()))
+        elif isinstance(other, (int, float, np.number)):
+            v = self.mul_float(other)
         else:
             v = self.data() * other
         v2 = self.__class__(v)
         return v2
     
     def mul_MVector3D(self, other):
-        vec_mat = np.array([[other.x(), other.y(), other.z()], 
-                            [other.x(), other.y(), other.z()], 
-                            [other.x(), other.y(), other.z()], 
-                            [other.x(), other.y(), other.z()]], dtype=np.float64)
-        data_sum = np.sum(vec_mat * self.__data[:, :3], axis=1) + self.__data[:, 3]
+        # アフィン変換を実数で直接計算する（一時配列を作らない）
+        vx, vy, vz = other.x(), other.y(), other.z()
+        (m11, m12, m13, m14, m21, m22, m23, m24, m31, m32, m33, m34, m41, m42, m43, m44) = self.values()
 
-        x = data_sum[0]
-        y = data_sum[1]
-        z = data_sum[2]
-        w = data_sum[3]
+        x = m11 * vx + m12 * vy + m13 * vz + m14
+        y = m21 * vx + m22 * vy + m23 * vz + m24
+        z = m31 * vx + m32 * vy + m33 * vz + m34
+        w = m41 * vx + m42 * vy + m43 * vz + m44
 
         if w == 1.0:
-            return MVector3D(x, y, z)
+            return MVector3D.fromFloats(x, y, z)
         elif w == 0.0:
             return MVector3D()
         else:
-            return MVector3D(x / w, y / w, z / w)
+            return MVector3D.fromFloats(x / w, y / w, z / w)
 
     def mul_MVector4D(self, other):
-        vec_mat = np.array([[other.x(), other.y(), other.z(), other.w()], 
-                            [other.x(), other.y(), other.z(), other.w()], 
-                            [other.x(), other.y(), other.z(), other.w()], 
-                            [other.x(), other.y(), other.z(), other.w()]], dtype=np.float64)
-        data_sum = np.sum(vec_mat * self.__data, axis=1)
+        vx, vy, vz, vw = other.x(), other.y(), other.z(), other.w()
+        (m11, m12, m13, m14, m21, m22, m23, m24, m31, m32, m33, m34, m41, m42, m43, m44) = self.values()
 
-        x = data_sum[0]
-        y = data_sum[1]
-        z = data_sum[2]
-        w = data_sum[3]
+        x = m11 * vx + m12 * vy + m13 * vz + m14 * vw
+        y = m21 * vx + m22 * vy + m23 * vz + m24 * vw
+        z = m31 * vx + m32 * vy + m33 * vz + m34 * vw
+        w = m41 * vx + m42 * vy + m43 * vz + m44 * vw
 
         return MVector4D(x, y, z, w)
 
@@ -1704,6 +1690,409 @@ class MMatrix4x4:
         return self
 
 
+class MVector3DArray:
+    # 複数の3次元ベクトルを (N, 3) の配列でまとめて保持する
+
+    def __init__(self, data=None):
+        if data is None:
+            self.__data = np.zeros((0, 3), dtype=np.float64)
+        elif isinstance(data, MVector3DArray):
+            # クラスの場合
+            self.__data = data.data().copy()
+        else:
+            # arrayそのもの・MVector3Dリストの場合
+            if len(data) > 0 and isinstance(data[0], MVector3D):
+                data = [[v.x(), v.y(), v.z()] for v in data]
+            self.__data = np.array(data, dtype=np.float64).reshape(-1, 3)
+
+    def copy(self):
+        return MVector3DArray(self.__data.copy())
+
+    def data(self):
+        return self.__data
+
+    def __len__(self):
+        return len(self.__data)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return MVector3D(self.__data[index])
+        return MVector3DArray(self.__data[index])
+
+    def __iter__(self):
+        for v in self.__data:
+            yield MVector3D(v)
+
+    def __str__(self):
+        return "MVector3DArray({0})".format(self.__data)
+
+    def length(self):
+        return np.linalg.norm(self.__data, ord=2, axis=1)
+
+    def lengthSquared(self):
+        return np.sum(self.__data ** 2, axis=1)
+
+    def normalized(self):
+        l2 = np.linalg.norm(self.__data, ord=2, axis=1, keepdims=True)
+        l2[l2 == 0] = 1
+        return MVector3DArray(self.__data / l2)
+
+    def normalize(self):
+        self.effective()
+        l2 = np.linalg.norm(self.__data, ord=2, axis=1, keepdims=True)
+        l2[l2 == 0] = 1
+        self.__data /= l2
+
+    def distanceToPoint(self, v):
+        return (self - v).length()
+
+    def effective(self):
+        self.__data[np.isnan(self.__data)] = 0
+        self.__data[np.isinf(self.__data)] = 0
+
+        return self
+
+    @classmethod
+    def crossProduct(cls, v1, v2):
+        return MVector3DArray(np.cross(get_array_data(v1, 3), get_array_data(v2, 3)))
+
+    @classmethod
+    def dotProduct(cls, v1, v2):
+        return np.sum(get_array_data(v1, 3) * get_array_data(v2, 3), axis=-1)
+
+    def x(self):
+        return self.__data[:, 0]
+
+    def y(self):
+        return self.__data[:, 1]
+
+    def z(self):
+        return self.__data[:, 2]
+
+    def __add__(self, other):
+        return MVector3DArray(self.__data + get_array_data(other, 3)).effective()
+
+    def __sub__(self, other):
+        return MVector3DArray(self.__data - get_array_data(other, 3)).effective()
+
+    def __mul__(self, other):
+        return MVector3DArray(self.__data * get_array_data(other, 3)).effective()
+
+    def __truediv__(self, other):
+        return MVector3DArray(self.__data / get_array_data(other, 3)).effective()
+
+    def __neg__(self):
+        return MVector3DArray(-self.__data)
+
+    def __pos__(self):
+        return MVector3DArray(+self.__data)
+
+
+class MQuaternionArray:
+    # 複数のクォータニオンを (N, 4) の配列でまとめて保持する（並びはMQuaternionと同じw,x,y,z）
+
+    def __init__(self, data=None):
+        if data is None:
+            self.__data = np.zeros((0, 4), dtype=np.float64)
+        elif isinstance(data, MQuaternionArray):
+            # クラスの場合
+            self.__data = data.data().copy()
+        else:
+            # arrayそのもの・MQuaternionリストの場合
+            if len(data) > 0 and isinstance(data[0], MQuaternion):
+                data = [[q.scalar(), q.x(), q.y(), q.z()] for q in data]
+            self.__data = np.array(data, dtype=np.float64).reshape(-1, 4)
+
+    def copy(self):
+        return MQuaternionArray(self.__data.copy())
+
+    def data(self):
+        return self.__data
+
+    def __len__(self):
+        return len(self.__data)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return MQuaternion(self.__data[index])
+        return MQuaternionArray(self.__data[index])
+
+    def __iter__(self):
+        for q in self.__data:
+            yield MQuaternion(q)
+
+    def __str__(self):
+        return "MQuaternionArray({0})".format(self.__data)
+
+    def length(self):
+        return np.linalg.norm(self.__data, ord=2, axis=1)
+
+    def lengthSquared(self):
+        return np.sum(self.__data ** 2, axis=1)
+
+    def normalized(self):
+        l2 = np.linalg.norm(self.__data, ord=2, axis=1, keepdims=True)
+        l2[l2 == 0] = 1
+        return MQuaternionArray(self.__data / l2)
+
+    def normalize(self):
+        l2 = np.linalg.norm(self.__data, ord=2, axis=1, keepdims=True)
+        l2[l2 == 0] = 1
+        self.__data /= l2
+
+    def inverted(self):
+        # 共役をノルムの二乗で割る
+        l2 = self.lengthSquared()[:, np.newaxis]
+        l2[l2 == 0] = 1
+        return MQuaternionArray(self.__data * np.array([1, -1, -1, -1]) / l2)
+
+    def toMatrix4x4(self):
+        w, x, y, z = self.__data[:, 0], self.__data[:, 1], self.__data[:, 2], self.__data[:, 3]
+
+        m = np.zeros((len(self.__data), 4, 4), dtype=np.float64)
+        m[:, 0, 0] = w * w + x * x - y * y - z * z
+        m[:, 0, 1] = 2.0 * x * y - 2.0 * w * z
+        m[:, 0, 2] = 2.0 * x * z + 2.0 * w * y
+        m[:, 1, 0] = 2.0 * x * y + 2.0 * w * z
+        m[:, 1, 1] = w * w - x * x + y * y - z * z
+        m[:, 1, 2] = 2.0 * y * z - 2.0 * w * x
+        m[:, 2, 0] = 2.0 * x * z - 2.0 * w * y
+        m[:, 2, 1] = 2.0 * y * z + 2.0 * w * x
+        m[:, 2, 2] = w * w - x * x - y * y + z * z
+
+        # 長さが1でない場合の補正
+        l2 = w * w + x * x + y * y + z * z
+        l2[l2 == 0] = 1
+        m /= l2[:, np.newaxis, np.newaxis]
+        m[:, 3, 3] = 1.0
+
+        return MMatrix4x4Array(m)
+
+    # 各クォータニオンで各ベクトルを回転する
+    def rotateVectors(self, vectors):
+        q = self.__data
+        vs = np.atleast_2d(get_array_data(vectors, 3))
+
+        # 長さが1でない場合の補正
+        l2 = np.sum(q ** 2, axis=1, keepdims=True)
+        l2[l2 == 0] = 1
+
+        # t = 2 * (q.xyz × v) / |q|^2 、 v' = v + w * t + q.xyz × t
+        t = 2.0 * np.cross(q[:, 1:], vs) / l2
+        return MVector3DArray(vs + q[:, :1] * t + np.cross(q[:, 1:], t))
+
+    @classmethod
+    def dotProduct(cls, v1, v2):
+        return np.sum(get_array_data(v1, 4) * get_array_data(v2, 4), axis=-1)
+
+    @classmethod
+    def rotationTo(cls, fromv, tov):
+        v0 = MVector3DArray(get_array_data(fromv, 3)).normalized().data()
+        v1 = MVector3DArray(get_array_data(tov, 3)).normalized().data()
+        v0, v1 = np.broadcast_arrays(v0, v1)
+        d = np.sum(v0 * v1, axis=1) + 1.0
+
+        result = np.zeros((len(d), 4), dtype=np.float64)
+
+        # 逆向きの場合、どの軸でもよい
+        opposite_mask = np.abs(d) < 0.0000001
+        if np.any(opposite_mask):
+            axis = np.cross(np.array([1.0, 0.0, 0.0]), v0[opposite_mask])
+            y_mask = np.sum(axis ** 2, axis=1) < 0.0000001
+            axis[y_mask] = np.cross(np.array([0.0, 1.0, 0.0]), v0[opposite_mask][y_mask])
+            result[opposite_mask, 1:] = axis
+
+        normal_mask = ~opposite_mask
+        sd = np.sqrt(2.0 * d[normal_mask])
+        result[normal_mask, 0] = sd * 0.5
+        result[normal_mask, 1:] = np.cross(v0[normal_mask], v1[normal_mask]) / sd[:, np.newaxis]
+
+        return MQuaternionArray(result).normalized()
+
+    @classmethod
+    def nlerp(cls, q1, q2, t):
+        q1 = get_array_data(q1, 4)
+        q2b = get_array_data(q2, 4)
+        q1, q2b = np.broadcast_arrays(q1, q2b)
+        t = np.broadcast_to(np.asarray(t, dtype=np.float64), (len(q1),))[:, np.newaxis]
+
+        # 角度が大きい方は反転
+        q2b = np.where((np.sum(q1 * q2b, axis=1) < 0)[:, np.newaxis], -q2b, q2b)
+        result = MQuaternionArray(q1 * (1.0 - t) + q2b * t).normalized().data()
+
+        result = np.where(t <= 0.0, q1, result)
+        result = np.where(t >= 1.0, get_array_data(q2, 4) * np.ones_like(q1), result)
+
+        return MQuaternionArray(result)
+
+    @classmethod
+    def slerp(cls, q1, q2, t):
+        q1 = get_array_data(q1, 4)
+        q2b = get_array_data(q2, 4)
+        q1, q2b = np.broadcast_arrays(q1, q2b)
+        t = np.broadcast_to(np.asarray(t, dtype=np.float64), (len(q1),))
+
+        dot = np.sum(q1 * q2b, axis=1)
+        # 角度が大きい方は反転
+        q2b = np.where((dot < 0)[:, np.newaxis], -q2b, q2b)
+        dot = np.abs(dot)
+
+        factor1 = 1.0 - t
+        factor2 = t.copy()
+
+        # 角度が十分ある場合のみ球面補間、それ以外は線形補間
+        angle = np.arccos(np.clip(dot, 0, 1))
+        sin_angle = np.sin(angle)
+        slerp_mask = ((1.0 - dot) > 0.0000001) & (sin_angle > 0.0000001)
+        factor1 = np.where(slerp_mask, np.sin((1.0 - t) * angle) / np.where(slerp_mask, sin_angle, 1), factor1)
+        factor2 = np.where(slerp_mask, np.sin(t * angle) / np.where(slerp_mask, sin_angle, 1), factor2)
+
+        result = q1 * factor1[:, np.newaxis] + q2b * factor2[:, np.newaxis]
+
+        result = np.where((t <= 0.0)[:, np.newaxis], q1, result)
+        result = np.where((t >= 1.0)[:, np.newaxis], get_array_data(q2, 4) * np.ones_like(q1), result)
+
+        return MQuaternionArray(result)
+
+    def x(self):
+        return self.__data[:, 1]
+
+    def y(self):
+        return self.__data[:, 2]
+
+    def z(self):
+        return self.__data[:, 3]
+
+    def scalar(self):
+        return self.__data[:, 0]
+
+    def vector(self):
+        return MVector3DArray(self.__data[:, 1:])
+
+    def __add__(self, other):
+        return MQuaternionArray(self.__data + get_array_data(other, 4))
+
+    def __sub__(self, other):
+        return MQuaternionArray(self.__data - get_array_data(other, 4))
+
+    def __mul__(self, other):
+        if isinstance(other, (MQuaternionArray, MQuaternion)):
+            # ハミルトン積
+            w1, x1, y1, z1 = np.moveaxis(self.__data, 1, 0)
+            w2, x2, y2, z2 = np.moveaxis(np.atleast_2d(get_array_data(other, 4)), 1, 0)
+            return MQuaternionArray(np.stack([w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2,
+                                              w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2,
+                                              w1 * y2 - x1 * z2 + y1 * w2 + z1 * x2,
+                                              w1 * z2 + x1 * y2 - y1 * x2 + z1 * w2], axis=1))
+        elif isinstance(other, (MVector3DArray, MVector3D)):
+            # ベクトルの回転（行列を作らずに計算する）
+            return self.rotateVectors(other)
+
+        return MQuaternionArray(self.__data * other)
+
+    def __neg__(self):
+        return MQuaternionArray(-self.__data)
+
+
+class MMatrix4x4Array:
+    # 複数の4x4行列を (N, 4, 4) の配列でまとめて保持する
+
+    def __init__(self, data=None, count=0):
+        if data is None:
+            # 単位行列
+            self.__data = np.tile(np.eye(4, dtype=np.float64), (count, 1, 1))
+        elif isinstance(data, MMatrix4x4Array):
+            # クラスの場合
+            self.__data = data.data().copy()
+        else:
+            # arrayそのもの・MMatrix4x4リストの場合
+            if len(data) > 0 and isinstance(data[0], MMatrix4x4):
+                data = [m.data() for m in data]
+            self.__data = np.array(data, dtype=np.float64).reshape(-1, 4, 4)
+
+    def copy(self):
+        return MMatrix4x4Array(self.__data.copy())
+
+    def data(self):
+        return self.__data
+
+    def __len__(self):
+        return len(self.__data)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return MMatrix4x4(self.__data[index])
+        return MMatrix4x4Array(self.__data[index])
+
+    def __iter__(self):
+        for m in self.__data:
+            yield MMatrix4x4(m)
+
+    def __str__(self):
+        return "MMatrix4x4Array({0})".format(self.__data)
+
+    # 逆行列
+    def inverted(self):
+        return MMatrix4x4Array(np.linalg.inv(self.__data))
+
+    # 回転行列
+    def rotate(self, qq):
+        if isinstance(qq, MQuaternion):
+            qq = MQuaternionArray([qq])
+        self.__data = self.__data @ qq.toMatrix4x4().data()
+
+    # 平行移動行列
+    def translate(self, vec3):
+        self.__data[:, :, 3] += np.einsum("nij,nj->ni", self.__data[:, :, :3], np.broadcast_to(get_array_data(vec3, 3), (len(self.__data), 3)))
+
+    # 縮尺行列
+    def scale(self, scale):
+        self.__data[:, :, :3] *= scale
+
+    # 単位行列
+    def setToIdentity(self):
+        self.__data[:] = np.eye(4, dtype=np.float64)
+
+    # 回転成分のみ適用
+    def mapVector(self, vector):
+        return MVector3DArray(np.einsum("nij,nj->ni", self.__data[:, :3, :3], np.broadcast_to(get_array_data(vector, 3), (len(self.__data), 3))))
+
+    def __mul__(self, other):
+        if isinstance(other, (MMatrix4x4Array, MMatrix4x4)):
+            return MMatrix4x4Array(self.__data @ other.data())
+        elif isinstance(other, (MVector3DArray, MVector3D)):
+            return MVector3DArray(mul_matrix_vectors(self.__data, get_array_data(other, 3)))
+
+        return MMatrix4x4Array(self.__data * other)
+
+
+# 行列 (N, 4, 4) または (4, 4) でベクトル (N, 3) を変換する（MMatrix4x4.mul_MVector3Dの一括版）
+def mul_matrix_vectors(mat, vectors):
+    vectors = np.atleast_2d(vectors)
+    data_sum = np.einsum("...ij,...j->...i", mat[..., :, :3], vectors) + mat[..., :, 3]
+
+    xyz = data_sum[..., :3]
+    w = data_sum[..., 3:]
+
+    # wが0の場合は原点、それ以外はwで割る
+    return np.where(w == 0.0, 0.0, xyz / np.where(w == 0.0, 1.0, w))
+
+
+# 配列クラス・単体クラス・配列・数値から演算用の配列を取得
+def get_array_data(v, size: int):
+    if isinstance(v, (MVector3DArray, MQuaternionArray)):
+        return v.data()
+    elif isinstance(v, MVector3D):
+        return v.data()
+    elif isinstance(v, MQuaternion):
+        return np.array([v.scalar(), v.x(), v.y(), v.z()], dtype=np.float64)
+    elif isinstance(v, np.ndarray) and v.ndim == 1 and len(v) != size:
+        # 要素ごとのスカラー値
+        return v[:, np.newaxis]
+
+    return v
+
+
 def is_almost_null(v):
     return abs(v) < 0.0000001
 
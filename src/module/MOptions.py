@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 #
 
+import os
+import argparse
+
 from mmd.VrmData import VrmModel
 from utils.MLogger import MLogger # noqa
 
@@ -9,7 +12,8 @@ logger = MLogger(__name__)
 
 class MExportOptions:
 
-    def __init__(self, version_name: str, logging_level: int, max_workers: int, vrm_model: VrmModel, output_path: str, monitor, is_file: bool, outout_datetime: str):
+    def __init__(self, version_name: str, logging_level: int, max_workers: int, vrm_model: VrmModel, output_path: str, monitor, is_file: bool, outout_datetime: str, \
+                 mydir_path=None):
         self.version_name = version_name
         self.logging_level = logging_level
         self.vrm_model = vrm_model
@@ -18,5 +22,56 @@ class MExportOptions:
         self.is_file = is_file
         self.outout_datetime = outout_datetime
         self.max_workers = max_workers
+        # 変換キャッシュの保存先（Noneの場合、キャッシュしない）
+        self.mydir_path = mydir_path
+
+
+
+
+class MBatchOptions:
+
+    def __init__(self, version_name: str, logging_level: int, max_workers: int, input_paths: list, output_dir_path: str, timeout: float, summary_path: str, \
+                 manifest_path: str, is_force: bool, mydir_path=None):
+        self.version_name = version_name
+        self.logging_level = logging_level
+        self.max_workers = max_workers
+        # 入力VRMのパス・ワイルドカード・ディレクトリ
+        self.input_paths = input_paths
+        # 出力先ディレクトリ（空の場合、VRMと同じ階層に日時付きで出力）
+        self.output_dir_path = output_dir_path
+        # 1ファイルあたりの制限時間（秒）
+        self.timeout = timeout
+        # 結果JSONの出力先（空の場合、出力先ディレクトリかカレントディレクトリ）
+        self.summary_path = summary_path
+        # 前回変換結果の記録先（空の場合、出力先ディレクトリかexeと同じ階層）
+        self.manifest_path = manifest_path
+        # 変更のないファイルも全て変換し直すか
+        self.is_force = is_force
+        # 変換キャッシュの保存先
+        self.mydir_path = mydir_path
 
+    # コマンドライン引数の解析
+    @classmethod
+    def parse(cls, version_name: str, mydir_path=None, argv=None):
+        parser = argparse.ArgumentParser(prog="executor.py convert", description="VRMファイルをまとめてPMXに変換します。")
+        parser.add_argument("input_paths", nargs="+", help="VRMファイル・ワイルドカード・ディレクトリ")
+        parser.add_argument("--output_dir", default="", help="出力先ディレクトリ")
+        parser.add_argument("--max_workers", default=max(1, min(5, os.cpu_count() or 1)), type=int, help="同時に変換するファイル数")
+        parser.add_argument("--timeout", default=600, type=float, help="1ファイルあたりの制限時間（秒）")
+        parser.add_argument("--summary", default="", help="結果JSONの出力先")
+        parser.add_argument("--manifest", default="", help="前回変換結果の記録先")
+        parser.add_argument("--force", action="store_true", help="変更のないファイルも変換し直す")
+        parser.add_argument("--verbose", default=MLogger.INFO, type=int)
+        args = parser.parse_args(argv)
 
+        return MBatchOptions(
+            version_name=version_name,
+            logging_level=args.verbose,
+            max_workers=max(1, args.max_workers),
+            input_paths=args.input_paths,
+            output_dir_path=args.output_dir,
+            timeout=args.timeout,
+            summary_path=args.summary,
+            manifest_path=args.manifest,
+            is_force=args.force,
+            mydir_path=mydir_path)
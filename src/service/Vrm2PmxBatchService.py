@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+#
+import os
+import sys
+import glob
+import json
+import time
+import tempfile
+import traceback
+import concurrent.futures
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from module.MOptions import MBatchOptions, MExportOptions
+from mmd.VrmData import VrmModel
+from mmd.VrmReader import VrmReader
+from service.Vrm2PmxExportService import Vrm2PmxExportService
+from utils import MFileUtils, MCacheUtils
+from utils.MLogger import MLogger # noqa
+
+logger = MLogger(__name__, level=1)
+
+# 変換結果の状態
+STATUS_SUCCESS = "success"
+STATUS_FAILED = "failed"
+STATUS_TIMEOUT = "timeout"
+STATUS_SKIPPED = "skipped"
+
+
+# ファイルの状態（サイズと更新日時、ない場合はNone）
+def get_file_state(file_path: str):
+    try:
+        stat = os.stat(file_path)
+        return [stat.st_size, stat.st_mtime_ns]
+    except OSError:
+        return None
+
+
+# 1ファイルの変換（プロセスプールの子プロセスで実行する）
+def convert_vrm(vrm_path: str, output_path: str, version_name: str, logging_level: int, mydir_path):
+    MLogger.initialize(level=logging_level, is_file=False)
+
+    start = time.time()
+    result = {"vrm_path": vrm_path, "output_path": output_path, "status": STATUS_FAILED, "elapsed": 0, "error": "",
+              "digest": "", "input_state": get_file_state(vrm_path), "output_paths": []}
+
+    vrm_model = None
+    try:
+        # 変換キャッシュがある場合、ノード・メッシュは読み込まない（ハッシュはマップしたファイルから求める）
+        reader = VrmReader(vrm_path)
+        cached_pmx_model = Vrm2PmxExportService.read_cache(mydir_path, reader.hexdigest(), version_name)
+        vrm_model = reader.read_data(is_partial=cached_pmx_model is not None)
+
+        if not isinstance(vrm_model, VrmModel):
+            # 読み込みに失敗した場合、例外が返ってくる
+            result["error"] = "VRM読み込み失敗: {0}".format(getattr(vrm_model, "message", vrm_model))
+        else:
+            options = MExportOptions(
+                version_name=version_name,
+                logging_level=logging_level,
+                max_workers=1,
+                vrm_model=vrm_model,
+                output_path=output_path,
+                monitor=sys.stdout,
+                is_file=False,
+                outout_datetime=MLogger.outout_datetime,
+                mydir_path=mydir_path)
+
+            service = Vrm2PmxExportService(options, cached_pmx_model)
+            if service.execute():
+                result["status"] = STATUS_SUCCESS
+                result["digest"] = vrm_model.digest
+                # PMXと出力したテクスチャ
+                result["output_paths"] = [output_path] + [os.path.join(os.path.dirname(output_path), tex_path) for tex_path in service.pmx_model.textures]
+            else:
+                result["error"] = "変換失敗"
+    except Exception:
+        result["error"] = traceback.format_exc()
+    finally:
+        # 変換が終わったら、入力ファイルのメモリマップを閉じる
+        if isinstance(vrm_model, VrmModel):
+            vrm_model.close()
+
+    result["elapsed"] = round(time.time() - start, 3)
+
+    return result
+
+
+class Vrm2PmxBatchService():
+    # 結果JSONのファイル名（出力先の指定がない場合）
+    SUMMARY_FILE_NAME = "vrm2pmx_summary.json"
+    # 前回変換結果のファイル名（出力先の指定がない場合）
+    MANIFEST_FILE_NAME = "vrm2pmx_manifest.json"
+
+    def __init__(self, options: MBatchOptions):
+        self.options = options
+        # 出力先ディレクトリ（同名VRMの重複回避用）
+        self.output_dir_paths = []
+        # 子プロセスのログレベル（並列で出力が混ざるため、デバッグ指定以外は警告以上のみ）
+        self.worker_logging_level = options.logging_level if options.logging_level < MLogger.INFO else MLogger.WARNING
+        # 前回変換結果の記録（キー：VRMパス）
+        self.manifest_path = options.manifest_path or os.path.join(options.output_dir_path or options.mydir_path or os.getcwd(), self.MANIFEST_FILE_NAME)
+        self.manifest = {}
+        # 変換結果に影響する条件のハッシュ
+        self.option_hash = MCacheUtils.get_cache_key(options.version_name, Vrm2PmxExportService.CACHE_VERSION)
+
+    def execute(self):
+        start = time.time()
+
+        vrm_paths = self.get_vrm_paths()
+        if not vrm_paths:
+            logger.error("変換対象のVRMファイルがありません。\n%s", "\n".join(self.options.input_paths), decoration=MLogger.DECORATION_BOX)
+            self.write_summary([], time.time() - start)
+            return False
+
+        self.manifest = self.read_manifest()
+
+        jobs = []
+        skipped_results = {}
+        for vrm_path in vrm_paths:
+            # 出力先指定がある場合、同名の番号がずれないよう全ファイル分の出力先を決める
+            output_path = self.get_output_path(vrm_path) if self.options.output_dir_path else None
+
+            skipped_result = self.get_skipped_result(vrm_path, output_path)
+            if skipped_result:
+                skipped_results[vrm_path] = skipped_result
+            else:
+                jobs.append((vrm_path, output_path or self.get_output_path(vrm_path)))
+
+        logger.info("VRM2PMX一括変換開始: %sファイル (変更なし: %sファイル)", len(jobs), len(skipped_results), decoration=MLogger.DECORATION_LINE)
+
+        converted_results = {result["vrm_path"]: result for result in self.convert_all(jobs)}
+        results = [skipped_results[vrm_path] if vrm_path in skipped_results else converted_results[vrm_path] for vrm_path in vrm_paths]
+
+        self.save_manifest(results)
+        self.write_summary(results, time.time() - start)
+
+        return all([result["status"] in [STATUS_SUCCESS, STATUS_SKIPPED] for result in results])
+
+    # 入力パスからVRMファイルパスリストを取得（ディレクトリは配下全て）
+    def get_vrm_paths(self):
+        vrm_paths = []
+        for input_path in self.options.input_paths:
+            if os.path.isdir(input_path):
+                file_paths = glob.glob(os.path.join(input_path, "**", "*.vrm"), recursive=True)
+            elif os.path.isfile(input_path):
+                file_paths = [input_path]
+            else:
+                file_paths = [p for p in glob.glob(input_path, recursive=True) if os.path.isfile(p)]
+
+            for file_path in sorted(file_paths):
+                file_path = os.path.abspath(file_path)
+                if os.path.splitext(file_path)[1].lower() == ".vrm" and file_path not in vrm_paths:
+                    vrm_paths.append(file_path)
+
+        return vrm_paths
+
+    # 出力PMXパス
+    def get_output_path(self, vrm_path: str):
+        if not self.options.output_dir_path:
+            # VRMと同じ階層に日時付きで出力
+            return MFileUtils.get_output_pmx_path(vrm_path, "", is_force=True)
+
+        # 出力先ディレクトリ配下に、ファイル名のディレクトリを作って出力（同名は番号を付与）
+        vrm_file_name, _ = os.path.splitext(os.path.basename(vrm_path))
+        dir_name = vrm_file_name
+        n = 1
+        while os.path.join(self.options.output_dir_path, dir_name) in self.output_dir_paths:
+            dir_name = "{0}_{1}".format(vrm_file_name, n)
+            n += 1
+
+        output_dir_path = os.path.join(self.options.output_dir_path, dir_name)
+        self.output_dir_paths.append(output_dir_path)
+        os.makedirs(output_dir_path, exist_ok=True)
+
+        return os.path.join(output_dir_path, "{0}.pmx".format(vrm_file_name))
+
+    # 前回から入力・条件・出力が変わっていない場合、変換を省いた結果を返す
+    def get_skipped_result(self, vrm_path: str, output_path: str):
+        entry = self.manifest.get(vrm_path)
+        if self.options.is_force or not entry:
+            return None
+
+        if entry.get("version") != self.options.version_name or entry.get("option_hash") != self.option_hash:
+            return None
+
+        # 出力先が変わった場合は変換し直す
+        if output_path and entry.get("output_path") != output_path:
+            return None
+
+        # 出力ファイルが消えたり書き換えられたりしていないか
+        outputs = entry.get("outputs") or {}
+        if not outputs or [file_path for (file_path, state) in outputs.items() if get_file_state(file_path) != state]:
+            return None
+
+        # 入力はサイズと更新日時が同じならそのまま、違う場合は中身のハッシュで比較する
+        input_state = get_file_state(vrm_path)
+        if input_state != entry.get("input_state"):
+            reader = VrmReader(vrm_path)
+            try:
+                digest = reader.hexdigest()
+            except Exception:
+                return None
+            finally:
+                reader.close()
+
+            if digest != entry.get("digest"):
+                return None
+
+            # 中身は同じなので、状態だけ更新する
+            entry["input_state"] = input_state
+
+        logger.test("skip: %s", vrm_path)
+
+        return {"vrm_path": vrm_path, "output_path": entry["output_path"], "status": STATUS_SKIPPED, "elapsed": 0, "error": "",
+                "digest": entry["digest"], "input_state": input_state, "output_paths": list(outputs.keys())}
+
+    # 前回変換結果の読み込み（ない場合・読めない場合は空）
+    def read_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {}
+
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+
+            return manifest.get("files", {})
+        except Exception as e:
+            logger.warning("前回変換結果が読み込めなかったため、全て変換します。\n%s\n%s", self.manifest_path, e)
+
+        return {}
+
+    # 変換結果を記録して保存（失敗したものは次回変換し直す）
+    def save_manifest(self, results: list):
+        for result in results:
+            if result["status"] == STATUS_SUCCESS:
+                self.manifest[result["vrm_path"]] = {
+                    "digest": result["digest"],
+                    "input_state": result["input_state"],
+                    "version": self.options.version_name,
+                    "option_hash": self.option_hash,
+                    "output_path": result["output_path"],
+                    "outputs": {file_path: get_file_state(file_path) for file_path in result["output_paths"]}
+                }
+            elif result["status"] != STATUS_SKIPPED:
+                self.manifest.pop(result["vrm_path"], None)
+
+        temp_path = None
+        try:
+            manifest_dir_path = os.path.dirname(os.path.abspath(self.manifest_path))
+            os.makedirs(manifest_dir_path, exist_ok=True)
+
+            # 一時ファイルに書き込んでから置き換える（書きかけの記録を読まないため）
+            fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=manifest_dir_path)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"files": self.manifest}, f, ensure_ascii=False, indent=2)
+
+            os.replace(temp_path, self.manifest_path)
+            logger.test("save_manifest: %s", self.manifest_path)
+        except Exception as e:
+            logger.warning("変換結果の記録に失敗しました。\n%s\n%s", self.manifest_path, e)
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    # 全ファイルの変換
+    # 制限時間を超えたファイルがある場合、プロセスプールごと止めて、残りを新しいプールで続ける
+    def convert_all(self, jobs: list):
+        results = {}
+        remaining_jobs = list(jobs)
+
+        while remaining_jobs:
+            remaining_jobs = self.convert_jobs(remaining_jobs, results, len(jobs))
+
+        return [results[vrm_path] for (vrm_path, _) in jobs]
+
+    # プロセスプールでの変換（中断した場合、未完了のジョブを返す）
+    def convert_jobs(self, jobs: list, results: dict, total_count: int):
+        waiting_jobs = list(jobs)
+        # 実行中のジョブ（キー：future、値：(ジョブ, 開始時間)）
+        running_jobs = {}
+
+        executor = ProcessPoolExecutor(max_workers=self.options.max_workers)
+        try:
+            while waiting_jobs or running_jobs:
+                # 空いている分だけ投入する（投入した時点から制限時間を計る）
+                while waiting_jobs and len(running_jobs) < self.options.max_workers:
+                    (vrm_path, output_path) = waiting_jobs.pop(0)
+                    try:
+                        future = executor.submit(convert_vrm, vrm_path, output_path, self.options.version_name, self.worker_logging_level, self.options.mydir_path)
+                    except BrokenProcessPool:
+                        # 壊れたプールには投入できないので、投入しようとしたものも含めて失敗とし、残りは新しいプールで続ける
+                        self.set_broken_results(list(running_jobs.values()) + [((vrm_path, output_path), time.time())], results, total_count)
+                        return waiting_jobs
+                    running_jobs[future] = ((vrm_path, output_path), time.time())
+
+                # 一番早く制限時間になるジョブまで待つ
+                wait_time = max(0, min([start + self.options.timeout for (_, start) in running_jobs.values()]) - time.time())
+                done_futures, _ = concurrent.futures.wait(running_jobs.keys(), timeout=wait_time, return_when=concurrent.futures.FIRST_COMPLETED)
+
+                is_broken = False
+                for future in done_futures:
+                    ((vrm_path, output_path), start) = running_jobs.pop(future)
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool:
+                        is_broken = True
+                        result = {"vrm_path": vrm_path, "output_path": output_path, "status": STATUS_FAILED, "elapsed": round(time.time() - start, 3),
+                                  "error": "変換プロセスが異常終了しました"}
+                    except Exception:
+                        result = {"vrm_path": vrm_path, "output_path": output_path, "status": STATUS_FAILED, "elapsed": round(time.time() - start, 3),
+                                  "error": traceback.format_exc()}
+
+                    self.set_result(results, result, total_count)
+
+                if is_broken:
+                    # 子プロセスが異常終了した場合、実行中のものは全て失敗とし、残りは新しいプールで続ける
+                    self.set_broken_results(list(running_jobs.values()), results, total_count)
+                    return waiting_jobs
+
+                timeout_futures = [f for (f, (_, start)) in running_jobs.items() if time.time() - start >= self.options.timeout and not f.done()]
+                if timeout_futures:
+                    for future in timeout_futures:
+                        ((vrm_path, output_path), start) = running_jobs.pop(future)
+                        self.set_result(results, {"vrm_path": vrm_path, "output_path": output_path, "status": STATUS_TIMEOUT, "elapsed": round(time.time() - start, 3),
+                                                  "error": "制限時間({0}秒)を超えました".format(self.options.timeout)}, total_count)
+
+                    # 止まらない子プロセスは終了させ、実行中だったものは最初からやり直す
+                    self.terminate_executor(executor)
+                    return [job for (job, _) in running_jobs.values()] + waiting_jobs
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        return []
+
+    # プールが壊れた時に実行中だったジョブを全て失敗とする
+    def set_broken_results(self, jobs: list, results: dict, total_count: int):
+        for ((vrm_path, output_path), start) in jobs:
+            self.set_result(results, {"vrm_path": vrm_path, "output_path": output_path, "status": STATUS_FAILED, "elapsed": round(time.time() - start, 3),
+                                      "error": "変換プロセスが異常終了しました"}, total_count)
+
+    # プロセスプールの子プロセスを強制終了
+    def terminate_executor(self, executor: ProcessPoolExecutor):
+        if hasattr(executor, "terminate_workers"):
+            executor.terminate_workers()
+            return
+
+        for process in list((getattr(executor, "_processes", None) or {}).values()):
+            try:
+                process.terminate()
+            except Exception:
+                pass
+
+    def set_result(self, results: dict, result: dict, total_count: int):
+        results[result["vrm_path"]] = result
+
+        if result["status"] == STATUS_SUCCESS:
+            logger.info("変換成功 (%s/%s): %s (%s秒)", len(results), total_count, result["vrm_path"], result["elapsed"])
+        else:
+            logger.warning("変換失敗 (%s/%s): %s [%s]\n%s", len(results), total_count, result["vrm_path"], result["status"], result["error"])
+
+    # 結果JSONの出力
+    def write_summary(self, results: list, elapsed: float):
+        summary = {
+            "version": self.options.version_name,
+            "total": len(results),
+            "succeeded": len([r for r in results if r["status"] == STATUS_SUCCESS]),
+            "skipped": len([r for r in results if r["status"] == STATUS_SKIPPED]),
+            "failed": len([r for r in results if r["status"] not in [STATUS_SUCCESS, STATUS_SKIPPED]]),
+            "elapsed": round(elapsed, 3),
+            "results": results
+        }
+
+        summary_path = self.options.summary_path or os.path.join(self.options.output_dir_path or os.getcwd(), self.SUMMARY_FILE_NAME)
+        with open(summary_path, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        logger.info("結果出力: %s", summary_path)
+
+        logger.info("VRM2PMX一括変換終了: 成功 %s / 変更なし %s / 失敗 %s (%s秒)", summary["succeeded"], summary["skipped"], summary["failed"], summary["elapsed"],
+                    decoration=MLogger.DECORATION_LINE)
+
+        return summary
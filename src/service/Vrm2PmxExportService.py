@@ -1,24 +1,127 @@
 # -*- coding: utf-8 -*-
 #
 import logging
+import math
 import os
+import re
+import threading
 import traceback
 import concurrent.futures
 from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 
 from module.MOptions import MExportOptions
 from mmd.VrmData import VrmModel # noqa
-from mmd.PmxData import PmxModel # noqa
-from module.MMath import MRect, MVector3D, MVector4D, MQuaternion, MMatrix4x4 # noqa
-from utils.MLogger import MLogger # noqa
+from mmd.VrmReader import VrmReader
+from mmd.PmxData import PmxModel, VertexStore, Material, Bone, Morph, DisplaySlot, Ik, IkLink # noqa
+from mmd.PmxWriter import PmxWriter
+from module.MMath import MRect, MVector3D, MVector4D, MQuaternion, MMatrix4x4, MVector3DArray # noqa
+from utils import MCacheUtils
+from utils.MLogger import MLogger, check_killed # noqa
 from utils.MException import SizingException, MKilledException
 
 logger = MLogger(__name__, level=1)
 
+# 画像形式ごとの拡張子
+IMAGE_EXTENSIONS = {"image/png": ".png", "image/jpeg": ".jpg"}
+# 1mあたりのMMDの長さ
+MMD_UNIT_SCALE = 12.5
+# これ未満のウェイトは切り捨てる
+WEIGHT_THRESHOLD = 0.01
+
+# humanoidボーン名から準標準ボーン名
+def get_humanoid_bone_names():
+    bone_names = {
+        "hips": "下半身",
+        "spine": "上半身",
+        "chest": "上半身2",
+        "upperChest": "上半身3",
+        "neck": "首",
+        "head": "頭",
+    }
+
+    for (side_name, side) in [("left", "左"), ("right", "右")]:
+        bone_names.update({
+            side_name + "Eye": side + "目",
+            side_name + "Shoulder": side + "肩",
+            side_name + "UpperArm": side + "腕",
+            side_name + "LowerArm": side + "ひじ",
+            side_name + "Hand": side + "手首",
+            side_name + "ThumbProximal": side + "親指０",
+            side_name + "ThumbIntermediate": side + "親指１",
+            side_name + "ThumbDistal": side + "親指２",
+            side_name + "UpperLeg": side + "足",
+            side_name + "LowerLeg": side + "ひざ",
+            side_name + "Foot": side + "足首",
+            side_name + "Toes": side + "足先EX",
+        })
+
+        for (finger_name, finger) in [("Index", "人指"), ("Middle", "中指"), ("Ring", "薬指"), ("Little", "小指")]:
+            for (joint_name, joint) in [("Proximal", "１"), ("Intermediate", "２"), ("Distal", "３")]:
+                bone_names[side_name + finger_name + joint_name] = side + finger + joint
+
+    return bone_names
+
+
+# humanoidボーンから生成する準標準ボーン（上から順に生成する）
+# name: ボーン名, english_name: 英名, position: 位置の基準ボーン名（2つの場合は中間）, parent: 親ボーン名（Noneの場合は挿入先の元の親）,
+# insert_before: 挿入先のボーン名（Noneの場合は末尾）, children: 親を付け替えるボーン名, flag: ボーンフラグ,
+# fixed_axis: 軸制限の向き（根元, 先）, ik: (ターゲット, [(リンク, 下限角度, 上限角度)], ループ回数, 単位角)
+def get_standard_bone_definitions():
+    definitions = [
+        {"name": "センター", "english_name": "center", "position": ["下半身"], "parent": None, "insert_before": "下半身", "children": [],
+         "flag": 0x0002 | 0x0004 | 0x0008 | 0x0010},
+        {"name": "グルーブ", "english_name": "groove", "position": ["下半身"], "parent": "センター", "insert_before": "下半身", "children": ["下半身", "上半身"],
+         "flag": 0x0002 | 0x0004 | 0x0008 | 0x0010},
+    ]
+
+    for (side, side_english) in [("左", "left"), ("右", "right")]:
+        definitions.extend([
+            {"name": side + "腕捩", "english_name": "arm_twist_" + side_english, "position": [side + "腕", side + "ひじ"], "parent": side + "腕",
+             "insert_before": side + "ひじ", "children": [side + "ひじ"], "flag": 0x0002 | 0x0008 | 0x0010 | 0x0400, "fixed_axis": (side + "腕", side + "ひじ")},
+            {"name": side + "手捩", "english_name": "wrist_twist_" + side_english, "position": [side + "ひじ", side + "手首"], "parent": side + "ひじ",
+             "insert_before": side + "手首", "children": [side + "手首"], "flag": 0x0002 | 0x0008 | 0x0010 | 0x0400, "fixed_axis": (side + "ひじ", side + "手首")},
+            {"name": side + "足ＩＫ", "english_name": "leg_IK_" + side_english, "position": [side + "足首"], "parent": "全ての親", "insert_before": None,
+             "children": [], "flag": 0x0002 | 0x0004 | 0x0008 | 0x0010 | 0x0020,
+             "ik": (side + "足首", [(side + "ひざ", MVector3D(math.radians(-180), 0, 0), MVector3D(math.radians(-0.5), 0, 0)), (side + "足", None, None)], 40, 2.0)},
+            {"name": side + "つま先", "english_name": "toe_" + side_english, "position": [side + "足先EX"], "parent": side + "足首", "insert_before": None,
+             "children": [], "flag": 0x0002},
+            {"name": side + "つま先ＩＫ", "english_name": "toe_IK_" + side_english, "position": [side + "つま先"], "parent": side + "足ＩＫ", "insert_before": None,
+             "children": [], "flag": 0x0002 | 0x0004 | 0x0008 | 0x0010 | 0x0020, "ik": (side + "つま先", [(side + "足首", None, None)], 3, 4.0)},
+        ])
+
+    return definitions
+
+
+HUMANOID_BONE_NAMES = get_humanoid_bone_names()
+STANDARD_BONE_DEFINITIONS = get_standard_bone_definitions()
+
 
 class Vrm2PmxExportService():
-    def __init__(self, options: MExportOptions):
+    # 変換結果キャッシュの形式（変換内容を変えた場合は上げる）
+    CACHE_VERSION = 7
+
+    def __init__(self, options: MExportOptions, cached_pmx_model=None):
         self.options = options
+        # 読み込み前に取得した変換キャッシュ（ある場合、VRMはノード・メッシュを読まずに渡される）
+        self.cached_pmx_model = cached_pmx_model
+        # 変換結果（出力ファイルの確認用）
+        self.pmx_model = None
+
+    # 変換キャッシュの読み込み（ない場合・読めない場合はNone）
+    @classmethod
+    def read_cache(cls, mydir_path, digest: str, version_name: str):
+        if not digest:
+            return None
+
+        cached_pmx_model = MCacheUtils.read_cache(mydir_path, cls.get_cache_key(digest, version_name))
+
+        return cached_pmx_model if isinstance(cached_pmx_model, PmxModel) else None
+
+    # 変換キャッシュのキー（同じVRM・同じバージョンの変換結果は同じ）
+    @classmethod
+    def get_cache_key(cls, digest: str, version_name: str):
+        return MCacheUtils.get_cache_key(digest, version_name, cls.CACHE_VERSION) if digest else None
 
     def execute(self):
         logging.basicConfig(level=self.options.logging_level, format="%(message)s [%(module_name)s]")
@@ -32,10 +135,11 @@ class Vrm2PmxExportService():
             logger.info(service_data_txt, decoration=MLogger.DECORATION_BOX)
 
             # 処理に成功しているか
-            result = self.convert_pmx()
+            self.pmx_model = self.convert_pmx()
+            result = self.pmx_model is not None
 
-            # # 最後に出力
-            # VmdWriter(MOptionsDataSet(self.options.motion, None, self.options.model, self.options.output_path, False, False, [], None, 0, [])).write()
+            # 最後に出力
+            PmxWriter().write(self.pmx_model, self.options.output_path)
 
             logger.info("出力終了: %s", os.path.basename(self.options.output_path), decoration=MLogger.DECORATION_BOX, title="成功")
 
@@ -53,3 +157,590 @@ class Vrm2PmxExportService():
     def convert_pmx(self):
         vrm_model = self.options.vrm_model
 
+        pmx_model = PmxModel()
+        pmx_model.path = self.options.output_path
+        pmx_model.name = vrm_model.name
+
+        # 使用している材質（メッシュを読んでいない場合もあるので、JSONから取得する）
+        material_indexes = sorted({primitive_data.get("material", -1) for mesh_data in vrm_model.json_data.get("meshes", [])
+                                   for primitive_data in mesh_data.get("primitives", []) if primitive_data.get("material", -1) >= 0})
+
+        # テクスチャ出力
+        texture_indexes = self.export_textures(vrm_model, pmx_model, material_indexes)
+
+        # 同じVRMの変換結果があれば、メッシュ等の変換は行わない
+        cache_key = self.get_cache_key(vrm_model.digest, self.options.version_name)
+        cached_pmx_model = self.cached_pmx_model or self.read_cache(self.options.mydir_path, vrm_model.digest, self.options.version_name)
+        if cached_pmx_model is not None:
+            # 出力先ごとに決まる項目のみ置き換える
+            cached_pmx_model.path = pmx_model.path
+            cached_pmx_model.textures = pmx_model.textures
+
+            logger.info("-- 変換キャッシュ読み込み完了")
+
+            return cached_pmx_model
+
+        if vrm_model.is_partial:
+            # ノード・メッシュを読み込んでいないモデルは、キャッシュがないと変換できない
+            raise SizingException("変換キャッシュが読み込めませんでした。VRMを読み込み直してください。")
+
+        # ボーン
+        node_bone_indexes = self.convert_bones(vrm_model, pmx_model)
+
+        # 準標準ボーン
+        node_bone_indexes = self.convert_standard_bones(vrm_model, pmx_model, node_bone_indexes)
+
+        # 頂点・面・材質・モーフ
+        self.convert_mesh(vrm_model, pmx_model, texture_indexes, node_bone_indexes)
+
+        # 表示枠
+        self.convert_display_slots(pmx_model)
+
+        # MMDの座標系に変換
+        self.convert_coordinates(vrm_model, pmx_model)
+
+        if MCacheUtils.save_cache(self.options.mydir_path, cache_key, pmx_model):
+            logger.test("cache_key: %s", cache_key)
+
+        return pmx_model
+
+    # ボーン変換（全ての親の下にglTFのノード階層）
+    # 戻り値はノードINDEXごとのボーンINDEX
+    def convert_bones(self, vrm_model: VrmModel, pmx_model: PmxModel):
+        root_bone = Bone("全ての親", "Root", MVector3D(), -1, 0, 0x0001 | 0x0002 | 0x0004 | 0x0008 | 0x0010)
+        root_bone.index = 0
+        pmx_model.bones[root_bone.name] = root_bone
+        pmx_model.bone_indexes[root_bone.index] = root_bone.name
+
+        node_store = vrm_model.node_store
+        node_count = len(node_store)
+        if node_count == 0:
+            logger.info("-- ボーン変換完了: %s", len(pmx_model.bones))
+            return np.zeros(0, dtype=np.int32)
+
+        # 初期姿勢の位置（親の階層ごとにまとめて計算）
+        positions = node_store.get_global_matrices()[:, :3, 3]
+        logger.test("positions: %s", positions)
+
+        # 親が先になる並び順でボーンINDEXを振る（0は全ての親）
+        sorted_indexes = node_store.get_sorted_indexes()
+        node_bone_indexes = np.zeros(node_count, dtype=np.int32)
+        node_bone_indexes[sorted_indexes] = np.arange(1, node_count + 1, dtype=np.int32)
+
+        # 親がないノードは全ての親の子
+        parent_bone_indexes = np.where(node_store.parent_indexes >= 0, node_bone_indexes[node_store.parent_indexes], 0)
+        # 表示先は最初の子（子がない場合は表示先なし）
+        first_child_indexes = node_store.get_first_child_indexes()
+        tail_bone_indexes = np.where(first_child_indexes >= 0, node_bone_indexes[first_child_indexes], -1)
+
+        for node_idx in sorted_indexes.tolist():
+            # ボーン名は重複しないよう番号を付与
+            base_name = node_store.names[node_idx] or "node{0:03d}".format(node_idx)
+            bone_name = base_name
+            n = 1
+            while bone_name in pmx_model.bones:
+                bone_name = "{0}_{1}".format(base_name, n)
+                n += 1
+
+            tail_index = int(tail_bone_indexes[node_idx])
+            # 回転・表示・操作（表示先がボーンの場合はそのフラグも）
+            flag = 0x0002 | 0x0008 | 0x0010 | (0x0001 if tail_index >= 0 else 0)
+            (x, y, z) = positions[node_idx].tolist()
+
+            bone = Bone(bone_name, base_name, MVector3D.fromFloats(x, y, z), int(parent_bone_indexes[node_idx]), 0, flag, tail_index=tail_index)
+            bone.index = int(node_bone_indexes[node_idx])
+            pmx_model.bones[bone.name] = bone
+            pmx_model.bone_indexes[bone.index] = bone.name
+
+        logger.info("-- ボーン変換完了: %s", len(pmx_model.bones))
+
+        return node_bone_indexes
+
+    # humanoidボーンを準標準ボーン名にして、足りない準標準ボーンをまとめて追加する
+    # 戻り値は追加後のノードINDEXごとのボーンINDEX
+    def convert_standard_bones(self, vrm_model: VrmModel, pmx_model: PmxModel, node_bone_indexes: np.ndarray):
+        bones = [pmx_model.bones[pmx_model.bone_indexes[bone_idx]] for bone_idx in range(len(pmx_model.bone_indexes))]
+        bone_count = len(bones)
+
+        # humanoidボーンの改名（同名の別ボーンがある場合、そちらに番号を付与）
+        rename_bone_indexes = {HUMANOID_BONE_NAMES[bone_name]: int(node_bone_indexes[node_idx]) for (bone_name, node_idx) in vrm_model.humanoid.items()
+                               if bone_name in HUMANOID_BONE_NAMES}
+        bone_names = {bone.name for bone in bones}
+        for bone in bones:
+            if bone.name in rename_bone_indexes and rename_bone_indexes[bone.name] != bone.index:
+                n = 1
+                while "{0}_{1}".format(bone.name, n) in bone_names or "{0}_{1}".format(bone.name, n) in rename_bone_indexes:
+                    n += 1
+                bone.name = "{0}_{1}".format(bone.name, n)
+                bone_names.add(bone.name)
+        for (bone_name, bone_idx) in rename_bone_indexes.items():
+            bones[bone_idx].name = bone_name
+
+        pmx_model.bones = {bone.name: bone for bone in bones}
+        pmx_model.bone_indexes = {bone.index: bone.name for bone in bones}
+        logger.test("humanoid: %s", rename_bone_indexes)
+
+        # 名前からINDEX・位置を引く表（追加するボーンは「既存ボーン数＋追加順」のINDEX）
+        name_indexes = {bone.name: bone.index for bone in bones}
+        positions = {bone.name: bone.position for bone in bones}
+
+        insert_bones = []
+        for definition in STANDARD_BONE_DEFINITIONS:
+            ik = definition.get("ik")
+            fixed_axis = definition.get("fixed_axis")
+            insert_before = definition["insert_before"]
+
+            # 参照するボーンが揃っていない場合は作らない
+            required_names = list(definition["position"]) + ([definition["parent"]] if definition["parent"] else []) + ([insert_before] if insert_before else []) \
+                + (list(fixed_axis) if fixed_axis else []) + ([ik[0]] + [link[0] for link in ik[1]] if ik else [])
+            if definition["name"] in name_indexes or [name for name in required_names if name not in name_indexes]:
+                continue
+
+            position = MVector3D()
+            for name in definition["position"]:
+                position += positions[name]
+            position /= len(definition["position"])
+
+            bone_idx = bone_count + len(insert_bones)
+            # 親の指定がない場合、挿入先の元の親
+            parent_index = name_indexes[definition["parent"]] if definition["parent"] else bones[name_indexes[insert_before]].parent_index
+
+            bone = Bone(definition["name"], definition["english_name"], position, parent_index, 0, definition["flag"])
+            if fixed_axis:
+                bone.fixed_axis = (positions[fixed_axis[1]] - positions[fixed_axis[0]]).normalized()
+            if ik:
+                (target_name, link_definitions, loop, limit_radian) = ik
+                links = [IkLink(name_indexes[link_name], 0 if limit_min is None else 1, limit_min, limit_max) for (link_name, limit_min, limit_max) in link_definitions]
+                bone.ik = Ik(name_indexes[target_name], loop, limit_radian, links)
+
+            # 子にするボーンの親を付け替える
+            for child_name in definition["children"]:
+                if child_name in name_indexes and name_indexes[child_name] < bone_count:
+                    bones[name_indexes[child_name]].parent_index = bone_idx
+
+            insert_bones.append((name_indexes[insert_before] if insert_before else bone_count, bone))
+            name_indexes[bone.name] = bone_idx
+            positions[bone.name] = position
+
+        if not insert_bones:
+            logger.info("-- 準標準ボーン変換完了: %s", len(rename_bone_indexes))
+            return node_bone_indexes
+
+        # まとめて挿入して、INDEXを一度で振り直す
+        bone_remap = pmx_model.insert_bones(insert_bones)
+        logger.test("bone_remap: %s", bone_remap)
+
+        logger.info("-- 準標準ボーン変換完了: %s (追加: %s)", len(rename_bone_indexes), len(insert_bones))
+
+        return bone_remap[node_bone_indexes]
+
+    # glTF（右手系・メートル単位）からMMD（左手系・1m=12.5）への座標変換
+    # モデルの正面がMMDと同じ-Z向きになる軸を反転する（VRM0.xは-Z向きなのでX軸、VRM1.0は+Z向きなのでZ軸）
+    # 頂点・モーフの配列はその場で変換し、複製は作らない
+    def convert_coordinates(self, vrm_model: VrmModel, pmx_model: PmxModel):
+        axis_flips = np.array([1, 1, -1] if vrm_model.is_vrm1 else [-1, 1, 1], dtype=np.float64)
+        position_scales = axis_flips * MMD_UNIT_SCALE
+        # 回転角度は反転した軸以外の軸周りが逆回りになる
+        rotation_flips = -axis_flips
+
+        vertex_store = pmx_model.vertex_store
+        vertex_store.positions *= position_scales.astype(np.float32)
+        vertex_store.normals *= axis_flips.astype(np.float32)
+        vertex_store.sdefs *= position_scales.astype(np.float32)
+
+        # 鏡像になって面の表裏が逆になるので、各面の2番目と3番目の頂点を入れ替える
+        indices = pmx_model.indices
+        second_indices = indices[:, 1].copy()
+        indices[:, 1] = indices[:, 2]
+        indices[:, 2] = second_indices
+
+        for morph in pmx_model.morphs.values():
+            if isinstance(morph.offsets, Morph.VertexMorphOffsets):
+                morph.offsets.position_offsets *= position_scales.astype(np.float32)
+
+        logger.test("axis_flips: %s", axis_flips)
+
+        # ボーン（IKの制限角度はMMDの座標系で指定しているので対象外）
+        bones = list(pmx_model.bones.values())
+        if bones:
+            bone_positions = MVector3DArray([bone.position for bone in bones]).data() * position_scales
+            tail_positions = MVector3DArray([bone.tail_position for bone in bones]).data() * position_scales
+            fixed_axes = MVector3DArray([bone.fixed_axis for bone in bones]).data() * axis_flips
+            local_x_vectors = MVector3DArray([bone.local_x_vector for bone in bones]).data() * axis_flips
+            local_z_vectors = MVector3DArray([bone.local_z_vector for bone in bones]).data() * axis_flips
+
+            for (bone, position, tail_position, fixed_axis, local_x_vector, local_z_vector) in \
+                    zip(bones, bone_positions.tolist(), tail_positions.tolist(), fixed_axes.tolist(), local_x_vectors.tolist(), local_z_vectors.tolist()):
+                bone.position = MVector3D.fromFloats(*position)
+                bone.tail_position = MVector3D.fromFloats(*tail_position)
+                bone.fixed_axis = MVector3D.fromFloats(*fixed_axis)
+                bone.local_x_vector = MVector3D.fromFloats(*local_x_vector)
+                bone.local_z_vector = MVector3D.fromFloats(*local_z_vector)
+
+        # 剛体（大きさは縮尺のみ）
+        rigidbodies = list(pmx_model.rigidbodies.values())
+        if rigidbodies:
+            shape_sizes = MVector3DArray([rigidbody.shape_size for rigidbody in rigidbodies]).data() * MMD_UNIT_SCALE
+            shape_positions = MVector3DArray([rigidbody.shape_position for rigidbody in rigidbodies]).data() * position_scales
+            shape_rotations = MVector3DArray([rigidbody.shape_rotation for rigidbody in rigidbodies]).data() * rotation_flips
+
+            for (rigidbody, shape_size, shape_position, shape_rotation) in zip(rigidbodies, shape_sizes.tolist(), shape_positions.tolist(), shape_rotations.tolist()):
+                rigidbody.shape_size = MVector3D.fromFloats(*shape_size)
+                rigidbody.shape_position = MVector3D.fromFloats(*shape_position)
+                rigidbody.shape_rotation = MVector3D.fromFloats(*shape_rotation)
+
+        # ジョイント（反転した軸の制限は上下限が入れ替わる）
+        joints = list(pmx_model.joints.values())
+        if joints:
+            joint_positions = MVector3DArray([joint.position for joint in joints]).data() * position_scales
+            joint_rotations = MVector3DArray([joint.rotation for joint in joints]).data() * rotation_flips
+            translation_limit_mins = MVector3DArray([joint.translation_limit_min for joint in joints]).data() * position_scales
+            translation_limit_maxs = MVector3DArray([joint.translation_limit_max for joint in joints]).data() * position_scales
+            rotation_limit_mins = MVector3DArray([joint.rotation_limit_min for joint in joints]).data() * rotation_flips
+            rotation_limit_maxs = MVector3DArray([joint.rotation_limit_max for joint in joints]).data() * rotation_flips
+
+            for (joint, position, rotation, translation_limit_min, translation_limit_max, rotation_limit_min, rotation_limit_max) in \
+                    zip(joints, joint_positions.tolist(), joint_rotations.tolist(),
+                        np.minimum(translation_limit_mins, translation_limit_maxs).tolist(), np.maximum(translation_limit_mins, translation_limit_maxs).tolist(),
+                        np.minimum(rotation_limit_mins, rotation_limit_maxs).tolist(), np.maximum(rotation_limit_mins, rotation_limit_maxs).tolist()):
+                joint.position = MVector3D.fromFloats(*position)
+                joint.rotation = MVector3D.fromFloats(*rotation)
+                joint.translation_limit_min = MVector3D.fromFloats(*translation_limit_min)
+                joint.translation_limit_max = MVector3D.fromFloats(*translation_limit_max)
+                joint.rotation_limit_min = MVector3D.fromFloats(*rotation_limit_min)
+                joint.rotation_limit_max = MVector3D.fromFloats(*rotation_limit_max)
+
+        logger.info("-- 座標変換完了")
+
+    # メッシュ変換
+    # プリミティブごとの頂点属性を連結して、項目ごとの配列に格納する
+    def convert_mesh(self, vrm_model: VrmModel, pmx_model: PmxModel, texture_indexes: dict, node_bone_indexes: np.ndarray):
+        positions = []
+        normals = []
+        uvs = []
+        deform_types = []
+        bone_indexes = []
+        weights = []
+        # 材質ごとの面（キー：VRM材質INDEX、値：面リスト）
+        material_faces = {}
+        # モーフごとの差分（キー：モーフ名、値：(頂点INDEX, 差分)リスト）
+        morph_offsets = {}
+
+        # メッシュを使っているノード（キー：メッシュINDEX、値：ノードINDEXリスト）
+        node_store = vrm_model.node_store
+        mesh_node_indexes = {}
+        for node_idx in np.flatnonzero(node_store.mesh_indexes >= 0):
+            mesh_node_indexes.setdefault(int(node_store.mesh_indexes[node_idx]), []).append(int(node_idx))
+
+        # スキンがないメッシュはノードの初期姿勢に置く
+        global_matrices = node_store.get_global_matrices()
+
+        skins_data = vrm_model.json_data.get("skins", [])
+
+        vertex_offset = 0
+        for mesh in vrm_model.meshes:
+            # スキン付きメッシュはノードの位置に依らないので、同じスキンのノードは一度だけ出力する
+            mesh_instances = []
+            mesh_skin_indexes = set()
+            for node_idx in mesh_node_indexes.get(mesh.index, [-1]):
+                skin_idx = int(node_store.skin_indexes[node_idx]) if node_idx >= 0 else -1
+                if skin_idx >= len(skins_data):
+                    skin_idx = -1
+                if skin_idx >= 0:
+                    if skin_idx in mesh_skin_indexes:
+                        logger.warning("同じスキンで複数のノードに使われているメッシュは、最初のノードのみ変換します。mesh: %s, node: %s", mesh.name, node_store.names[node_idx])
+                        continue
+                    mesh_skin_indexes.add(skin_idx)
+                mesh_instances.append((node_idx, skin_idx))
+
+            if len(mesh_instances) > 1:
+                logger.info("-- 複数のノードで使われているメッシュ: %s, %s", mesh.name, len(mesh_instances))
+
+            for node_idx, skin_idx in mesh_instances:
+                # スキンがない場合、ノードのボーン（ノードがない場合は全ての親）に乗せる
+                default_bone_index = int(node_bone_indexes[node_idx]) if node_idx >= 0 else 0
+                if skin_idx >= 0:
+                    joint_bone_indexes = node_bone_indexes[np.array(skins_data[skin_idx].get("joints", []), dtype=np.int64)]
+                    node_matrix = None
+                else:
+                    joint_bone_indexes = np.zeros(0, dtype=np.int32)
+                    node_matrix = global_matrices[node_idx] if node_idx >= 0 else None
+                if node_matrix is not None:
+                    # 法線は逆転置行列で変換する（非一様な縮尺でも面に垂直なまま）
+                    node_normal_matrix = np.linalg.pinv(node_matrix[:3, :3]).T
+
+                # 頂点の出力位置（キー：プリミティブの頂点キー）
+                vertex_offsets = {}
+
+                for primitive in mesh.primitives:
+                    if primitive.mode != VrmReader.PRIMITIVE_MODE_TRIANGLES or "POSITION" not in primitive.attributes:
+                        logger.warning("三角形以外のプリミティブは変換できません。mesh: %s, primitive: %s, mode: %s", mesh.name, primitive.index, primitive.mode)
+                        continue
+
+                    # 頂点属性を共有しているプリミティブは、最初のプリミティブの頂点をそのまま使う（頂点は一度だけ出力する）
+                    if primitive.vertex_key not in vertex_offsets:
+                        vertex_count = len(primitive.attributes["POSITION"])
+
+                        primitive_positions = primitive.attributes["POSITION"]
+                        primitive_normals = primitive.attributes.get("NORMAL", np.zeros((vertex_count, 3), dtype=np.float32))
+                        if node_matrix is not None:
+                            primitive_positions = primitive_positions @ node_matrix[:3, :3].T + node_matrix[:3, 3]
+                            primitive_normals = primitive_normals @ node_normal_matrix.T
+                            normal_lengths = np.linalg.norm(primitive_normals, axis=1, keepdims=True)
+                            primitive_normals = np.divide(primitive_normals, normal_lengths, out=np.zeros_like(primitive_normals), where=normal_lengths > 0)
+                        positions.append(primitive_positions)
+                        normals.append(primitive_normals)
+                        uvs.append(primitive.attributes.get("TEXCOORD_0", np.zeros((vertex_count, 2), dtype=np.float32)))
+
+                        # JOINTS_n と WEIGHTS_n を全て並べる
+                        set_count = 0
+                        while "JOINTS_{0}".format(set_count) in primitive.attributes and "WEIGHTS_{0}".format(set_count) in primitive.attributes:
+                            set_count += 1
+                        if set_count > 0:
+                            primitive_joints = np.concatenate([primitive.attributes["JOINTS_{0}".format(n)] for n in range(set_count)], axis=1)
+                            primitive_weights = np.concatenate([primitive.attributes["WEIGHTS_{0}".format(n)] for n in range(set_count)], axis=1)
+                        else:
+                            primitive_joints = np.zeros((vertex_count, 0), dtype=np.int32)
+                            primitive_weights = np.zeros((vertex_count, 0), dtype=np.float32)
+
+                        primitive_deform_types, primitive_bone_indexes, primitive_weights = \
+                            self.convert_weights(primitive_joints, primitive_weights, joint_bone_indexes, default_bone_index)
+                        deform_types.append(primitive_deform_types)
+                        bone_indexes.append(primitive_bone_indexes)
+                        weights.append(primitive_weights)
+
+                        for target_idx, target in enumerate(primitive.targets):
+                            if "POSITION" not in target or len(target["POSITION"]) == 0:
+                                continue
+
+                            morph_name = mesh.target_names[target_idx] if target_idx < len(mesh.target_names) else "{0}_{1}".format(mesh.name, target_idx)
+                            if morph_name not in morph_offsets:
+                                morph_offsets[morph_name] = []
+                            morph_deltas = target["POSITION"].deltas
+                            if node_matrix is not None:
+                                morph_deltas = morph_deltas @ node_matrix[:3, :3].T
+                            morph_offsets[morph_name].append((target["POSITION"].indices.astype(np.int32) + vertex_offset, morph_deltas))
+
+                        vertex_offsets[primitive.vertex_key] = vertex_offset
+                        vertex_offset += vertex_count
+
+                    if primitive.material_index not in material_faces:
+                        material_faces[primitive.material_index] = []
+                    material_faces[primitive.material_index].append(primitive.indices.reshape(-1, 3).astype(np.int32) + vertex_offsets[primitive.vertex_key])
+
+        if vertex_offset == 0:
+            raise SizingException("変換できるメッシュがありません。")
+
+        # 連結した配列をそのまま使う（座標変換もこの配列上で行う）
+        vertex_store = VertexStore(positions=np.concatenate(positions).astype(np.float32, copy=False), normals=np.concatenate(normals).astype(np.float32, copy=False),
+                                   uvs=np.concatenate(uvs).astype(np.float32, copy=False), deform_types=np.concatenate(deform_types),
+                                   bone_indexes=np.concatenate(bone_indexes), weights=np.concatenate(weights))
+        pmx_model.vertex_store = vertex_store
+
+        logger.test("vertex_store: %s", vertex_store)
+        logger.test("deform_types: %s", np.bincount(vertex_store.deform_types, minlength=3))
+        logger.info("-- 頂点変換完了: %s", len(vertex_store))
+
+        # 面は材質順に並べる（材質なしは最後）
+        faces = []
+        for material_idx in sorted(material_faces.keys(), key=lambda m: (m < 0, m)):
+            material_face = np.concatenate(material_faces[material_idx])
+            faces.append(material_face)
+
+            material = self.create_material(vrm_model, pmx_model, material_idx, texture_indexes, len(material_face) * 3)
+            material.index = len(pmx_model.materials)
+            pmx_model.materials[material.name] = material
+            pmx_model.material_indexes[material.index] = material.name
+
+        pmx_model.indices = np.concatenate(faces)
+
+        logger.info("-- 面・材質変換完了: %s, %s", len(pmx_model.indices), len(pmx_model.materials))
+
+        for morph_name, offsets in morph_offsets.items():
+            morph = Morph(morph_name, morph_name, 4, 1, Morph.VertexMorphOffsets(np.concatenate([o[0] for o in offsets]),
+                                                                              np.concatenate([o[1] for o in offsets]).astype(np.float32, copy=False)))
+            morph.index = len(pmx_model.morphs)
+            pmx_model.morphs[morph.name] = morph
+
+        logger.info("-- モーフ変換完了: %s", len(pmx_model.morphs))
+
+    # ウェイト変換
+    # 全頂点のジョイント・ウェイト (N, K) から、閾値未満を切り捨てて大きい順に最大4つ残し、残った数で BDEF1/BDEF2/BDEF4 を決める
+    # joint_bone_indexes: スキンのジョイント順のボーンINDEX, default_bone_index: ウェイトがない頂点のボーンINDEX
+    def convert_weights(self, joints: np.ndarray, weights: np.ndarray, joint_bone_indexes: np.ndarray, default_bone_index: int):
+        vertex_count, weight_count = weights.shape
+        weights = weights.astype(np.float32)
+
+        # スキンの範囲外のジョイントは無効
+        joints = joints.astype(np.int64)
+        is_valid_joints = (joints >= 0) & (joints < len(joint_bone_indexes))
+        weights[~is_valid_joints | (weights < 0)] = 0
+        bone_indexes = np.zeros((vertex_count, weight_count), dtype=np.int32)
+        if len(joint_bone_indexes) > 0:
+            bone_indexes[is_valid_joints] = joint_bone_indexes[joints[is_valid_joints]]
+
+        # 同じボーンのウェイトは1つにまとめる
+        for n in range(weight_count):
+            for m in range(n + 1, weight_count):
+                is_same_bones = bone_indexes[:, n] == bone_indexes[:, m]
+                weights[is_same_bones, n] += weights[is_same_bones, m]
+                weights[is_same_bones, m] = 0
+
+        # 閾値未満は切り捨て（最大のウェイトは残す）
+        weights[(weights < WEIGHT_THRESHOLD) & (weights < weights.max(axis=1, initial=0, keepdims=True))] = 0
+
+        # 大きい順に最大4つ
+        if weight_count > 4:
+            top_indexes = np.argpartition(-weights, 3, axis=1)[:, :4]
+            weights = np.take_along_axis(weights, top_indexes, axis=1)
+            bone_indexes = np.take_along_axis(bone_indexes, top_indexes, axis=1)
+        elif weight_count < 4:
+            weights = np.pad(weights, ((0, 0), (0, 4 - weight_count)))
+            bone_indexes = np.pad(bone_indexes, ((0, 0), (0, 4 - weight_count)))
+        sorted_indexes = np.argsort(-weights, axis=1, kind="stable")
+        weights = np.take_along_axis(weights, sorted_indexes, axis=1)
+        bone_indexes = np.take_along_axis(bone_indexes, sorted_indexes, axis=1)
+
+        # ウェイトがない頂点はデフォルトのボーンに乗せる
+        weight_sums = weights.sum(axis=1)
+        no_weights = weight_sums <= 0
+        weights[no_weights, 0] = 1
+        bone_indexes[no_weights, 0] = default_bone_index
+        weight_sums[no_weights] = 1
+
+        # 合計1に正規化
+        weights /= weight_sums[:, np.newaxis]
+        bone_indexes[weights <= 0] = 0
+
+        # 残ったウェイトの数で変形方式を決める
+        used_counts = np.count_nonzero(weights, axis=1)
+        deform_types = np.full(vertex_count, PmxWriter.DEFORM_BDEF4, dtype=np.uint8)
+        deform_types[used_counts == 2] = PmxWriter.DEFORM_BDEF2
+        deform_types[used_counts <= 1] = PmxWriter.DEFORM_BDEF1
+
+        return deform_types, bone_indexes, weights
+
+    # 材質生成
+    def create_material(self, vrm_model: VrmModel, pmx_model: PmxModel, material_idx: int, texture_indexes: dict, vertex_count: int):
+        material_data = vrm_model.json_data["materials"][material_idx] if 0 <= material_idx < len(vrm_model.json_data.get("materials", [])) else {}
+
+        # 材質名は重複しないよう番号を付与
+        base_name = material_data.get("name", "") or "材質{0:02d}".format(len(pmx_model.materials))
+        material_name = base_name
+        n = 1
+        while material_name in pmx_model.materials:
+            material_name = "{0}_{1}".format(base_name, n)
+            n += 1
+
+        base_color = material_data.get("pbrMetallicRoughness", {}).get("baseColorFactor", [1, 1, 1, 1])
+        diffuse_color = MVector3D(base_color[0], base_color[1], base_color[2])
+        ambient_color = MVector3D(base_color[0] * 0.5, base_color[1] * 0.5, base_color[2] * 0.5)
+
+        # 描画フラグ（地面影・セルフシャドウマップ・セルフシャドウ）
+        flag = 0x02 | 0x04 | 0x08
+        if material_data.get("doubleSided", False):
+            # 両面描画
+            flag |= 0x01
+
+        main_image_idx, sphere_image_idx = vrm_model.get_material_image_indexes(material_idx)
+        texture_index = texture_indexes.get(main_image_idx, -1)
+        sphere_texture_index = texture_indexes.get(sphere_image_idx, -1)
+        # スフィアは加算
+        sphere_mode = 2 if sphere_texture_index >= 0 else 0
+
+        return Material(material_name, material_name, diffuse_color, base_color[3], 0, MVector3D(), ambient_color, flag, MVector4D(0, 0, 0, 1), 1,
+                        texture_index, sphere_texture_index, sphere_mode, 1, 0, "", vertex_count)
+
+    # 表示枠変換
+    def convert_display_slots(self, pmx_model: PmxModel):
+        root_slot = DisplaySlot("Root", "Root", 1, [(0, pmx_model.bones["全ての親"].index)])
+        pmx_model.display_slots[root_slot.name] = root_slot
+
+        morph_slot = DisplaySlot("表情", "Exp", 1, [(1, morph.index) for morph in pmx_model.morphs.values()])
+        pmx_model.display_slots[morph_slot.name] = morph_slot
+
+        bone_slot = DisplaySlot("ボーン", "Bone", 0, [(0, bone.index) for bone in sorted(pmx_model.bones.values(), key=lambda b: b.index)
+                                                      if bone.index > 0 and bone.getVisibleFlag()])
+        if bone_slot.references:
+            pmx_model.display_slots[bone_slot.name] = bone_slot
+
+    # 使用材質が参照するテクスチャのみ出力（キー：画像INDEX、値：PMXテクスチャINDEX）
+    def export_textures(self, vrm_model: VrmModel, pmx_model: PmxModel, material_indexes: list):
+        image_indexes = []
+        for material_idx in material_indexes:
+            for image_idx in vrm_model.get_material_image_indexes(material_idx):
+                if 0 <= image_idx < len(vrm_model.images) and image_idx not in image_indexes \
+                        and vrm_model.images[image_idx].buffer_view_index >= 0:
+                    image_indexes.append(image_idx)
+
+        texture_indexes = {}
+        if not image_indexes:
+            return texture_indexes
+
+        tex_dir_path = os.path.join(os.path.dirname(self.options.output_path), "tex")
+        os.makedirs(tex_dir_path, exist_ok=True)
+
+        # ファイル名はINDEX順に先に確定させる
+        tex_paths = {}
+        for image_idx in image_indexes:
+            file_name = self.get_texture_file_name(vrm_model.images[image_idx], pmx_model.textures)
+            tex_paths[image_idx] = os.path.join(tex_dir_path, file_name)
+
+            texture_indexes[image_idx] = len(pmx_model.textures)
+            pmx_model.textures.append(os.path.join("tex", file_name))
+
+        # 停止命令は呼び出し元スレッドに出る
+        caller_thread = threading.current_thread()
+
+        with ThreadPoolExecutor(thread_name_prefix="texture", max_workers=max(1, self.options.max_workers)) as executor:
+            futures = {executor.submit(self.write_texture, vrm_model, vrm_model.images[image_idx], tex_paths[image_idx], caller_thread): image_idx
+                       for image_idx in image_indexes}
+
+            try:
+                for n, future in enumerate(concurrent.futures.as_completed(futures)):
+                    # 書き込み中のエラーはここで送出
+                    future.result()
+                    logger.info("-- テクスチャ出力: %s (%s/%s)", os.path.basename(tex_paths[futures[future]]), n + 1, len(futures))
+            except Exception as e:
+                # 未着手のものは取り消す
+                for f in futures:
+                    f.cancel()
+                raise e
+
+        logger.info("-- テクスチャ出力完了: %s", len(texture_indexes))
+
+        return texture_indexes
+
+    # テクスチャファイル名
+    def get_texture_file_name(self, image, textures: list):
+        base_name = re.sub(r'[\\/:*?"<>|]', "_", image.name) if image.name else "texture{0:02d}".format(image.index)
+        # 名前に画像拡張子が含まれている場合は除く
+        if os.path.splitext(base_name)[1].lower() in [".png", ".jpg", ".jpeg"]:
+            base_name = os.path.splitext(base_name)[0]
+        ext = IMAGE_EXTENSIONS.get(image.mime_type, ".png")
+
+        file_name = "{0}{1}".format(base_name, ext)
+        n = 1
+        while os.path.join("tex", file_name) in textures:
+            file_name = "{0}_{1}{2}".format(base_name, n, ext)
+            n += 1
+
+        return file_name
+
+    # BINチャンク上の画像をデコードせずそのままファイルに書き込む
+    def write_texture(self, vrm_model: VrmModel, image, tex_path: str, caller_thread: threading.Thread):
+        # 停止命令が出ている場合、エラー
+        check_killed(caller_thread)
+
+        try:
+            with open(tex_path, "wb") as f:
+                f.write(vrm_model.get_image_view(image))
+        except Exception as e:
+            # 書きかけのファイルは残さない
+            if os.path.exists(tex_path):
+                os.remove(tex_path)
+            raise e
+
+        logger.test("texture: %s -> %s", image, tex_path)
+
+        return tex_path
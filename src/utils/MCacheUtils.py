@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+
+import os
+import glob
+import hashlib
+import tempfile
+import _pickle as cPickle
+
+from utils.MLogger import MLogger # noqa
+
+logger = MLogger(__name__)
+
+# キャッシュディレクトリ名（history.jsonと同じ階層）
+CACHE_DIR_NAME = "cache"
+# キャッシュファイルの拡張子
+CACHE_EXT = ".cache"
+# キャッシュ全体の最大サイズ（超えた分は使われていない順に削除）
+MAX_CACHE_SIZE = 1024 ** 3
+
+
+# キャッシュディレクトリパス
+def get_cache_dir_path(mydir_path):
+    return os.path.join(mydir_path, CACHE_DIR_NAME)
+
+
+# キャッシュキー（入力データのハッシュと変換条件から生成）
+def get_cache_key(*values):
+    blake2 = hashlib.blake2b(digest_size=32)
+    for value in values:
+        blake2.update(str(value).encode('utf-8'))
+        blake2.update(b'\0')
+
+    return blake2.hexdigest()
+
+
+# キャッシュファイルパス
+def get_cache_path(mydir_path, cache_key):
+    return os.path.join(get_cache_dir_path(mydir_path), "{0}{1}".format(cache_key, CACHE_EXT))
+
+
+# キャッシュ読み込み（ない場合・読めない場合はNone）
+def read_cache(mydir_path, cache_key):
+    if not mydir_path or not cache_key:
+        return None
+
+    cache_path = get_cache_path(mydir_path, cache_key)
+    if not os.path.exists(cache_path):
+        return None
+
+    try:
+        with open(cache_path, 'rb') as f:
+            data = cPickle.load(f)
+
+        # 使用日時を更新（削除順の判定に使う）
+        os.utime(cache_path)
+        logger.test("read_cache: %s", cache_path)
+
+        return data
+    except Exception as e:
+        # 壊れたキャッシュは削除して、無かったものとする
+        logger.debug("キャッシュの読み込みに失敗しました: %s, %s", cache_path, e)
+        remove_cache_file(cache_path)
+
+    return None
+
+
+# キャッシュ保存（失敗しても処理は続ける）
+def save_cache(mydir_path, cache_key, data, max_size=MAX_CACHE_SIZE):
+    if not mydir_path or not cache_key:
+        return False
+
+    cache_dir_path = get_cache_dir_path(mydir_path)
+    temp_path = None
+
+    try:
+        os.makedirs(cache_dir_path, exist_ok=True)
+
+        # 一時ファイルに書き込んでから置き換える（書きかけのキャッシュを読まないため）
+        fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=cache_dir_path)
+        with os.fdopen(fd, 'wb') as f:
+            cPickle.dump(data, f, -1)
+
+        os.replace(temp_path, get_cache_path(mydir_path, cache_key))
+        logger.test("save_cache: %s", get_cache_path(mydir_path, cache_key))
+    except Exception as e:
+        logger.debug("キャッシュの保存に失敗しました: %s, %s", cache_dir_path, e)
+        if temp_path:
+            remove_cache_file(temp_path)
+        return False
+
+    evict_cache(mydir_path, max_size)
+
+    return True
+
+
+# 最大サイズを超えた分を、使われていない順に削除
+def evict_cache(mydir_path, max_size=MAX_CACHE_SIZE):
+    cache_files = []
+    for cache_path in glob.glob(os.path.join(get_cache_dir_path(mydir_path), "*{0}".format(CACHE_EXT))):
+        try:
+            stat = os.stat(cache_path)
+            cache_files.append((stat.st_mtime, stat.st_size, cache_path))
+        except OSError:
+            pass
+
+    total_size = sum([size for (_, size, _) in cache_files])
+
+    for (_, size, cache_path) in sorted(cache_files):
+        if total_size <= max_size:
+            break
+
+        if remove_cache_file(cache_path):
+            total_size -= size
+            logger.test("evict_cache: %s", cache_path)
+
+    return total_size
+
+
+def remove_cache_file(cache_path):
+    try:
+        os.remove(cache_path)
+        return True
+    except OSError:
+        return False
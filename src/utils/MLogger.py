@@ -2,6 +2,7 @@
 #
 from datetime import datetime
 import logging
+import os
 import traceback
 import threading
 import sys
@@ -32,6 +33,8 @@ class MLogger():
     total_level = logging.INFO
     is_file = False
     outout_datetime = ""
+    # 停止命令を出したか（出していない間は、スレッドごとの停止命令を確認しない。新しい処理の開始時に戻す）
+    is_killing = False
     
     logger = None
 
@@ -39,6 +42,8 @@ class MLogger():
         self.module_name = module_name
         self.default_level = level
         self.child = False
+        # ファイル出力ハンドラ（出力ファイルが変わるまで使い回す）
+        self.file_handler = None
 
         # ロガー
         self.logger = logging.getLogger("Vrm2PmxExporter").getChild(self.module_name)
@@ -57,50 +62,59 @@ class MLogger():
         self.child = True
 
         for f in self.logger.handlers:
-            if isinstance(f, logging.StreamHandler):
+            if isinstance(f, logging.StreamHandler) and not isinstance(f, logging.FileHandler):
                 f.setStream(options.monitor)
 
     def time(self, msg, *args, **kwargs):
-        if not kwargs:
-            kwargs = {}
-            
+        if self.TIMER < self.total_level or self.TIMER < self.default_level:
+            check_killed()
+            return
+
         kwargs["level"] = self.TIMER
         kwargs["time"] = True
         self.print_logger(msg, *args, **kwargs)
 
     def info_debug(self, msg, *args, **kwargs):
-        if not kwargs:
-            kwargs = {}
-            
+        if self.INFO_DEBUG < self.total_level or self.INFO_DEBUG < self.default_level:
+            check_killed()
+            return
+
         kwargs["level"] = self.INFO_DEBUG
         kwargs["time"] = True
         self.print_logger(msg, *args, **kwargs)
 
     def test(self, msg, *args, **kwargs):
-        if not kwargs:
-            kwargs = {}
+        if self.TEST < self.total_level or self.TEST < self.default_level:
+            check_killed()
+            return
 
         kwargs["level"] = self.TEST
         kwargs["time"] = True
         self.print_logger(msg, *args, **kwargs)
     
     def debug(self, msg, *args, **kwargs):
-        if not kwargs:
-            kwargs = {}
-            
+        if self.DEBUG < self.total_level or self.DEBUG < self.default_level:
+            check_killed()
+            return
+
         kwargs["level"] = logging.DEBUG
         kwargs["time"] = True
         self.print_logger(msg, *args, **kwargs)
     
     def info(self, msg, *args, **kwargs):
-        if not kwargs:
-            kwargs = {}
-            
+        if self.INFO < self.total_level or self.INFO < self.default_level:
+            check_killed()
+            return
+
         kwargs["level"] = logging.INFO
         self.print_logger(msg, *args, **kwargs)
 
     # ログレベルカウント
     def count(self, msg, fno, fnos, *args, **kwargs):
+        if self.INFO < self.total_level or self.INFO < self.default_level:
+            check_killed()
+            return
+
         last_fno = 0
 
         if fnos and len(fnos) > 0 and fnos[-1] > 0:
@@ -118,49 +132,40 @@ class MLogger():
             self.print_logger(log_msg, *args, **kwargs)
 
     def warning(self, msg, *args, **kwargs):
-        if not kwargs:
-            kwargs = {}
-            
+        if self.WARNING < self.total_level or self.WARNING < self.default_level:
+            check_killed()
+            return
+
         kwargs["level"] = logging.WARNING
         self.print_logger(msg, *args, **kwargs)
 
     def error(self, msg, *args, **kwargs):
-        if not kwargs:
-            kwargs = {}
-            
+        if self.ERROR < self.total_level or self.ERROR < self.default_level:
+            check_killed()
+            return
+
         kwargs["level"] = logging.ERROR
         self.print_logger(msg, *args, **kwargs)
 
     def critical(self, msg, *args, **kwargs):
-        if not kwargs:
-            kwargs = {}
-            
+        if self.CRITICAL < self.total_level or self.CRITICAL < self.default_level:
+            check_killed()
+            return
+
         kwargs["level"] = logging.CRITICAL
         self.print_logger(msg, *args, **kwargs)
 
     # 実際に出力する実態
     def print_logger(self, msg, *args, **kwargs):
-
-        if "is_killed" in threading.current_thread()._kwargs and threading.current_thread()._kwargs["is_killed"]:
-            # 停止命令が出ている場合、エラー
-            raise MKilledException()
+        check_killed()
 
         target_level = kwargs.pop("level", logging.INFO)
         # if self.logger.isEnabledFor(target_level) and self.default_level <= target_level:
         if self.total_level <= target_level and self.default_level <= target_level:
 
             if self.is_file:
-                for f in self.logger.handlers:
-                    if isinstance(f, logging.FileHandler):
-                        # 既存のファイルハンドラはすべて削除
-                        self.logger.removeHandler(f)
-
                 # ファイル出力ありの場合、ハンドラ紐付け
-                # ファイル出力ハンドラ
-                fh = logging.FileHandler("log/VmdSizing_{0}.log".format(self.outout_datetime))
-                fh.setLevel(self.default_level)
-                fh.setFormatter(logging.Formatter(self.DEFAULT_FORMAT))
-                self.logger.addHandler(fh)
+                self.set_file_handler()
 
             # モジュール名を出力するよう追加
             extra_args = {}
@@ -207,6 +212,24 @@ class MLogger():
             except Exception as e:
                 raise e
             
+    # ファイル出力ハンドラの紐付け（出力ファイルが変わった場合のみ作り直す）
+    def set_file_handler(self):
+        file_path = os.path.abspath("log/VmdSizing_{0}.log".format(self.outout_datetime))
+        if self.file_handler and self.file_handler.baseFilename == file_path:
+            return
+
+        for f in list(self.logger.handlers):
+            if isinstance(f, logging.FileHandler):
+                # 既存のファイルハンドラはすべて削除
+                self.logger.removeHandler(f)
+                f.close()
+
+        # ファイル出力ハンドラ
+        self.file_handler = logging.FileHandler(file_path)
+        self.file_handler.setLevel(self.default_level)
+        self.file_handler.setFormatter(logging.Formatter(self.DEFAULT_FORMAT))
+        self.logger.addHandler(self.file_handler)
+
     def create_box_message(self, msg, level, title=None):
         msg_block = []
         msg_block.append("■■■■■■■■■■■■■■■■■")
@@ -264,8 +287,23 @@ class MLogger():
         cls.outout_datetime = "{0:%Y%m%d_%H%M%S}".format(datetime.now())
 
 
+# 停止命令が出ている場合、エラー
+# 停止命令の確認（ログを出力しない場合も確認する）
+# thread: 停止命令を確認するスレッド（指定がない場合は実行中のスレッド）
+def check_killed(thread=None):
+    if MLogger.is_killing:
+        thread_kwargs = getattr(thread or threading.current_thread(), "_kwargs", None)
+        if thread_kwargs and thread_kwargs.get("is_killed", False):
+            raise MKilledException()
+
+
 @cython.ccall
 def print_message(msg: str, target_level: int):
-    sys.stdout.write(msg + "\n", (target_level < MLogger.INFO))
+    try:
+        # GUIのコンソールはINFO未満をまとめて出力する
+        sys.stdout.write(msg + "\n", (target_level < MLogger.INFO))
+    except TypeError:
+        # 標準出力の場合（コマンドライン実行）
+        sys.stdout.write(msg + "\n")
 
 